@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# cityscapes encode_segmap基准测试：逐类别mask循环 vs 256项查找表
+# python benchmarks/bench_encode_segmap.py --height 1024 --width 2048 --repeat 20
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semseg.dataloader.utils import make_label_lut, apply_label_lut
+
+VOID_CLASSES = [0, 1, 2, 3, 4, 5, 6, 9, 10, 14, 15, 16, 18, 29, 30, -1]
+VALID_CLASSES = [7, 8, 11, 12, 13, 17, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 31, 32, 33]
+IGNORE_INDEX = 250
+
+
+def encode_segmap_loop(mask, class_map):
+    # 原cityscapesLoader.encode_segmap的实现
+    mask = mask.copy()
+    for _voidc in VOID_CLASSES:
+        mask[mask == _voidc] = IGNORE_INDEX
+    for _validc in VALID_CLASSES:
+        mask[mask == _validc] = class_map[_validc]
+    return mask
+
+
+def main(args):
+    rng = np.random.RandomState(0)
+    mask = rng.randint(0, 34, size=(args.height, args.width)).astype(np.uint8)
+    class_map = dict(zip(VALID_CLASSES, range(19)))
+    lut = make_label_lut(class_map, VOID_CLASSES, IGNORE_INDEX)
+
+    assert np.array_equal(encode_segmap_loop(mask, class_map), apply_label_lut(mask, lut))
+
+    t_loop = min(timeit.repeat(lambda: encode_segmap_loop(mask, class_map), number=1, repeat=args.repeat))
+    t_lut = min(timeit.repeat(lambda: apply_label_lut(mask, lut), number=1, repeat=args.repeat))
+    out = np.empty_like(mask)
+    t_lut_out = min(timeit.repeat(lambda: apply_label_lut(mask, lut, out=out), number=1, repeat=args.repeat))
+
+    print('label size: {}x{}'.format(args.height, args.width))
+    print('loop:          {:.3f} ms'.format(t_loop * 1000))
+    print('lut:           {:.3f} ms ({:.1f}x)'.format(t_lut * 1000, t_loop / t_lut))
+    print('lut (out=):    {:.3f} ms ({:.1f}x)'.format(t_lut_out * 1000, t_loop / t_lut_out))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='encode_segmap benchmark')
+    parser.add_argument('--height', type=int, default=1024, help='label height [ 1024 ]')
+    parser.add_argument('--width', type=int, default=2048, help='label width [ 2048 ]')
+    parser.add_argument('--repeat', type=int, default=10, help='timing repeats [ 10 ]')
+    args = parser.parse_args()
+    main(args)
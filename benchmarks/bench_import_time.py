@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# 各入口模块的启动(import)耗时：每个入口在新的进程中用python -X importtime导入，
+# 记录总耗时和最重的顶层依赖，可保存为json并与之前的结果比较，发现启动时间的回退
+# python benchmarks/bench_import_time.py --repeat 5 --output import_time.json
+# python benchmarks/bench_import_time.py --baseline import_time.json --threshold 0.2
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = [
+    'semseg.dataloader.camvid_loader',
+    'semseg.dataloader.cityscapes_loader',
+    'semseg.dataloader.packed_loader',
+    'semseg.modelloader',
+    'semseg.modelloader.pspnet',
+    'semseg.inference',
+    'semseg.metrics',
+    'train',
+    'validate',
+]
+
+
+def parse_importtime(stderr):
+    """Parses -X importtime output into [(package, depth, self_us, cumulative_us)]"""
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        name = fields[2].rstrip()
+        stripped = name.lstrip()
+        # 嵌套的import每层缩进两个空格
+        depth = (len(name) - len(stripped) - 1) // 2
+        records.append((stripped, depth, int(fields[0]), int(fields[1])))
+    return records
+
+
+def measure(entry, python=sys.executable):
+    """Imports entry in a fresh interpreter, returns (wall_ms, import_ms, records)"""
+    start = time.time()
+    proc = subprocess.run([python, '-X', 'importtime', '-c', 'import ' + entry], cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall_ms = (time.time() - start) * 1000
+    records = parse_importtime(proc.stderr)
+    if proc.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(entry, proc.stderr.splitlines()[-1] if proc.stderr else ''))
+    import_ms = sum(r[3] for r in records if r[1] == 0) / 1000.0
+    return wall_ms, import_ms, records
+
+
+def run(entries, repeat, top):
+    results = {}
+    for entry in entries:
+        best = None
+        for _ in range(repeat):
+            wall_ms, import_ms, records = measure(entry)
+            # 取多次中最快的一次，减少系统噪声
+            if best is None or import_ms < best[1]:
+                best = (wall_ms, import_ms, records)
+        wall_ms, import_ms, records = best
+        # 按顶层包汇总self耗时，如torch、matplotlib、google(protobuf)
+        packages = {}
+        for name, _, self_us, _ in records:
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + self_us
+        heaviest = sorted(packages.items(), key=lambda kv: -kv[1])[:top]
+        results[entry] = {
+            'wall_ms': round(wall_ms, 2),
+            'import_ms': round(import_ms, 2),
+            'top': [[name, round(us / 1000.0, 2)] for name, us in heaviest],
+        }
+    return results
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """Returns the entries whose import time regressed against the baseline"""
+    regressions = []
+    for entry, res in results.items():
+        if entry not in baseline:
+            continue
+        old, new = baseline[entry]['import_ms'], res['import_ms']
+        if new > old * (1 + threshold) and new - old > min_delta_ms:
+            regressions.append((entry, old, new))
+    return regressions
+
+
+def main(args):
+    entries = args.entries.split(',') if args.entries != '' else ENTRY_POINTS
+    results = run(entries, args.repeat, args.top)
+
+    print('{:<40s} {:>10s} {:>10s}  {}'.format('entry', 'wall ms', 'import ms', 'heaviest packages (ms)'))
+    for entry in entries:
+        res = results[entry]
+        heavy = ', '.join('{} {:.0f}'.format(name, ms) for name, ms in res['top'])
+        print('{:<40s} {:>10.1f} {:>10.1f}  {}'.format(entry, res['wall_ms'], res['import_ms'], heavy))
+
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'results': results}, f, indent=2)
+
+    if args.baseline != '':
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        for entry, old, new in regressions:
+            print('regression: {} {:.1f} ms -> {:.1f} ms'.format(entry, old, new))
+        if regressions:
+            sys.exit(1)
+        print('no regression against {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='import time benchmark of the entry points')
+    parser.add_argument('--entries', type=str, default='', help='comma separated modules, empty for all entry points')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per entry, the fastest is kept [ 3 ]')
+    parser.add_argument('--top', type=int, default=5, help='heaviest top-level packages to report [ 5 ]')
+    parser.add_argument('--output', type=str, default='', help='save the results as json')
+    parser.add_argument('--baseline', type=str, default='', help='json saved by --output to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown [ 0.2 ]')
+    parser.add_argument('--min_delta_ms', type=float, default=20.0, help='ignore slowdowns smaller than this [ 20 ]')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# 标签图编码基准测试：int64/uint8原始数组 vs 调色板PNG、rle和packbits的大小与编解码速度
+# 默认使用合成的CamVid/Cityscapes大小的分块标签图，--masks指定真实标签(如CamVid/valannot/*.png)
+# python benchmarks/bench_mask_encoding.py --dataset CityScapes --repeat 5
+# python benchmarks/bench_mask_encoding.py --masks '~/Data/CamVid/valannot/*.png' --repeat 5
+import argparse
+import glob
+import os
+import sys
+import timeit
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semseg.mask_encoding import MASK_FORMATS, encode_mask, decode_mask
+
+DATASETS = {'CamVid': ((360, 480), 13), 'CityScapes': ((1024, 2048), 19)}
+
+
+def synthetic_masks(size, n_classes, n_masks, n_regions=60, seed=0):
+    # Voronoi区域模拟分割结果中成片的类别，在1/4分辨率上计算后放大
+    rng = np.random.RandomState(seed)
+    h, w = size[0] // 4, size[1] // 4
+    yy, xx = np.mgrid[:h, :w]
+    masks = []
+    for _ in range(n_masks):
+        seeds = rng.rand(n_regions, 2) * [h, w]
+        labels = rng.randint(0, n_classes, n_regions).astype(np.uint8)
+        d = (yy[None] - seeds[:, 0, None, None]) ** 2 + (xx[None] - seeds[:, 1, None, None]) ** 2
+        masks.append(np.repeat(np.repeat(labels[d.argmin(0)], 4, axis=0), 4, axis=1))
+    return masks
+
+
+def load_masks(pattern, n_masks):
+    paths = sorted(glob.glob(os.path.expanduser(pattern)))[:n_masks]
+    return [np.asarray(Image.open(p), dtype=np.uint8) for p in paths]
+
+
+def main(args):
+    if args.masks != '':
+        masks = load_masks(args.masks, args.n_masks)
+        source = args.masks
+    else:
+        size, n_classes = DATASETS[args.dataset]
+        masks = synthetic_masks(size, n_classes, args.n_masks)
+        source = 'synthetic {} {}x{}'.format(args.dataset, size[0], size[1])
+    if len(masks) == 0:
+        print('no masks found')
+        return
+    pixels = float(sum(m.size for m in masks))
+
+    print('{} masks, {}'.format(len(masks), source))
+    print('{:<10s} {:>12s} {:>10s} {:>10s} {:>12s} {:>12s}'.format(
+        'format', 'bytes/mask', 'bits/px', 'vs int64', 'encode ms', 'decode ms'))
+    print('{:<10s} {:>12.0f} {:>10.2f} {:>9.1f}x {:>12s} {:>12s}'.format(
+        'int64', 8 * pixels / len(masks), 64.0, 1.0, '', ''))
+    print('{:<10s} {:>12.0f} {:>10.2f} {:>9.1f}x {:>12s} {:>12s}'.format(
+        'uint8', pixels / len(masks), 8.0, 8.0, '', ''))
+    for fmt in MASK_FORMATS:
+        encoded = [encode_mask(m, fmt) for m in masks]
+        for m, data in zip(masks, encoded):
+            assert np.array_equal(decode_mask(data, fmt), m)
+        n_bytes = float(sum(len(data) for data in encoded))
+        t_encode = min(timeit.repeat(lambda: [encode_mask(m, fmt) for m in masks], number=1, repeat=args.repeat))
+        t_decode = min(timeit.repeat(lambda: [decode_mask(d, fmt) for d in encoded], number=1, repeat=args.repeat))
+        print('{:<10s} {:>12.0f} {:>10.2f} {:>9.1f}x {:>12.3f} {:>12.3f}'.format(
+            fmt, n_bytes / len(masks), 8 * n_bytes / pixels, 8 * pixels / n_bytes,
+            1000 * t_encode / len(masks), 1000 * t_decode / len(masks)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mask encoding benchmark')
+    parser.add_argument('--dataset', type=str, default='CamVid', help='size and class num of the synthetic masks [ CamVid CityScapes ]')
+    parser.add_argument('--masks', type=str, default='', help='glob of label PNGs to use instead of synthetic masks')
+    parser.add_argument('--n_masks', type=int, default=8, help='number of masks [ 8 ]')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repeats [ 5 ]')
+    args = parser.parse_args()
+    main(args)
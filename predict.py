@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# 批量预测：输入为图像目录、文件列表(.txt每行一个路径)或glob，不需要标签；
+# 线程池解码和预处理，最多queue_size张图像在队列中，主线程按batch前向，
+# 单独的写线程保存标签图(调色板PNG、rle或packbits，见semseg.mask_encoding)和可选的blend图，
+# 输出文件名由输入的相对路径决定，重复运行结果相同
+# python predict.py --structure ENet --model_state_dict ENet_camvid_class_13_100.pt --inputs ~/Data/CamVid/test --output_dir pred
+# python predict.py --torchscript ENet_360x480.pt --inputs 'images/*.jpg' --img_size 360x480 --output_dir pred --blend_dir blend
+import argparse
+import collections
+import glob
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from semseg.dataloader.utils import blend_segmap, normalize_batch
+from semseg.inference import OOMFallbackPredictor, model_output
+from semseg.mask_encoding import MASK_FORMATS, save_mask
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.ppm')
+
+
+def dataset_constants(dataset):
+    """(BGR mean, divide by 255, palette, n_classes) of the images the model was trained on"""
+    if dataset == 'CityScapes':
+        from semseg.dataloader.cityscapes_loader import cityscapesLoader
+        return np.array(cityscapesLoader.mean_rgb['cityscapes']), True, cityscapesLoader.palette, 19
+    from semseg.dataloader.camvid_loader import camvidLoader
+    return camvidLoader.mean, True, camvidLoader.palette, 13
+
+
+def collect_inputs(inputs):
+    """Image paths of the directories (recursive), .txt file lists and glob patterns, sorted"""
+    paths = []
+    for item in inputs:
+        item = os.path.expanduser(item)
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(IMG_EXTENSIONS))
+        elif item.endswith('.txt') and os.path.isfile(item):
+            with open(item) as f:
+                paths.extend(os.path.expanduser(line.strip()) for line in f if line.strip() != '')
+        else:
+            paths.extend(p for p in glob.glob(item) if p.lower().endswith(IMG_EXTENSIONS))
+    # 去重后排序，顺序和输出文件名都与输入的写法无关
+    return sorted(set(os.path.abspath(p) for p in paths))
+
+
+def output_names(paths):
+    """Output name (without extension) of each path: the path relative to their common directory
+
+    Images differing only by the extension keep it in the name, e.g. a_jpg and a_png.
+    """
+    if len(paths) == 0:
+        return []
+    root = os.path.commonpath([os.path.dirname(p) for p in paths])
+    stems = [os.path.splitext(os.path.relpath(p, root))[0] for p in paths]
+    counts = collections.Counter(stems)
+    return [stem if counts[stem] == 1 else stem + '_' + os.path.splitext(p)[1][1:].lower()
+            for stem, p in zip(stems, paths)]
+
+
+class Preprocessor(object):
+    """Decodes an image file to the uint8 CHW BGR tensor of the loaders (img_uint8=True)
+
+    :param img_size: (h, w) the image is resized to, None keeps the image size
+    :param keep_rgb: also return the decoded RGB image before resizing, for the blends
+    """
+
+    def __init__(self, img_size=None, keep_rgb=False):
+        self.img_size = img_size
+        self.keep_rgb = keep_rgb
+
+    def __call__(self, path):
+        img = Image.open(path).convert('RGB')
+        size = (img.size[1], img.size[0])
+        rgb = np.asarray(img, dtype=np.uint8)
+        if self.img_size is not None and tuple(self.img_size) != size:
+            img = img.resize((self.img_size[1], self.img_size[0]), Image.BILINEAR)
+        # RGB -> BGR，HWC -> CHW
+        chw = torch.from_numpy(np.ascontiguousarray(np.asarray(img, dtype=np.uint8)[:, :, ::-1].transpose(2, 0, 1)))
+        return chw, size, rgb if self.keep_rgb else None
+
+
+def preprocess_stream(paths, preprocess, workers=4, queue_size=16):
+    """Yields (index, path, preprocess(path) or the exception) in the input order
+
+    At most queue_size images are decoded ahead of the consumer, so the memory does
+    not grow with the number of inputs.
+    """
+    def _run(path):
+        try:
+            return preprocess(path)
+        except Exception as e:
+            return e
+
+    it = enumerate(paths)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in range(queue_size):
+            item = next(it, None)
+            if item is None:
+                break
+            pending.append((item[0], item[1], pool.submit(_run, item[1])))
+        while pending:
+            index, path, future = pending.popleft()
+            result = future.result()
+            item = next(it, None)
+            if item is not None:
+                pending.append((item[0], item[1], pool.submit(_run, item[1])))
+            yield index, path, result
+
+
+def batch_stream(samples, batch_size):
+    """Groups consecutive samples of the same input size into batches of at most batch_size"""
+    batch = []
+    for sample in samples:
+        if batch and (len(batch) == batch_size or batch[-1][2].size() != sample[2].size()):
+            yield batch
+            batch = []
+        batch.append(sample)
+    if batch:
+        yield batch
+
+
+class MaskWriter(object):
+    """Writer thread saving the encoded predicted masks and the optional blends
+
+    put() blocks when queue_size masks are waiting, close() waits for the last
+    ones and raises the first error of the thread.
+    """
+
+    def __init__(self, output_dir, palette, blend_dir='', alpha=0.5, queue_size=16, mask_format='png'):
+        self.output_dir = output_dir
+        self.mask_format = mask_format
+        self.blend_dir = blend_dir
+        self.palette = palette
+        self.alpha = alpha
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.written = 0
+        self.write_time = 0.0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, name, mask, size, rgb=None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((name, mask, size, rgb))
+
+    @staticmethod
+    def _makedirs(path):
+        d = os.path.dirname(path)
+        if d != '' and not os.path.isdir(d):
+            os.makedirs(d, exist_ok=True)
+
+    def write(self, name, mask, size, rgb=None):
+        img = Image.fromarray(mask)
+        if tuple(mask.shape) != tuple(size):
+            # 输入缩放过时，标签图用最近邻恢复到原图大小
+            img = img.resize((size[1], size[0]), Image.NEAREST)
+        mask = np.asarray(img)
+        if self.blend_dir != '' and rgb is not None:
+            path = os.path.join(self.blend_dir, name + '.png')
+            self._makedirs(path)
+            Image.fromarray(blend_segmap(rgb, mask, self.palette, alpha=self.alpha)).save(path)
+        path = os.path.join(self.output_dir, name)
+        self._makedirs(path)
+        save_mask(path, mask, self.mask_format, self.palette)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            start = time.perf_counter()
+            try:
+                self.write(*item)
+                self.written += 1
+            except Exception as e:
+                self.error = e
+            self.write_time += time.perf_counter() - start
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def load_model(args, n_classes, device):
+    if args.torchscript != '':
+        # semseg.export导出的TorchScript，输入大小需与导出时一致
+        return torch.jit.load(os.path.expanduser(args.torchscript), map_location=device).eval()
+    from semseg.modelloader import get_model
+    model = get_model(args.structure, n_classes=n_classes)
+    if args.model_state_dict != '':
+        model.load_state_dict(torch.load(os.path.expanduser(args.model_state_dict), map_location='cpu'))
+    model.eval()
+    if args.fuse_bn:
+        from semseg.modelloader.fusion import optimize_for_inference
+        model = optimize_for_inference(model)
+    return model.to(device)
+
+
+def predict(args):
+    if args.mask_format not in MASK_FORMATS:
+        raise ValueError('unknown mask format {}, available: {}'.format(args.mask_format, ', '.join(MASK_FORMATS)))
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    mean, img_norm, palette, n_classes = dataset_constants(args.dataset)
+    n_classes = args.n_classes if args.n_classes > 0 else n_classes
+    img_size = tuple(int(v) for v in args.img_size.split('x')) if args.img_size != '' else None
+
+    paths = collect_inputs(args.inputs.split(','))
+    names = output_names(paths)
+    print('{} images'.format(len(paths)))
+    if len(paths) == 0:
+        return
+    model = load_model(args, n_classes, device)
+    # 显存/内存不足时自动减半batch
+    predictor = OOMFallbackPredictor(lambda imgs: model_output(model(imgs)))
+
+    blend_dir = os.path.expanduser(args.blend_dir) if args.blend_dir != '' else ''
+    writer = MaskWriter(os.path.expanduser(args.output_dir), palette, blend_dir=blend_dir,
+                        queue_size=args.queue_size, mask_format=args.mask_format)
+    samples = preprocess_stream(paths, Preprocessor(img_size, keep_rgb=blend_dir != ''),
+                                workers=args.workers, queue_size=args.queue_size)
+    failed = []
+
+    def decoded():
+        for index, path, result in samples:
+            if isinstance(result, Exception):
+                print('skip {}: {}'.format(path, result))
+                failed.append(path)
+                continue
+            # (index, path, chw, size, rgb)
+            yield (index, path) + result
+
+    batches = batch_stream(decoded(), args.batch_size)
+    n_images = 0
+    input_wait, forward_time, output_wait = 0.0, 0.0, 0.0
+    start = time.perf_counter()
+    try:
+        while True:
+            t = time.perf_counter()
+            batch = next(batches, None)
+            input_wait += time.perf_counter() - t
+            if batch is None:
+                break
+            t = time.perf_counter()
+            with torch.no_grad():
+                imgs = normalize_batch(torch.stack([s[2] for s in batch]).to(device), mean, img_norm)
+                masks = predictor(imgs).max(1)[1].to(torch.uint8).cpu().numpy()
+            forward_time += time.perf_counter() - t
+            t = time.perf_counter()
+            for sample, mask in zip(batch, masks):
+                writer.put(names[sample[0]], mask, sample[3], sample[4])
+            output_wait += time.perf_counter() - t
+            n_images += len(batch)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+
+    print('{} images in {:.2f} s, {:.2f} img/s, {} failed'.format(
+        n_images, elapsed, n_images / max(elapsed, 1e-9), len(failed)))
+    # 主线程等待解码的时间长说明瓶颈在输入，等待写线程的时间长说明瓶颈在输出
+    print('forward {:.2f} ms/img, waiting for decoding {:.2f} s, waiting for the writer {:.2f} s, '
+          'writing {:.2f} s'.format(1000 * forward_time / max(n_images, 1), input_wait, output_wait,
+                                    writer.write_time))
+    return n_images, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='predict the masks of a directory, file list or glob of images')
+    parser.add_argument('--inputs', type=str, default='', help='comma separated image directories, .txt file lists or glob patterns')
+    parser.add_argument('--output_dir', type=str, default='pred', help='directory of the masks [ pred ]')
+    parser.add_argument('--mask_format', type=str, default='png', help='mask encoding, png is a palette PNG [ ' + ' '.join(MASK_FORMATS) + ' ]')
+    parser.add_argument('--blend_dir', type=str, default='', help='also save the masks blended with the images to this directory')
+    parser.add_argument('--structure', type=str, default='ENet', help='use the net structure to segment [ ENet fcn32s segnet erfnet ]')
+    parser.add_argument('--model_state_dict', type=str, default='', help='model state dict path [ ENet_camvid_class_13_100.pt ]')
+    parser.add_argument('--torchscript', type=str, default='', help='TorchScript model exported by semseg.export, replaces structure')
+    parser.add_argument('--dataset', type=str, default='CamVid', help='mean and palette of the training dataset [ CamVid CityScapes ]')
+    parser.add_argument('--n_classes', type=int, default=0, help='class num, 0 for the dataset class num [ 0 ]')
+    parser.add_argument('--img_size', type=str, default='', help='HxW the images are resized to, the masks keep the image size, empty keeps it')
+    parser.add_argument('--batch_size', type=int, default=4, help='images per forward, halved automatically when out of memory [ 4 ]')
+    parser.add_argument('--workers', type=int, default=4, help='image decoding threads [ 4 ]')
+    parser.add_argument('--queue_size', type=int, default=16, help='max images waiting to be predicted or written [ 16 ]')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 for the torch default [ 0 ]')
+    parser.add_argument('--fuse_bn', type=bool, default=False, help='fold BatchNorm into the convolutions [ False ]')
+    parser.add_argument('--cuda', type=bool, default=False, help='use cuda [ False ]')
+    args = parser.parse_args()
+    print(args)
+    predict(args)
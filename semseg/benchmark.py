@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# 模型推理速度测试：对注册的模型在不同分辨率、batch size和线程数下预热后重复计时，
+# 统计延迟分位数、每秒图像数和峰值内存，结果可保存为json并与之前的结果比较
+# python -m semseg.benchmark --structures ENet,erfnet --resolutions 360x480,512x1024 --output bench.json
+# python -m semseg.benchmark --structures ENet,erfnet --resolutions 360x480,512x1024 --baseline bench.json
+# 比较两个已保存的结果文件，不运行测试
+# python -m semseg.benchmark --results new.json --baseline bench.json
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+
+from semseg.inference import is_oom_error
+from semseg.pytorch_modelsize import current_rss_mb, peak_rss_mb, reset_peak_rss
+
+DEFAULT_RESOLUTIONS = '360x480,512x1024,713x713'
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_forward(model, input_, warmup=3, repeat=10):
+    """Times repeat forward passes of model after warmup passes, returns the latencies in ms"""
+    device = input_.device
+    model.eval()
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            _sync(device)
+            start = time.perf_counter()
+            model(input_)
+            # cuda为异步执行，需要同步后再计时
+            _sync(device)
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def latency_stats(times_ms, batch_size):
+    """Percentiles of the latencies in ms and the images/sec at the mean latency"""
+    times_ms = np.asarray(times_ms, dtype=np.float64)
+    return {
+        'mean_ms': float(times_ms.mean()),
+        'std_ms': float(times_ms.std()),
+        'min_ms': float(times_ms.min()),
+        'p50_ms': float(np.percentile(times_ms, 50)),
+        'p90_ms': float(np.percentile(times_ms, 90)),
+        'p99_ms': float(np.percentile(times_ms, 99)),
+        'img_per_s': float(batch_size * 1000.0 / times_ms.mean()),
+    }
+
+
+def benchmark_model(model, input_size, warmup=3, repeat=10, device=None):
+    """Times model on random input_size, returns the latency stats and the peak memory in MB
+
+    The peak memory is the cuda allocator peak on gpu and the peak RSS growth of
+    this process on cpu.
+    """
+    device = torch.device('cpu') if device is None else device
+    input_ = torch.randn(*input_size, device=device)
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        base_mb = torch.cuda.memory_allocated(device) / 1024.0 ** 2
+    else:
+        base_mb = current_rss_mb()
+        reset_peak_rss()
+    times = time_forward(model, input_, warmup=warmup, repeat=repeat)
+    if device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated(device) / 1024.0 ** 2
+    else:
+        peak_mb = peak_rss_mb()
+    result = latency_stats(times, input_size[0])
+    result['peak_mem_mb'] = max(peak_mb - base_mb, 0.0)
+    result['times_ms'] = [round(t, 3) for t in times]
+    return result
+
+
+def sweep(structures, n_classes, resolutions, batch_sizes, threads, warmup=3, repeat=10, device=None):
+    """Benchmarks every structure for every resolution, batch size and thread count"""
+    from semseg.modelloader import get_model
+    device = torch.device('cpu') if device is None else device
+    default_threads = torch.get_num_threads()
+    results = []
+    for structure in structures:
+        try:
+            model = get_model(structure, n_classes=n_classes).to(device)
+        except Exception as e:
+            print('{}: build failed, {}'.format(structure, e))
+            continue
+        for h, w in resolutions:
+            for batch_size in batch_sizes:
+                for n_threads in threads:
+                    # 0表示使用torch默认的线程数
+                    torch.set_num_threads(n_threads if n_threads > 0 else default_threads)
+                    result = {'structure': structure, 'input_size': [batch_size, 3, h, w],
+                              'threads': torch.get_num_threads(), 'device': str(device)}
+                    try:
+                        result.update(benchmark_model(model, result['input_size'], warmup, repeat, device))
+                    except Exception as e:
+                        # 形状不匹配等错误只记录在该配置的结果中，不中断整个测试
+                        result['error'] = 'out of memory' if is_oom_error(e) else str(e)
+                    print(format_result(result))
+                    results.append(result)
+        del model
+    torch.set_num_threads(default_threads)
+    return results
+
+
+def _key(result):
+    return '{}|{}|{}|{}'.format(result['structure'], 'x'.join(map(str, result['input_size'])),
+                                result['threads'], result['device'])
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def diff_results(results, baseline):
+    """(key, old p50, new p50) of the configurations measured without error in both results"""
+    old_results = dict((_key(r), r) for r in baseline if 'error' not in r)
+    diffs = []
+    for r in results:
+        old = old_results.get(_key(r))
+        if old is not None and 'error' not in r:
+            diffs.append((_key(r), old['p50_ms'], r['p50_ms']))
+    return diffs
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """Returns the configurations whose p50 latency regressed against the baseline"""
+    return [(key, old, new) for key, old, new in diff_results(results, baseline)
+            if new > old * (1 + threshold) and new - old > min_delta_ms]
+
+
+def format_result(r):
+    if 'error' in r:
+        return '{:<20s} {:<18s} {:>3d}  error: {}'.format(
+            r['structure'], 'x'.join(map(str, r['input_size'])), r['threads'], r['error'])
+    return '{:<20s} {:<18s} {:>3d} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f}'.format(
+        r['structure'], 'x'.join(map(str, r['input_size'])), r['threads'], r['p50_ms'], r['p99_ms'],
+        r['mean_ms'], r['img_per_s'], r['peak_mem_mb'])
+
+
+def _parse_size(s):
+    return tuple(int(v) for v in s.split('x'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='latency and throughput of the modelloader models')
+    parser.add_argument('--structures', type=str, default='all', help='comma separated structures [ all ]')
+    parser.add_argument('--n_classes', type=int, default=13, help='class num [ 13 ]')
+    parser.add_argument('--resolutions', type=str, default=DEFAULT_RESOLUTIONS, help='comma separated HxW input sizes [ ' + DEFAULT_RESOLUTIONS + ' ]')
+    parser.add_argument('--batch_sizes', type=str, default='1', help='comma separated batch sizes [ 1 ]')
+    parser.add_argument('--threads', type=str, default='0', help='comma separated cpu thread counts, 0 for the torch default [ 0 ]')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed passes before timing [ 3 ]')
+    parser.add_argument('--repeat', type=int, default=10, help='timed passes [ 10 ]')
+    parser.add_argument('--cuda', type=bool, default=False, help='use cuda [ False ]')
+    parser.add_argument('--output', type=str, default='', help='save the results as json')
+    parser.add_argument('--baseline', type=str, default='', help='json saved by --output to compare against')
+    parser.add_argument('--results', type=str, default='', help='json saved by --output to compare with --baseline instead of running the sweep')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative p50 slowdown [ 0.1 ]')
+    parser.add_argument('--min_delta_ms', type=float, default=1.0, help='ignore slowdowns smaller than this [ 1 ]')
+    args = parser.parse_args()
+
+    if args.results != '':
+        if args.baseline == '':
+            parser.error('--results needs --baseline')
+        results = load_results(args.results)
+    else:
+        from semseg.modelloader import list_models
+        structures = list_models() if args.structures == 'all' else args.structures.split(',')
+        device = torch.device('cuda' if args.cuda else 'cpu')
+
+        print('{:<20s} {:<18s} {:>3s} {:>10s} {:>10s} {:>10s} {:>10s} {:>12s}'.format(
+            'structure', 'input', 'thr', 'p50 ms', 'p99 ms', 'mean ms', 'img/s', 'peak mem MB'))
+        results = sweep(structures, args.n_classes,
+                        [_parse_size(r) for r in args.resolutions.split(',')],
+                        [int(b) for b in args.batch_sizes.split(',')],
+                        [int(t) for t in args.threads.split(',')],
+                        warmup=args.warmup, repeat=args.repeat, device=device)
+
+        if args.output != '':
+            with open(args.output, 'w') as f:
+                json.dump({'torch': torch.__version__, 'results': results}, f, indent=2)
+
+    if args.baseline != '':
+        baseline = load_results(args.baseline)
+        if args.results != '':
+            print('{:<50s} {:>10s} {:>10s} {:>8s}'.format('configuration', 'old p50', 'new p50', 'change'))
+            for key, old, new in diff_results(results, baseline):
+                print('{:<50s} {:>10.2f} {:>10.2f} {:>+7.1f}%'.format(key, old, new, 100.0 * (new - old) / old))
+        regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+        for key, old, new in regressions:
+            print('regression: {} p50 {:.2f} ms -> {:.2f} ms'.format(key, old, new))
+        if regressions:
+            sys.exit(1)
+        print('no regression against {}'.format(args.baseline))
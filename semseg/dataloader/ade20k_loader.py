@@ -5,17 +5,29 @@ import os
 import collections
 import torch
 import scipy.misc as m
-import matplotlib.pyplot as plt
 from PIL import Image
 from torch.utils import data
 import glob
 import numpy as np
 
+from semseg.dataloader.label_cache import LabelCache
+from semseg.dataloader.utils import make_palette, decode_segmap_palette, img_to_tensor
+
+
 class ade20kLoader(data.Dataset):
-    def __init__(self, root, split="training", is_transform=False, img_size=512):
+    # 类别l的颜色为(10 * (l % 10), l, 0)
+    palette = make_palette([[10 * (l % 10), l, 0] for l in range(13)])
+    # encode_segmap的映射版本，修改映射时需要更新以使缓存的标签失效
+    label_map_version = 'ade20k-v1'
+    # load_raw和img_uint8的图像已经减过均值(见resize_img)，打包数据集读取和normalize_batch时减去的均值
+    raw_mean = (0.0, 0.0, 0.0)
+
+    def __init__(self, root, split="training", is_transform=False, img_size=512, label_cache=None, img_uint8=False):
         self.root = root
         self.split = split
         self.is_transform = is_transform
+        # 返回uint8的CHW图像，均值在resize前已减去，训练/校验中按batch只/255(normalize_batch使用raw_mean)
+        self.img_uint8 = img_uint8
         self.img_size = img_size if isinstance(img_size, tuple) else (img_size, img_size)
         self.mean = np.array([104.00699, 116.66877, 122.67892])
         self.n_classes = 13
@@ -30,6 +42,11 @@ class ade20kLoader(data.Dataset):
         # print(len(self.label_files[self.split]))
         assert len(self.image_files[self.split]) == len(self.label_files[self.split])
 
+        # 预处理标签缓存，仅在is_transform时使用
+        if label_cache is not None and not isinstance(label_cache, LabelCache):
+            label_cache = LabelCache(label_cache)
+        self.label_cache = label_cache
+
     def __len__(self):
         return len(self.image_files[self.split])
 
@@ -42,6 +59,13 @@ class ade20kLoader(data.Dataset):
         img = Image.open(img_path)
         img = np.array(img, dtype=np.uint8)
 
+        if self.label_cache is not None and self.is_transform:
+            # 缓存中的标签已经过encode_segmap和resize
+            lbl = self.label_cache.load(lbl_path, self.img_size, self.label_map_version, self.prepare_label)
+            img = img_to_tensor(self.transform_img(img))
+            lbl = torch.from_numpy(lbl).long()
+            return img, lbl
+
         lbl = Image.open(lbl_path)
         lbl = np.array(lbl, dtype=np.int32)
 
@@ -50,26 +74,62 @@ class ade20kLoader(data.Dataset):
 
         return img, lbl
 
+    def prepare_label(self, lbl_path):
+        lbl = Image.open(lbl_path)
+        lbl = np.array(lbl, dtype=np.int32)
+        return self.transform_lbl(lbl)
+
+    def cache_label(self, index):
+        lbl_path = self.label_files[self.split][index]
+        self.label_cache.load(lbl_path, self.img_size, self.label_map_version, self.prepare_label)
+        return self.label_cache.key(lbl_path, self.img_size, self.label_map_version)
+
+    # 读取打包用的uint8图像和uint8标签，图像和transform_img相同，打包后的图像只需要/255(raw_mean为0)
+    def load_raw(self, index):
+        img = np.array(Image.open(self.image_files[self.split][index]), dtype=np.uint8)
+        # 转回RGB顺序，ShardedSegDataset.transform中再转换为BGR
+        img = self.resize_img(img)[:, :, ::-1]
+        lbl_path = self.label_files[self.split][index]
+        if self.label_cache is not None:
+            lbl = self.label_cache.load(lbl_path, self.img_size, self.label_map_version, self.prepare_label)
+        else:
+            lbl = self.prepare_label(lbl_path)
+        return img, np.asarray(lbl, dtype=np.uint8)
+
     # 转换HWC为CHW
     def transform(self, img, lbl):
+        img = self.transform_img(img)
+        lbl = self.transform_lbl(lbl)
+
+        img = img_to_tensor(img)
+        lbl = torch.from_numpy(lbl).long()
+        return img, lbl
+
+    # RGB -> BGR，减均值后resize，imresize把float图像缩放到0~255的uint8
+    def resize_img(self, img):
         img = img[:, :, ::-1]
         img = img.astype(np.float64)
         img -= self.mean
-        img = m.imresize(img, (self.img_size[0], self.img_size[1]))
+        return m.imresize(img, (self.img_size[0], self.img_size[1]))
+
+    def transform_img(self, img):
+        img = self.resize_img(img)
+        if self.img_uint8:
+            # 均值已经减去，normalize_batch(raw_mean)只/255，和float的结果一致
+            return img.transpose(2, 0, 1)
         img = img.astype(float) / 255.0
         # HWC -> CHW
         img = img.transpose(2, 0, 1)
+        return img
 
+    def transform_lbl(self, lbl):
         lbl = self.encode_segmap(lbl)
         lbl = lbl.astype(float)
         lbl = m.imresize(lbl, (self.img_size[0], self.img_size[1]), 'nearest', mode='F')
         lbl = lbl.astype(int)
         # print(img)
         # print(lbl)
-
-        img = torch.from_numpy(img).float()
-        lbl = torch.from_numpy(lbl).long()
-        return img, lbl
+        return lbl
 
     def encode_segmap(self, mask):
         # Refer : http://groups.csail.mit.edu/vision/datasets/ADE20K/code/loadAde20K.m
@@ -78,28 +138,20 @@ class ade20kLoader(data.Dataset):
         label_mask = (mask[:, :, 0] / 10.0) * 256 + mask[:, :, 1]
         return np.array(label_mask, dtype=np.uint8)
 
-    def decode_segmap(self, temp, plot=False):
+    def decode_segmap(self, temp, plot=False, out=None):
         # TODO:(@meetshah1995)
         # Verify that the color mapping is 1-to-1
-        r = temp.copy()
-        g = temp.copy()
-        b = temp.copy()
-        for l in range(0, self.n_classes):
-            r[temp == l] = 10 * (l % 10)
-            g[temp == l] = l
-            b[temp == l] = 0
-
-        rgb = np.zeros((temp.shape[0], temp.shape[1], 3))
-        rgb[:, :, 0] = (r / 255.0)
-        rgb[:, :, 1] = (g / 255.0)
-        rgb[:, :, 2] = (b / 255.0)
+        rgb = decode_segmap_palette(temp, self.palette, out=out)
         if plot:
+            import matplotlib.pyplot as plt
             plt.imshow(rgb)
             plt.show()
         else:
             return rgb
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
     HOME_PATH = os.path.expanduser('~')
     local_path = os.path.join(HOME_PATH, 'Data/ADE20K_2016_07_26')
     dst = ade20kLoader(local_path, is_transform=True)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# 按batch进行的图像/标签联合数据增强：翻转、旋转、缩放和裁剪合并为一个仿射变换，
+# 整个(N, C, H, W)的batch只需要一次grid_sample，标签使用最近邻采样
+import math
+import numbers
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+
+class BatchJointAugment(object):
+    """Random flip, rotation, scale and crop applied to a whole batch at once
+
+    :param flip: random horizontal flip with probability 0.5
+    :param degree: rotation angle is drawn from [-degree, degree]
+    :param scale: (min, max) range of the zoom factor
+    :param crop_size: (h, w) output size, None keeps the input size
+    :param ignore_index: label value for pixels sampled outside the image
+    :param fill: image value for pixels sampled outside the image, a number or one value per channel
+    """
+
+    def __init__(self, flip=True, degree=0, scale=(1.0, 1.0), crop_size=None, ignore_index=250, fill=0):
+        self.flip = flip
+        self.degree = degree
+        self.scale = scale
+        if isinstance(crop_size, numbers.Number):
+            crop_size = (int(crop_size), int(crop_size))
+        self.crop_size = crop_size
+        self.ignore_index = ignore_index
+        self.fill = fill
+
+    def sample_params(self, seeds):
+        """Draws (flip, angle, scale, tx, ty) for every sample from its own seeded generator"""
+        params = torch.empty(len(seeds), 5, dtype=torch.float64)
+        generator = torch.Generator()
+        for i, seed in enumerate(seeds):
+            generator.manual_seed(int(seed))
+            params[i] = torch.rand(5, generator=generator, dtype=torch.float64)
+        flip = (params[:, 0] < 0.5) if self.flip else torch.zeros(len(seeds), dtype=torch.bool)
+        angle = (params[:, 1] * 2 - 1) * math.radians(self.degree)
+        scale = self.scale[0] + params[:, 2] * (self.scale[1] - self.scale[0])
+        # 平移量在[-1, 1]之间，之后按可平移的范围缩放
+        shift = params[:, 3:] * 2 - 1
+        return flip, angle, scale, shift
+
+    def affine_theta(self, flip, angle, scale, shift, in_size, out_size):
+        """Builds the (N, 2, 3) affine_grid matrices mapping output to input coordinates"""
+        h, w = in_size
+        oh, ow = out_size
+        sign = 1.0 - 2.0 * flip.double()
+        cos = torch.cos(angle) / scale
+        sin = torch.sin(angle) / scale
+        # 裁剪窗口可平移的范围（像素），平移取整使不缩放时的裁剪和像素对齐
+        range_x = torch.clamp(w - ow / scale, min=0)
+        range_y = torch.clamp(h - oh / scale, min=0)
+        tx = torch.round((shift[:, 0] + 1) / 2 * range_x) - range_x / 2
+        ty = torch.round((shift[:, 1] + 1) / 2 * range_y) - range_y / 2
+
+        theta = torch.empty(len(flip), 2, 3, dtype=torch.float64)
+        theta[:, 0, 0] = sign * cos * ow / w
+        theta[:, 0, 1] = -sign * sin * oh / w
+        theta[:, 0, 2] = tx * 2 / w
+        theta[:, 1, 0] = sin * ow / h
+        theta[:, 1, 1] = cos * oh / h
+        theta[:, 1, 2] = ty * 2 / h
+        return theta
+
+    def __call__(self, imgs, lbls, seeds=None):
+        """Augments a batch
+
+        :param imgs: (N, C, H, W) float or uint8 images
+        :param lbls: (N, H, W) integer labels
+        :param seeds: one seed per sample, None draws them from the global torch RNG
+            (reproducible with torch.manual_seed and the DataLoader worker seeds)
+        """
+        n, _, h, w = imgs.size()
+        if seeds is None:
+            seeds = torch.randint(0, 2 ** 31 - 1, (n,), dtype=torch.int64).tolist()
+        flip, angle, scale, shift = self.sample_params(seeds)
+
+        out_size = self.crop_size if self.crop_size is not None else (h, w)
+        if self.degree == 0 and self.scale[0] == self.scale[1] == 1.0 and tuple(out_size) == (h, w):
+            # 只有翻转时直接翻转，无需插值
+            if flip.any():
+                imgs = imgs.clone()
+                lbls = lbls.clone()
+                imgs[flip] = imgs[flip].flip(-1)
+                lbls[flip] = lbls[flip].flip(-1)
+            return imgs, lbls
+
+        theta = self.affine_theta(flip, angle, scale, shift, (h, w), out_size)
+        grid = F.affine_grid(theta.float(), (n, 1) + tuple(out_size), align_corners=False).to(imgs.device)
+
+        img_dtype = imgs.dtype
+        # 减去fill后按0补边再加回，图像外的像素即为fill
+        fill = torch.as_tensor(self.fill, dtype=torch.float32, device=imgs.device).reshape(1, -1, 1, 1)
+        imgs = F.grid_sample(imgs.float() - fill, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        imgs += fill
+        if img_dtype == torch.uint8:
+            imgs = imgs.round_().clamp_(0, 255).to(torch.uint8)
+
+        # 标签+1后采样，图像外的0即为ignore_index
+        lbls_shift = (lbls.unsqueeze(1).long() + 1).float()
+        lbls_shift = F.grid_sample(lbls_shift, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+        lbls_shift = lbls_shift.squeeze(1).long()
+        lbls_out = lbls_shift - 1
+        lbls_out[lbls_shift == 0] = self.ignore_index
+        return imgs, lbls_out.to(lbls.dtype)
+
+
+class AugmentCollate(object):
+    """DataLoader collate_fn which collates the samples and augments the whole batch
+
+    trainloader = DataLoader(dst, batch_size=4, collate_fn=AugmentCollate(BatchJointAugment(degree=10)))
+    """
+
+    def __init__(self, augment, collate_fn=default_collate):
+        self.augment = augment
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        imgs, lbls = self.collate_fn(batch)
+        return self.augment(imgs, lbls)
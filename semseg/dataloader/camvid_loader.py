@@ -4,25 +4,44 @@ import os
 import collections
 import random
 
-import cv2
 import numpy as np
-import scipy.misc as m
-import matplotlib.pyplot as plt
 from PIL import Image
 from torch.utils import data
-from torchvision import transforms
 import glob
 
-from semseg.dataloader.utils import Compose, RandomHorizontallyFlip, RandomRotate
+from semseg.dataloader.utils import Compose, RandomHorizontallyFlip, RandomRotate, make_palette, decode_segmap_palette, \
+    img_to_tensor
 
 
 class camvidLoader(data.Dataset):
-    def __init__(self, root, split="train", is_transform=False, is_augment=False):
+    Sky = [128, 128, 128]
+    Building = [128, 0, 0]
+    Pole = [192, 192, 128]
+    Road_marking = [255, 69, 0]
+    Road = [128, 64, 128]
+    Pavement = [60, 40, 222]
+    Tree = [128, 128, 0]
+    SignSymbol = [192, 128, 128]
+    Fence = [64, 64, 128]
+    Car = [64, 0, 128]
+    Pedestrian = [64, 64, 0]
+    Bicyclist = [0, 128, 192]
+    Unlabelled = [0, 0, 0]
+
+    label_colours = np.array([Sky, Building, Pole, Road_marking, Road,
+                              Pavement, Tree, SignSymbol, Fence, Car,
+                              Pedestrian, Bicyclist, Unlabelled])
+    palette = make_palette(label_colours)
+    # BGR均值
+    mean = np.array([104.00699, 116.66877, 122.67892])
+
+    def __init__(self, root, split="train", is_transform=False, is_augment=False, img_uint8=False):
         self.root = root
         self.split = split
         self.img_size = [360, 480]
         self.is_transform = is_transform
-        self.mean = np.array([104.00699, 116.66877, 122.67892])
+        # 返回uint8的CHW图像，减均值和归一化在训练/校验中按batch进行(normalize_batch)
+        self.img_uint8 = img_uint8
         self.n_classes = 13
         self.files = collections.defaultdict(list)
         self.joint_augment_transform = None
@@ -42,13 +61,24 @@ class camvidLoader(data.Dataset):
     def __len__(self):
         return len(self.files[self.split])
 
-    def __getitem__(self, index):
+    def sample_paths(self, index):
         img_name = self.files[self.split][index]
         img_file_name = img_name[img_name.rfind('/')+1:img_name.rfind('.')]
         # img_file_name = img_name[:img_name.rfind('.')]
         # print(img_file_name)
         img_path = self.root + '/' + self.split + '/' + img_file_name + '.png'
         lbl_path = self.root + '/' + self.split + 'annot/' + img_file_name + '.png'
+        return img_path, lbl_path
+
+    # 读取未经transform的uint8 RGB图像和uint8标签，用于打包数据集
+    def load_raw(self, index):
+        img_path, lbl_path = self.sample_paths(index)
+        img = np.array(Image.open(img_path), dtype=np.uint8)
+        lbl = np.array(Image.open(lbl_path), dtype=np.uint8)
+        return img, lbl
+
+    def __getitem__(self, index):
+        img_path, lbl_path = self.sample_paths(index)
 
         img = Image.open(img_path)
         lbl = Image.open(lbl_path)
@@ -95,53 +125,29 @@ class camvidLoader(data.Dataset):
     # 转换HWC为CHW
     def transform(self, img, lbl):
         img = img[:, :, ::-1]
-        img = img.astype(np.float64)
-        img -= self.mean
-        img = img.astype(float) / 255.0
+        if not self.img_uint8:
+            img = img.astype(np.float64)
+            img -= self.mean
+            img = img.astype(float) / 255.0
         # HWC -> CHW
         img = img.transpose(2, 0, 1)
 
-        img = torch.from_numpy(img).float()
+        img = img_to_tensor(img)
         lbl = torch.from_numpy(lbl).long()
         return img, lbl
 
-    def decode_segmap(self, temp, plot=False):
-        Sky = [128, 128, 128]
-        Building = [128, 0, 0]
-        Pole = [192, 192, 128]
-        Road_marking = [255, 69, 0]
-        Road = [128, 64, 128]
-        Pavement = [60, 40, 222]
-        Tree = [128, 128, 0]
-        SignSymbol = [192, 128, 128]
-        Fence = [64, 64, 128]
-        Car = [64, 0, 128]
-        Pedestrian = [64, 64, 0]
-        Bicyclist = [0, 128, 192]
-        Unlabelled = [0, 0, 0]
-
-        label_colours = np.array([Sky, Building, Pole, Road_marking, Road, 
-                                  Pavement, Tree, SignSymbol, Fence, Car, 
-                                  Pedestrian, Bicyclist, Unlabelled])
-        r = temp.copy()
-        g = temp.copy()
-        b = temp.copy()
-        for l in range(0, self.n_classes):
-            r[temp == l] = label_colours[l, 0]
-            g[temp == l] = label_colours[l, 1]
-            b[temp == l] = label_colours[l, 2]
-
-        rgb = np.zeros((temp.shape[0], temp.shape[1], 3))
-        rgb[:, :, 0] = r
-        rgb[:, :, 1] = g
-        rgb[:, :, 2] = b
+    def decode_segmap(self, temp, plot=False, out=None):
+        rgb = decode_segmap_palette(temp, self.palette, out=out)
         if plot:
+            import matplotlib.pyplot as plt
             plt.imshow(rgb)
             plt.show()
         else:
             return rgb
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
     HOME_PATH = os.path.expanduser('~')
     local_path = os.path.join(HOME_PATH, 'Data/CamVid')
     batch_size = 4
@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
 import torch
 import numpy as np
 import scipy.misc as m
 
 from torch.utils import data
-import matplotlib.pyplot as plt
 
-from semseg.dataloader.utils import recursive_glob
+from semseg.dataloader.label_cache import LabelCache
+from semseg.dataloader.utils import recursive_glob, make_label_lut, apply_label_lut, make_palette, \
+    decode_segmap_palette, img_to_tensor
 
 
 class cityscapesLoader(data.Dataset):
@@ -46,6 +48,7 @@ class cityscapesLoader(data.Dataset):
     ]
 
     label_colours = dict(zip(range(19), colors))
+    palette = make_palette(colors)
 
     mean_rgb = {
         "pascal": [103.939, 116.779, 123.68],
@@ -61,6 +64,8 @@ class cityscapesLoader(data.Dataset):
         augmentations=None,
         img_norm=True,
         version="cityscapes",
+        label_cache=None,
+        img_uint8=False,
     ):
         """__init__
 
@@ -69,12 +74,17 @@ class cityscapesLoader(data.Dataset):
         :param is_transform:
         :param img_size:
         :param augmentations 
+        :param label_cache: cache directory or LabelCache for the preprocessed labels,
+            only used with is_transform and without augmentations
+        :param img_uint8: return uint8 CHW BGR images and leave the mean/scale
+            normalization to normalize_batch
         """
         self.root = root
         self.split = split
         self.is_transform = is_transform
         self.augmentations = augmentations
         self.img_norm = img_norm
+        self.img_uint8 = img_uint8
         self.n_classes = 19
         self.img_size = (
             img_size if isinstance(img_size, tuple) else (img_size, img_size)
@@ -136,6 +146,14 @@ class cityscapesLoader(data.Dataset):
 
         self.ignore_index = 250
         self.class_map = dict(zip(self.valid_classes, range(19)))
+        # labelId -> trainId的查找表，encode_segmap一次索引完成映射
+        self.label_lut = make_label_lut(self.class_map, self.void_classes, self.ignore_index)
+        # 映射改变时缓存的标签随之失效
+        self.label_map_version = hashlib.sha1(self.label_lut.tobytes()).hexdigest()[:12]
+
+        if label_cache is not None and not isinstance(label_cache, LabelCache):
+            label_cache = LabelCache(label_cache)
+        self.label_cache = label_cache
 
         if not self.files[split]:
             raise Exception(
@@ -154,11 +172,7 @@ class cityscapesLoader(data.Dataset):
         :param index:
         """
         img_path = self.files[self.split][index].rstrip()
-        lbl_path = os.path.join(
-            self.annotations_base,
-            img_path.split(os.sep)[-2],
-            os.path.basename(img_path)[:-15] + "gtFine_labelIds.png",
-        )
+        lbl_path = self.label_path(img_path)
 
         img = m.imread(img_path)
         img = np.array(img, dtype=np.uint8)
@@ -199,6 +213,12 @@ class cityscapesLoader(data.Dataset):
         #     y2 = object_det_bbox[3]
         #     cv2.rectangle(img, pt1=(x1, y1), pt2=(x2, y2), color=(255, 0, 0), thickness=5)
 
+        if self.label_cache is not None and self.is_transform and self.augmentations is None:
+            # 缓存中的标签已经过encode_segmap和resize
+            lbl = self.label_cache.load(lbl_path, self.img_size, self.label_map_version, self.prepare_label)
+            img = img_to_tensor(self.transform_img(img))
+            lbl = torch.from_numpy(lbl).long()
+            return img, lbl
 
         lbl = m.imread(lbl_path)
         lbl = self.encode_segmap(np.array(lbl, dtype=np.uint8))
@@ -211,16 +231,72 @@ class cityscapesLoader(data.Dataset):
 
         return img, lbl
 
+    def label_path(self, img_path):
+        return os.path.join(
+            self.annotations_base,
+            img_path.split(os.sep)[-2],
+            os.path.basename(img_path)[:-15] + "gtFine_labelIds.png",
+        )
+
+    def prepare_label(self, lbl_path):
+        """prepare_label, reads, encodes and resizes a label to img_size
+
+        :param lbl_path:
+        """
+        lbl = m.imread(lbl_path)
+        lbl = self.encode_segmap(np.array(lbl, dtype=np.uint8))
+        return self.transform_lbl(lbl)
+
+    def cache_label(self, index):
+        """cache_label, fills the label cache for one sample and returns its key
+
+        :param index:
+        """
+        lbl_path = self.label_path(self.files[self.split][index].rstrip())
+        self.label_cache.load(lbl_path, self.img_size, self.label_map_version, self.prepare_label)
+        return self.label_cache.key(lbl_path, self.img_size, self.label_map_version)
+
+    def load_raw(self, index):
+        """load_raw, returns the uint8 RGB image and uint8 label resized to img_size
+
+        :param index:
+        """
+        img_path = self.files[self.split][index].rstrip()
+        lbl_path = self.label_path(img_path)
+        img = m.imread(img_path)
+        img = m.imresize(np.array(img, dtype=np.uint8), (self.img_size[0], self.img_size[1]))
+        if self.label_cache is not None:
+            lbl = self.label_cache.load(lbl_path, self.img_size, self.label_map_version, self.prepare_label)
+        else:
+            lbl = self.prepare_label(lbl_path)
+        return img, np.asarray(lbl, dtype=np.uint8)
+
     def transform(self, img, lbl):
         """transform
 
         :param img:
         :param lbl:
         """
+        img = self.transform_img(img)
+        lbl = self.transform_lbl(lbl)
+
+        img = img_to_tensor(img)
+        lbl = torch.from_numpy(lbl).long()
+
+        return img, lbl
+
+    def transform_img(self, img):
+        """transform_img
+
+        :param img:
+        """
         img = m.imresize(
             img, (self.img_size[0], self.img_size[1])
         )  # uint8 with RGB mode
         img = img[:, :, ::-1]  # RGB -> BGR
+        if self.img_uint8:
+            # NHWC -> NCHW, normalized per batch by normalize_batch
+            return img.transpose(2, 0, 1)
         img = img.astype(np.float64)
         img -= self.mean
         if self.img_norm:
@@ -229,7 +305,13 @@ class cityscapesLoader(data.Dataset):
             img = img.astype(float) / 255.0
         # NHWC -> NCHW
         img = img.transpose(2, 0, 1)
+        return img
 
+    def transform_lbl(self, lbl):
+        """transform_lbl
+
+        :param lbl:
+        """
         classes = np.unique(lbl)
         lbl = lbl.astype(float)
         lbl = m.imresize(lbl, (self.img_size[0], self.img_size[1]), "nearest", mode="F")
@@ -242,36 +324,19 @@ class cityscapesLoader(data.Dataset):
             print("after det", classes, np.unique(lbl))
             raise ValueError("Segmentation map contained invalid class values")
 
-        img = torch.from_numpy(img).float()
-        lbl = torch.from_numpy(lbl).long()
+        return lbl
 
-        return img, lbl
-
-    def decode_segmap(self, temp):
-        r = temp.copy()
-        g = temp.copy()
-        b = temp.copy()
-        for l in range(0, self.n_classes):
-            r[temp == l] = self.label_colours[l][0]
-            g[temp == l] = self.label_colours[l][1]
-            b[temp == l] = self.label_colours[l][2]
-
-        rgb = np.zeros((temp.shape[0], temp.shape[1], 3))
-        rgb[:, :, 0] = r / 255.0
-        rgb[:, :, 1] = g / 255.0
-        rgb[:, :, 2] = b / 255.0
-        return rgb
+    def decode_segmap(self, temp, out=None):
+        return decode_segmap_palette(temp, self.palette, out=out)
 
     def encode_segmap(self, mask):
-        # Put all void classes to zero
-        for _voidc in self.void_classes:
-            mask[mask == _voidc] = self.ignore_index
-        for _validc in self.valid_classes:
-            mask[mask == _validc] = self.class_map[_validc]
-        return mask
+        # void classes -> ignore_index, valid classes -> trainId
+        return apply_label_lut(mask, self.label_lut)
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
     HOME_PATH = os.path.expanduser('~')
     local_path = os.path.join(HOME_PATH, 'Data/cityscapes/')
     dst = cityscapesLoader(local_path, is_transform=True)
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+# 预处理标签缓存：将解码、encode_segmap和resize之后的训练分辨率标签保存为uint8的.npy文件，
+# 第二个epoch开始直接读取缓存，源文件修改后自动失效
+import argparse
+import glob
+import hashlib
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+
+class LabelCache(object):
+    """On-disk cache of preprocessed uint8 label maps
+
+    Entries are keyed by the source label path, its mtime and size, the
+    target img_size and the label mapping version, so a changed source file
+    or mapping simply misses the cache and gets recomputed.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, src_path, img_size, version):
+        st = os.stat(src_path)
+        key_str = '|'.join([os.path.abspath(src_path), str(st.st_mtime_ns), str(st.st_size),
+                            'x'.join(map(str, img_size)), str(version)])
+        return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def load(self, src_path, img_size, version, compute_fn):
+        """Returns the cached label of src_path, computing it with compute_fn(src_path) on a miss"""
+        key = self.key(src_path, img_size, version)
+        path = self.path(key)
+        if os.path.exists(path):
+            try:
+                return np.load(path)
+            except (IOError, OSError, ValueError):
+                # 写入中断等原因导致的损坏缓存，重新计算
+                pass
+        lbl = np.ascontiguousarray(compute_fn(src_path), dtype=np.uint8)
+        self.save(path, lbl)
+        return lbl
+
+    def save(self, path, lbl):
+        cache_subdir = os.path.dirname(path)
+        if not os.path.exists(cache_subdir):
+            try:
+                os.makedirs(cache_subdir)
+            except OSError:
+                # 多个worker同时创建目录
+                pass
+        # 先写临时文件再rename，保证并行写入时不会读到不完整的文件
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=cache_subdir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, lbl)
+        os.replace(tmp_path, path)
+
+    def prune(self, keys):
+        """Removes cache entries whose key is not in keys, returns the number removed"""
+        keys = set(keys)
+        removed = 0
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.npy')):
+            if os.path.basename(path)[:-len('.npy')] not in keys:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+def build_label_cache(dataset, processes=None, prune=False):
+    """Fills dataset.label_cache for every sample using a process pool
+
+    :param dataset: loader created with label_cache, e.g. cityscapesLoader or ade20kLoader
+    :param processes: number of worker processes, None uses all cores
+    :param prune: remove cache entries that do not belong to this dataset (needs one cache_dir per split)
+    """
+    if dataset.label_cache is None:
+        raise ValueError('dataset was created without a label_cache')
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunksize = max(1, len(dataset) // (8 * (processes or multiprocessing.cpu_count())))
+        keys = pool.map(dataset.cache_label, range(len(dataset)), chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    if prune:
+        print('pruned {} stale labels'.format(dataset.label_cache.prune(keys)))
+    return keys
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build the preprocessed label cache')
+    parser.add_argument('--dataset', type=str, default='CityScapes', help='dataset [ CityScapes ADE20K ]')
+    parser.add_argument('--dataset_path', type=str, default='~/Data/cityscapes', help='dataset path [ ~/Data/cityscapes ]')
+    parser.add_argument('--split', type=str, default='train', help='dataset split [ train val ]')
+    parser.add_argument('--cache_dir', type=str, default='~/Data/cityscapes/label_cache', help='cache directory')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes [ cpu count ]')
+    parser.add_argument('--prune', type=bool, default=False, help='remove stale cache entries [ False ]')
+    args = parser.parse_args()
+
+    local_path = os.path.expanduser(args.dataset_path)
+    if args.dataset == 'CityScapes':
+        from semseg.dataloader.cityscapes_loader import cityscapesLoader
+        dst = cityscapesLoader(local_path, split=args.split, is_transform=True, label_cache=args.cache_dir)
+    elif args.dataset == 'ADE20K':
+        from semseg.dataloader.ade20k_loader import ade20kLoader
+        dst = ade20kLoader(local_path, split=args.split, is_transform=True, label_cache=args.cache_dir)
+    else:
+        raise ValueError('label cache is not supported for dataset {}'.format(args.dataset))
+    build_label_cache(dst, processes=args.processes, prune=args.prune)
+    print('cached {} labels in {}'.format(len(dst), args.cache_dir))
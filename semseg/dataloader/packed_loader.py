@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# 打包的数据集格式：将一个split打包成少量大的uint8分片(.npy)和一个索引文件index.json，
+# 读取时通过np.memmap零拷贝访问，无需逐个打开和解码png/jpg文件
+import argparse
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+from torch.utils import data
+
+from semseg.dataloader.utils import make_palette, decode_segmap_palette, img_to_tensor
+
+INDEX_FILE = 'index.json'
+
+
+def pack_dataset(dataset, out_dir, shard_size=1024, processes=None):
+    """Packs a loader split into fixed-size uint8 image/label shards plus an index
+
+    :param dataset: camvidLoader, cityscapesLoader or ade20kLoader, samples are read with dataset.load_raw
+    :param out_dir: output directory, index.json and the shards are written into it
+    :param shard_size: number of samples per shard
+    :param processes: number of worker processes used for decoding, None uses all cores
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    n_samples = len(dataset)
+    if n_samples == 0:
+        raise ValueError('nothing to pack, the dataset is empty')
+    pool = multiprocessing.Pool(processes)
+    shards = []
+    images = labels = None
+    img_shape = None
+    try:
+        # imap保持样本顺序，解码在进程池中并行进行
+        for i, (img, lbl) in enumerate(pool.imap(dataset.load_raw, range(n_samples), chunksize=8)):
+            if img_shape is None:
+                img_shape = img.shape
+            if img.shape != img_shape or lbl.shape != img_shape[:2]:
+                raise ValueError('sample {} has shape {}/{}, expected {}'.format(i, img.shape, lbl.shape, img_shape))
+            shard_id, offset = divmod(i, shard_size)
+            if offset == 0:
+                count = min(shard_size, n_samples - i)
+                shard = {'images': 'images_{:05d}.npy'.format(shard_id),
+                         'labels': 'labels_{:05d}.npy'.format(shard_id),
+                         'count': count}
+                shards.append(shard)
+                images = np.lib.format.open_memmap(os.path.join(out_dir, shard['images']), mode='w+',
+                                                   dtype=np.uint8, shape=(count,) + img_shape)
+                labels = np.lib.format.open_memmap(os.path.join(out_dir, shard['labels']), mode='w+',
+                                                   dtype=np.uint8, shape=(count,) + img_shape[:2])
+            images[offset] = img
+            labels[offset] = lbl
+            if offset == shard['count'] - 1:
+                images.flush()
+                labels.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    index = {
+        'n_classes': dataset.n_classes,
+        'img_size': list(img_shape[:2]),
+        # ade20kLoader.load_raw的图像已经减过均值，读取时不再减
+        'mean': [float(v) for v in getattr(dataset, 'raw_mean', dataset.mean)],
+        'img_norm': bool(getattr(dataset, 'img_norm', True)),
+        'palette': dataset.palette[:dataset.n_classes].tolist(),
+        'shards': shards,
+    }
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+class ShardedSegDataset(data.Dataset):
+    """Dataset reading samples packed by pack_dataset through np.memmap
+
+    Returns the same (img, lbl) pair as the source loader with is_transform=True:
+    img is a float CHW BGR tensor with the mean subtracted (and scaled by 1/255
+    when img_norm), lbl is a long HW tensor.
+    """
+
+    def __init__(self, root, is_transform=True, img_uint8=False):
+        self.root = root
+        self.is_transform = is_transform
+        # 返回uint8的CHW图像，减均值和归一化在训练/校验中按batch进行(normalize_batch)
+        self.img_uint8 = img_uint8
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.n_classes = self.index['n_classes']
+        self.img_size = self.index['img_size']
+        self.mean = np.array(self.index['mean'])
+        self.img_norm = self.index['img_norm']
+        self.palette = make_palette(self.index['palette'])
+
+        counts = [shard['count'] for shard in self.index['shards']]
+        # 每个分片第一个样本的全局下标
+        self.offsets = np.cumsum([0] + counts)
+        # memmap在每个DataLoader worker中首次访问时打开，避免pickle
+        self.shards = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _open_shards(self):
+        self.shards = []
+        for shard in self.index['shards']:
+            images = np.load(os.path.join(self.root, shard['images']), mmap_mode='r')
+            labels = np.load(os.path.join(self.root, shard['labels']), mmap_mode='r')
+            self.shards.append((images, labels))
+
+    def __getstate__(self):
+        # 不pickle打开的memmap（spawn方式的worker会复制整个分片）
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def load_raw(self, index):
+        if self.shards is None:
+            self._open_shards()
+        if index < 0:
+            index += len(self)
+        shard_id = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        images, labels = self.shards[shard_id]
+        offset = index - self.offsets[shard_id]
+        return images[offset], labels[offset]
+
+    def __getitem__(self, index):
+        img, lbl = self.load_raw(index)
+        if self.is_transform:
+            img, lbl = self.transform(img, lbl)
+        return img, lbl
+
+    # 和camvidLoader/cityscapesLoader的transform相同，HWC RGB -> CHW BGR
+    def transform(self, img, lbl):
+        img = img[:, :, ::-1]
+        if not self.img_uint8:
+            img = img.astype(np.float64)
+            img -= self.mean
+            if self.img_norm:
+                img = img / 255.0
+        img = img.transpose(2, 0, 1)
+
+        img = img_to_tensor(img)
+        lbl = torch.from_numpy(lbl.astype(np.int64))
+        return img, lbl
+
+    def decode_segmap(self, temp, plot=False, out=None):
+        rgb = decode_segmap_palette(temp, self.palette, out=out)
+        if plot:
+            import matplotlib.pyplot as plt
+            plt.imshow(rgb)
+            plt.show()
+        else:
+            return rgb
+
+
+# python -m semseg.dataloader.packed_loader --dataset CamVid --dataset_path ~/Data/CamVid --split train --out_dir ~/Data/CamVid_packed/train
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pack a dataset split into memory-mapped shards')
+    parser.add_argument('--dataset', type=str, default='CamVid', help='dataset [ CamVid CityScapes ADE20K ]')
+    parser.add_argument('--dataset_path', type=str, default='~/Data/CamVid', help='dataset path [ ~/Data/CamVid ]')
+    parser.add_argument('--split', type=str, default='train', help='dataset split [ train val ]')
+    parser.add_argument('--out_dir', type=str, default='~/Data/CamVid_packed/train', help='packed output directory')
+    parser.add_argument('--shard_size', type=int, default=1024, help='samples per shard [ 1024 ]')
+    parser.add_argument('--processes', type=int, default=None, help='decoding processes [ cpu count ]')
+    args = parser.parse_args()
+
+    local_path = os.path.expanduser(args.dataset_path)
+    if args.dataset == 'CamVid':
+        from semseg.dataloader.camvid_loader import camvidLoader
+        dst = camvidLoader(local_path, split=args.split)
+    elif args.dataset == 'CityScapes':
+        from semseg.dataloader.cityscapes_loader import cityscapesLoader
+        dst = cityscapesLoader(local_path, split=args.split)
+    elif args.dataset == 'ADE20K':
+        from semseg.dataloader.ade20k_loader import ade20kLoader
+        dst = ade20kLoader(local_path, split=args.split)
+    else:
+        raise ValueError('unknown dataset {}'.format(args.dataset))
+    index = pack_dataset(dst, os.path.expanduser(args.out_dir), shard_size=args.shard_size, processes=args.processes)
+    print('packed {} samples into {} shards'.format(len(dst), len(index['shards'])))
@@ -8,6 +8,8 @@ import random
 from PIL import Image, ImageOps
 import numpy as np
 import os
+import torch
+import torch.nn.functional as F
 
 def recursive_glob(rootdir=".", suffix=""):
     """Performs recursive glob with given suffix and rootdir
@@ -22,6 +24,138 @@ def recursive_glob(rootdir=".", suffix=""):
     ]
 
 
+def make_label_lut(class_map, void_classes=(), ignore_index=250, default=None):
+    """Builds a 256-entry uint8 lookup table remapping raw label ids
+        :param class_map dict of raw label id -> train id
+        :param void_classes raw label ids which are mapped to ignore_index
+        :param ignore_index train id used for void_classes
+        :param default train id for ids not in class_map/void_classes, None keeps the raw id
+    """
+    if default is None:
+        lut = np.arange(256, dtype=np.uint8)
+    else:
+        lut = np.full(256, default, dtype=np.uint8)
+    # 超出uint8范围的id（例如cityscapes中的-1）不会出现在uint8标签图中，直接跳过
+    for label_id in void_classes:
+        if 0 <= label_id < 256:
+            lut[label_id] = ignore_index
+    for label_id, train_id in class_map.items():
+        if 0 <= label_id < 256:
+            lut[label_id] = train_id
+    return lut
+
+
+def apply_label_lut(mask, lut, out=None):
+    """Remaps a uint8 label map through lut in one vectorized indexing pass
+        :param mask uint8 label map of any shape
+        :param lut 256-entry uint8 lookup table, see make_label_lut
+        :param out optional uint8 array with the same shape as mask to write into
+    """
+    mask = np.asarray(mask)
+    if mask.dtype != np.uint8:
+        mask = mask.astype(np.uint8)
+    return np.take(lut, mask, out=out)
+
+
+def img_to_tensor(img):
+    """Converts a CHW image to a tensor, uint8 images stay uint8 (see normalize_batch), others become float
+        :param img CHW numpy image
+    """
+    if img.dtype == np.uint8:
+        return torch.from_numpy(np.ascontiguousarray(img))
+    return torch.from_numpy(img).float()
+
+
+def normalize_batch(imgs, mean, img_norm=True):
+    """Normalizes a uint8 (N, C, H, W) BGR batch returned by the loaders with img_uint8=True
+        :param imgs uint8 image batch, on any device
+        :param mean BGR mean of the loader, e.g. dst.mean
+        :param img_norm divide by 255 after subtracting the mean
+    The mean subtraction and scaling run in float64 before the cast to float32, the same
+    as the loaders' per-sample transform, so the result is numerically identical to it.
+    """
+    mean = torch.as_tensor(np.asarray(mean, dtype=np.float64)).to(imgs.device).view(1, -1, 1, 1)
+    imgs = imgs.double() - mean
+    if img_norm:
+        imgs /= 255.0
+    return imgs.float()
+
+
+class PadCollate(object):
+    """DataLoader collate_fn padding (img, lbl) samples of different sizes into one batch
+
+    Images are padded with 0 and labels with ignore_index at the bottom/right, so the
+    padded pixels are ignored by the loss and the metrics. The padding still changes
+    the context the network sees near the bottom/right borders, so the predictions
+    there can differ from an unpadded forward; batches need no padding only when all
+    images have the same size and it is a multiple of size_divisor.
+        :param ignore_index label value of the padding
+        :param size_divisor the padded height and width are rounded up to a multiple of it
+        :param return_sizes also return the list of unpadded (h, w) of the samples
+    """
+
+    def __init__(self, ignore_index=250, size_divisor=1, return_sizes=False):
+        self.ignore_index = ignore_index
+        self.size_divisor = size_divisor
+        self.return_sizes = return_sizes
+
+    def __call__(self, batch):
+        imgs, lbls = zip(*batch)
+        d = self.size_divisor
+        h = int(math.ceil(max(img.size(-2) for img in imgs) / float(d))) * d
+        w = int(math.ceil(max(img.size(-1) for img in imgs) / float(d))) * d
+        sizes = [tuple(img.size()[-2:]) for img in imgs]
+        if all(size == (h, w) for size in sizes):
+            img_batch, lbl_batch = torch.stack(imgs), torch.stack(lbls)
+        else:
+            img_batch = imgs[0].new_zeros((len(imgs), imgs[0].size(0), h, w))
+            lbl_batch = lbls[0].new_full((len(lbls), h, w), self.ignore_index)
+            for i, (img, lbl) in enumerate(batch):
+                img_batch[i, :, :img.size(-2), :img.size(-1)] = img
+                lbl_batch[i, :lbl.size(-2), :lbl.size(-1)] = lbl
+        if self.return_sizes:
+            return img_batch, lbl_batch, sizes
+        return img_batch, lbl_batch
+
+
+def make_palette(colors, size=256):
+    """Builds a (size, 3) uint8 palette from a list of RGB colors
+        :param colors list of [r, g, b] for class 0 ... n_classes-1
+        :param size number of palette entries, labels without a color (e.g. 250) decode to black
+    """
+    palette = np.zeros((size, 3), dtype=np.uint8)
+    palette[:len(colors)] = np.asarray(colors, dtype=np.uint8)
+    return palette
+
+
+def decode_segmap_palette(label, palette, out=None):
+    """Decodes label maps to uint8 RGB with one gather from the palette
+        :param label (H, W) or (N, H, W) integer label map
+        :param palette (n, 3) uint8 palette, labels >= n are clipped to the last entry
+        :param out optional uint8 array of shape label.shape + (3,) to write into
+    """
+    label = np.asarray(label)
+    return np.take(palette, label, axis=0, mode='clip', out=out)
+
+
+def blend_segmap(img, label, palette, alpha=0.5, out=None):
+    """Blends the decoded label colors onto uint8 images with integer arithmetic
+        :param img (H, W, 3) or (N, H, W, 3) uint8 image
+        :param label (H, W) or (N, H, W) integer label map
+        :param palette (n, 3) uint8 palette
+        :param alpha weight of the label colors
+        :param out optional uint8 array with the same shape as img to write into
+    """
+    weight = int(round(alpha * 256))
+    blend = np.asarray(img, dtype=np.uint16) * (256 - weight)
+    blend += decode_segmap_palette(label, palette).astype(np.uint16) * weight
+    blend >>= 8
+    if out is None:
+        return blend.astype(np.uint8)
+    out[...] = blend
+    return out
+
+
 class Compose(object):
     def __init__(self, transforms):
         self.transforms = transforms
@@ -78,7 +212,6 @@ class CenterCrop(object):
 class RandomHorizontallyFlip(object):
     def __call__(self, img, mask):
         if random.random() < 0.5:
-            print('RandomHorizontallyFlip----FLIP_LEFT_RIGHT')
             return img.transpose(Image.FLIP_LEFT_RIGHT), mask.transpose(Image.FLIP_LEFT_RIGHT)
         return img, mask
 
@@ -151,7 +284,6 @@ class RandomRotate(object):
 
     def __call__(self, img, mask):
         rotate_degree = random.random() * 2 * self.degree - self.degree
-        print('RandomRotate----{}'.format(rotate_degree))
         return img.rotate(rotate_degree, Image.BILINEAR), mask.rotate(rotate_degree, Image.NEAREST)
 
 
@@ -172,49 +304,185 @@ class RandomSized(object):
         return self.crop(*self.scale(img, mask))
 
 
+class SlidingWindowTiler(object):
+    """Cuts images into overlapping crop_size windows and merges window predictions back
+
+    The source is padded once and the windows are strided views (Tensor.unfold) of the
+    padded tensor, only the final stacking copies. Windows lie on a regular grid with
+    stride ceil(crop * stride_rate), so merge is a single F.fold scatter-add.
+
+    With clip_last the last window row/column is shifted back to end at the image border
+    instead of running into the padding (only images smaller than the crop are padded).
+    The grid is then regular except for that row/column, and merge folds the (at most 4)
+    regular blocks separately.
+
+    :param crop_size: window size, int or (h, w)
+    :param stride_rate: window stride relative to crop_size
+    :param ignore_label: value the labels are padded with
+    :param clip_last: keep the last windows inside the image
+    """
+
+    def __init__(self, crop_size, stride_rate=2 / 3., ignore_label=250, clip_last=False):
+        if isinstance(crop_size, numbers.Number):
+            crop_size = (int(crop_size), int(crop_size))
+        self.crop_size = tuple(crop_size)
+        self.stride_rate = stride_rate
+        self.ignore_label = ignore_label
+        self.clip_last = clip_last
+        self.stride = tuple(max(1, int(math.ceil(c * stride_rate))) for c in self.crop_size)
+
+    def grid(self, h, w):
+        """Returns the number of windows (rows, cols) and the padded size (ph, pw) for a h x w image"""
+        (ch, cw), (sh, sw) = self.crop_size, self.stride
+        rows = int(math.ceil(max(h - ch, 0) / float(sh))) + 1
+        cols = int(math.ceil(max(w - cw, 0) / float(sw))) + 1
+        if self.clip_last:
+            return (rows, cols), (max(h, ch), max(w, cw))
+        return (rows, cols), ((rows - 1) * sh + ch, (cols - 1) * sw + cw)
+
+    def starts(self, h, w):
+        """Returns the window row starts and column starts, (rows,) and (cols,) int64 arrays"""
+        (rows, cols), _ = self.grid(h, w)
+        (ch, cw), (sh, sw) = self.crop_size, self.stride
+        sy, sx = np.arange(rows) * sh, np.arange(cols) * sw
+        if self.clip_last:
+            # 最后一个窗口不再超出图像，避免大片的pad区域在最后一个窗口中产生伪影
+            sy[-1], sx[-1] = min(sy[-1], max(h - ch, 0)), min(sx[-1], max(w - cw, 0))
+        return sy.astype(np.int64), sx.astype(np.int64)
+
+    def slices_info(self, h, w):
+        """Returns a (num_windows, 6) int64 array of [sy, ey, sx, ex, sub_h, sub_w] per window
+
+        ey/ex are the window end in the padded image, sub_h/sub_w the part inside the image
+        """
+        (ch, cw) = self.crop_size
+        sy, sx = np.meshgrid(*self.starts(h, w), indexing='ij')
+        sy, sx = sy.ravel(), sx.ravel()
+        return np.stack([sy, sy + ch, sx, sx + cw, np.minimum(sy + ch, h) - sy, np.minimum(sx + cw, w) - sx],
+                        axis=1).astype(np.int64)
+
+    def _blocks(self, starts, stride):
+        # 按行(列)把窗口分成等间隔的块：[(第一个窗口下标, 窗口数)]，clip_last时最后一个窗口单独成块
+        n = len(starts)
+        if n > 1 and starts[-1] != (n - 1) * stride:
+            return [(0, n - 1), (n - 1, 1)]
+        return [(0, n)]
+
+    def window_views(self, x, value=0):
+        """Pads x once and returns its windows as a view
+
+        With clip_last and a shifted last window the windows are gathered from the
+        stride 1 unfold view, which copies them.
+
+        :param x: (..., H, W) tensor
+        :return: (..., rows, cols, h, w) view of the padded tensor
+        """
+        h, w = x.size()[-2:]
+        _, (ph, pw) = self.grid(h, w)
+        if (ph, pw) != (h, w):
+            # 只pad一次，F.pad对2维的标签也适用
+            x = F.pad(x, (0, pw - w, 0, ph - h), value=value)
+        sy, sx = self.starts(h, w)
+        if len(self._blocks(sy, self.stride[0])) == 1 and len(self._blocks(sx, self.stride[1])) == 1:
+            return x.unfold(-2, self.crop_size[0], self.stride[0]).unfold(-2, self.crop_size[1], self.stride[1])
+        views = x.unfold(-2, self.crop_size[0], 1).unfold(-2, self.crop_size[1], 1)
+        views = views.index_select(-4, torch.from_numpy(sy).to(x.device))
+        return views.index_select(-3, torch.from_numpy(sx).to(x.device))
+
+    def tile(self, img, mask=None):
+        """Stacks the windows of img (and mask)
+
+        :param img: (C, H, W) or (N, C, H, W) tensor, or a HWC np.ndarray / PIL image
+        :param mask: (H, W) or (N, H, W) labels, optional
+        :return: img windows (num_windows, C, h, w) (N * num_windows for a batch, image major),
+            mask windows (num_windows, h, w) or None, and slices_info
+        """
+        img = self._to_tensor(img, hwc=True)
+        h, w = img.size()[-2:]
+        views = self.window_views(img, value=0)
+        # (..., C, rows, cols, h, w) -> (... * rows * cols, C, h, w)
+        views = views.movedim(-5, -3)
+        img_windows = views.reshape((-1,) + tuple(views.size()[-3:]))
+        mask_windows = None
+        if mask is not None:
+            mask = self._to_tensor(mask, hwc=False)
+            assert tuple(mask.size()[-2:]) == (h, w)
+            views = self.window_views(mask, value=self.ignore_label)
+            mask_windows = views.reshape((-1,) + tuple(views.size()[-2:]))
+        return img_windows, mask_windows, self.slices_info(h, w)
+
+    __call__ = tile
+
+    def merge(self, windows, size, weight=None):
+        """Scatter-adds window predictions back into full images, averaging the overlaps
+
+        :param windows: (N * num_windows, C, h, w) float tensor, ordered as returned by tile
+        :param size: (H, W) of the source image
+        :param weight: optional (h, w) per-pixel window weight, the overlaps are weighted averages
+        :return: (N, C, H, W) tensor
+        """
+        h, w = size
+        (rows, cols), (ph, pw) = self.grid(h, w)
+        (ch, cw), (sh, sw) = self.crop_size, self.stride
+        c = windows.size(1)
+        if weight is not None:
+            weight = weight.to(device=windows.device, dtype=windows.dtype)
+            windows = windows * weight
+        else:
+            weight = windows.new_ones(self.crop_size)
+        windows = windows.reshape(-1, rows, cols, c * ch * cw)
+        merged = windows.new_zeros((windows.size(0), c, ph, pw))
+        count = windows.new_zeros((1, 1, ph, pw))
+        sy, sx = self.starts(h, w)
+        # 每个等间隔的块用一次fold，fold的输入为(N, C * h * w, L)
+        for r0, n_rows in self._blocks(sy, sh):
+            for c0, n_cols in self._blocks(sx, sw):
+                bh, bw = (n_rows - 1) * sh + ch, (n_cols - 1) * sw + cw
+                block = windows[:, r0:r0 + n_rows, c0:c0 + n_cols].reshape(windows.size(0), -1, c * ch * cw)
+                y, x = int(sy[r0]), int(sx[c0])
+                merged[:, :, y:y + bh, x:x + bw] += F.fold(block.transpose(1, 2), (bh, bw), self.crop_size,
+                                                           stride=self.stride)
+                block_count = weight.reshape(1, -1, 1).expand(1, weight.numel(), n_rows * n_cols)
+                count[:, :, y:y + bh, x:x + bw] += F.fold(block_count.contiguous(), (bh, bw), self.crop_size,
+                                                          stride=self.stride)
+        merged = merged / count
+        return merged[:, :, :h, :w]
+
+    @staticmethod
+    def _to_tensor(x, hwc):
+        if isinstance(x, Image.Image):
+            x = np.array(x)
+        if isinstance(x, np.ndarray):
+            x = torch.from_numpy(np.ascontiguousarray(x))
+            if hwc and x.dim() == 3:
+                # HWC -> CHW的view，不复制
+                x = x.permute(2, 0, 1)
+        return x
+
+
+def _windows_to_pil(img_windows, mask_windows):
+    # 张量窗口转换回PIL图像，保持SlidingCrop/SlidingCropOld原来的返回类型
+    imgs = [Image.fromarray(np.ascontiguousarray(win.permute(1, 2, 0).numpy()).astype(np.uint8)).convert('RGB')
+            for win in img_windows]
+    masks = [Image.fromarray(win.numpy().astype(np.uint8)).convert('P') for win in mask_windows]
+    return imgs, masks
+
+
 class SlidingCropOld(object):
     def __init__(self, crop_size, stride_rate, ignore_label):
         self.crop_size = crop_size
         self.stride_rate = stride_rate
         self.ignore_label = ignore_label
-
-    def _pad(self, img, mask):
-        h, w = img.shape[: 2]
-        pad_h = max(self.crop_size - h, 0)
-        pad_w = max(self.crop_size - w, 0)
-        img = np.pad(img, ((0, pad_h), (0, pad_w), (0, 0)), 'constant')
-        mask = np.pad(mask, ((0, pad_h), (0, pad_w)), 'constant', constant_values=self.ignore_label)
-        return img, mask
+        self.tiler = SlidingWindowTiler(crop_size, stride_rate, ignore_label)
 
     def __call__(self, img, mask):
+        """Returns lists of the PIL image and mask windows, or the padded image and mask when it fits in one window"""
         assert img.size == mask.size
-
-        w, h = img.size
-        long_size = max(h, w)
-
-        img = np.array(img)
-        mask = np.array(mask)
-
-        if long_size > self.crop_size:
-            stride = int(math.ceil(self.crop_size * self.stride_rate))
-            h_step_num = int(math.ceil((h - self.crop_size) / float(stride))) + 1
-            w_step_num = int(math.ceil((w - self.crop_size) / float(stride))) + 1
-            img_sublist, mask_sublist = [], []
-            for yy in xrange(h_step_num):
-                for xx in xrange(w_step_num):
-                    sy, sx = yy * stride, xx * stride
-                    ey, ex = sy + self.crop_size, sx + self.crop_size
-                    img_sub = img[sy: ey, sx: ex, :]
-                    mask_sub = mask[sy: ey, sx: ex]
-                    img_sub, mask_sub = self._pad(img_sub, mask_sub)
-                    img_sublist.append(Image.fromarray(img_sub.astype(np.uint8)).convert('RGB'))
-                    mask_sublist.append(Image.fromarray(mask_sub.astype(np.uint8)).convert('P'))
+        img_windows, mask_windows, _ = self.tiler(img, mask)
+        img_sublist, mask_sublist = _windows_to_pil(img_windows, mask_windows)
+        if max(img.size) > self.crop_size:
             return img_sublist, mask_sublist
-        else:
-            img, mask = self._pad(img, mask)
-            img = Image.fromarray(img.astype(np.uint8)).convert('RGB')
-            mask = Image.fromarray(mask.astype(np.uint8)).convert('P')
-            return img, mask
+        return img_sublist[0], mask_sublist[0]
 
 
 class SlidingCrop(object):
@@ -222,42 +490,15 @@ class SlidingCrop(object):
         self.crop_size = crop_size
         self.stride_rate = stride_rate
         self.ignore_label = ignore_label
-
-    def _pad(self, img, mask):
-        h, w = img.shape[: 2]
-        pad_h = max(self.crop_size - h, 0)
-        pad_w = max(self.crop_size - w, 0)
-        img = np.pad(img, ((0, pad_h), (0, pad_w), (0, 0)), 'constant')
-        mask = np.pad(mask, ((0, pad_h), (0, pad_w)), 'constant', constant_values=self.ignore_label)
-        return img, mask, h, w
+        self.tiler = SlidingWindowTiler(crop_size, stride_rate, ignore_label)
 
     def __call__(self, img, mask):
+        """Returns lists of the PIL image windows, mask windows and [sy, ey, sx, ex, sub_h, sub_w] slices_info"""
         assert img.size == mask.size
-
         w, h = img.size
-        long_size = max(h, w)
-
-        img = np.array(img)
-        mask = np.array(mask)
-
-        if long_size > self.crop_size:
-            stride = int(math.ceil(self.crop_size * self.stride_rate))
-            h_step_num = int(math.ceil((h - self.crop_size) / float(stride))) + 1
-            w_step_num = int(math.ceil((w - self.crop_size) / float(stride))) + 1
-            img_slices, mask_slices, slices_info = [], [], []
-            for yy in xrange(h_step_num):
-                for xx in xrange(w_step_num):
-                    sy, sx = yy * stride, xx * stride
-                    ey, ex = sy + self.crop_size, sx + self.crop_size
-                    img_sub = img[sy: ey, sx: ex, :]
-                    mask_sub = mask[sy: ey, sx: ex]
-                    img_sub, mask_sub, sub_h, sub_w = self._pad(img_sub, mask_sub)
-                    img_slices.append(Image.fromarray(img_sub.astype(np.uint8)).convert('RGB'))
-                    mask_slices.append(Image.fromarray(mask_sub.astype(np.uint8)).convert('P'))
-                    slices_info.append([sy, ey, sx, ex, sub_h, sub_w])
-            return img_slices, mask_slices, slices_info
-        else:
-            img, mask, sub_h, sub_w = self._pad(img, mask)
-            img = Image.fromarray(img.astype(np.uint8)).convert('RGB')
-            mask = Image.fromarray(mask.astype(np.uint8)).convert('P')
-            return [img], [mask], [[0, sub_h, 0, sub_w, sub_h, sub_w]]
+        img_windows, mask_windows, slices_info = self.tiler(img, mask)
+        img_slices, mask_slices = _windows_to_pil(img_windows, mask_windows)
+        if max(h, w) > self.crop_size:
+            return img_slices, mask_slices, slices_info.tolist()
+        # 图像不大于窗口时窗口的结束位置为图像大小
+        return img_slices, mask_slices, [[0, h, 0, w, h, w]]
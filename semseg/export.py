@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# 模型导出：把注册的模型在给定的输入大小下trace(或script)为TorchScript，并导出ONNX，
+# 导出后和eager模式的输出对比(最大误差和argmax像素一致率)，再测试导出模型的推理速度；
+# trace得到的图中输入大小是常量，服务端需要按导出时的分辨率输入
+# python -m semseg.export --structure ENet --model_state_dict ENet_camvid_class_13_100.pt --resolution 360x480
+import argparse
+import contextlib
+import inspect
+import os
+import sys
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from semseg.benchmark import latency_stats, time_forward
+from semseg.inference import model_output
+
+FORMATS = ['torchscript', 'onnx']
+
+
+class ExportWrapper(nn.Module):
+    """Calls model with its default keyword arguments and returns the main score map
+
+    forward(input, only_encode=False) style flags stay python constants and
+    auxiliary outputs are dropped, the exported graph has one input and one output.
+    """
+
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return model_output(self.model(x))
+
+
+@contextlib.contextmanager
+def _traceable_unpool():
+    # trace时input.size()返回张量，新版pytorch中max_unpool2d对输出大小的检查要求bool，
+    # 导出期间跳过对张量的检查，导出的图中大小是常量
+    check = getattr(F, '_check_unpool_output_size', None)
+    if check is None:
+        yield
+        return
+
+    def _check(output_size, dim):
+        if not torch.is_tensor(output_size[dim]):
+            check(output_size, dim)
+
+    F._check_unpool_output_size = _check
+    try:
+        yield
+    finally:
+        F._check_unpool_output_size = check
+
+
+def export_torchscript(model, example, method='trace', freeze=True):
+    """TorchScript module of the eval-mode model
+
+    :param method: trace (at the size of example) or script
+    :param freeze: inline the parameters and fold conv+bn with torch.jit.freeze
+    """
+    wrapper = ExportWrapper(model).eval()
+    with torch.no_grad(), _traceable_unpool():
+        if method == 'script':
+            module = torch.jit.script(wrapper)
+        elif method == 'trace':
+            module = torch.jit.trace(wrapper, example, check_trace=False)
+        else:
+            raise ValueError('unknown export method {}'.format(method))
+    return torch.jit.freeze(module) if freeze else module
+
+
+def export_onnx(model, example, path, opset_version=13, dynamic_batch=False):
+    """Exports model traced at example to path with the TorchScript based ONNX exporter"""
+    wrapper = ExportWrapper(model).eval()
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # dynamo导出器需要onnxscript，且不支持本仓库模型中的python控制流
+        kwargs['dynamo'] = False
+    if dynamic_batch:
+        kwargs['dynamic_axes'] = {'input': {0: 'batch'}, 'output': {0: 'batch'}}
+    with torch.no_grad(), _traceable_unpool():
+        torch.onnx.export(wrapper, (example,), path, input_names=['input'], output_names=['output'],
+                          opset_version=opset_version, do_constant_folding=True, **kwargs)
+    return path
+
+
+def onnx_session(path, threads=0):
+    """onnxruntime cpu session of path, None when onnxruntime is not installed"""
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    options = onnxruntime.SessionOptions()
+    if threads > 0:
+        options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+class OnnxRunner(object):
+    """Makes an onnxruntime session callable on torch tensors like the eager model"""
+
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        out = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})
+        return torch.from_numpy(out[0])
+
+
+def parity(reference, exported, inputs, rtol=1e-3):
+    """Compares exported to the eager reference on inputs
+
+    Returns (ok, max abs diff, argmax pixel agreement); ok when the max
+    difference is within rtol of the output scale (at least 1).
+    """
+    diff, agreement, ok = 0.0, 1.0, True
+    with torch.no_grad():
+        for x in inputs:
+            ref = model_output(reference(x.clone())).float()
+            out = model_output(exported(x.clone())).float().to(ref.device)
+            d = (out - ref).abs().max().item()
+            ok = ok and d <= rtol * max(ref.abs().max().item(), 1.0)
+            diff = max(diff, d)
+            agreement = min(agreement, (out.max(1)[1] == ref.max(1)[1]).float().mean().item())
+    return ok, diff, agreement
+
+
+def export_model(model, input_size, output_prefix, formats=('torchscript', 'onnx'), method='trace',
+                 opset_version=13, dynamic_batch=False, rtol=1e-3, n_checks=2, warmup=3, repeat=10, threads=0):
+    """Exports model to output_prefix.pt / .onnx, checks the parity and times eager and exported
+
+    Returns one result dict per format (plus eager) with the path, the parity
+    and the latency stats, or the error of a failed export.
+    """
+    model.eval()
+    example = torch.randn(*input_size)
+    # 随机输入用于对比，第一个即trace时的输入
+    inputs = [example] + [torch.randn(*input_size) for _ in range(n_checks - 1)]
+    eager = {'format': 'eager', 'path': ''}
+    eager.update(latency_stats(time_forward(model, example, warmup, repeat), input_size[0]))
+    results = [eager]
+    for fmt in formats:
+        result = {'format': fmt}
+        try:
+            if fmt == 'torchscript':
+                result['path'] = output_prefix + '.pt'
+                exported = export_torchscript(model, example, method)
+                torch.jit.save(exported, result['path'])
+                # 重新加载保存的文件，确认文件本身可用
+                exported = torch.jit.load(result['path'])
+            elif fmt == 'onnx':
+                result['path'] = export_onnx(model, example, output_prefix + '.onnx', opset_version, dynamic_batch)
+                session = onnx_session(result['path'], threads)
+                if session is None:
+                    result['skipped'] = 'onnxruntime is not installed, parity and latency not checked'
+                    results.append(result)
+                    continue
+                exported = OnnxRunner(session)
+            else:
+                raise ValueError('unknown format {}'.format(fmt))
+        except Exception as e:
+            lines = [l.strip() for l in str(e).split('\n') if l.strip() != '']
+            result['error'] = '{}: {}'.format(type(e).__name__, lines[0] if lines else '')
+            results.append(result)
+            continue
+        result['parity'], result['max_abs_diff'], result['agreement'] = parity(model, exported, inputs, rtol)
+        result.update(latency_stats(time_forward(exported, example, warmup, repeat), input_size[0]))
+        result['speedup'] = eager['p50_ms'] / result['p50_ms']
+        results.append(result)
+    return results
+
+
+def format_result(r):
+    if 'error' in r or 'skipped' in r:
+        return '{:<12s} {}'.format(r['format'], r.get('error', r.get('skipped')))
+    if r['format'] == 'eager':
+        return '{:<12s} {:>8s} {:>10s} {:>9s} {:>10.2f} {:>10.2f} {:>8s}'.format(
+            'eager', '', '', '', r['p50_ms'], r['img_per_s'], '')
+    return '{:<12s} {:>8s} {:>10.2e} {:>9.4f} {:>10.2f} {:>10.2f} {:>7.2f}x  {}'.format(
+        r['format'], 'ok' if r['parity'] else 'FAIL', r['max_abs_diff'], r['agreement'], r['p50_ms'],
+        r['img_per_s'], r['speedup'], r['path'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a modelloader model to TorchScript and ONNX')
+    parser.add_argument('--structure', type=str, default='ENet', help='use the net structure to segment [ ENet ]')
+    parser.add_argument('--n_classes', type=int, default=13, help='class num [ 13 ]')
+    parser.add_argument('--model_state_dict', type=str, default='', help='trained state dict [ ENet_camvid_class_13_100.pt ]')
+    parser.add_argument('--resolution', type=str, default='360x480', help='HxW input size of the exported graph [ 360x480 ]')
+    parser.add_argument('--batch_size', type=int, default=1, help='input batch size [ 1 ]')
+    parser.add_argument('--formats', type=str, default=','.join(FORMATS), help='comma separated formats [ ' + ' '.join(FORMATS) + ' ]')
+    parser.add_argument('--method', type=str, default='trace', help='TorchScript by [ trace script ]')
+    parser.add_argument('--opset', type=int, default=13, help='ONNX opset version [ 13 ]')
+    parser.add_argument('--dynamic_batch', type=bool, default=False, help='ONNX batch dimension is dynamic [ False ]')
+    parser.add_argument('--output_dir', type=str, default='.', help='directory of the exported files [ . ]')
+    parser.add_argument('--rtol', type=float, default=1e-3, help='allowed max diff relative to the output scale [ 1e-3 ]')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed passes before timing [ 3 ]')
+    parser.add_argument('--repeat', type=int, default=10, help='timed passes [ 10 ]')
+    parser.add_argument('--threads', type=int, default=0, help='cpu threads, 0 for the torch default [ 0 ]')
+    args = parser.parse_args()
+
+    from semseg.modelloader import get_model
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    model = get_model(args.structure, n_classes=args.n_classes)
+    if args.model_state_dict != '':
+        model.load_state_dict(torch.load(args.model_state_dict, map_location='cpu'))
+    h, w = [int(v) for v in args.resolution.split('x')]
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    prefix = os.path.join(args.output_dir, '{}_{}x{}'.format(args.structure, h, w))
+
+    results = export_model(model, (args.batch_size, 3, h, w), prefix, formats=args.formats.split(','),
+                           method=args.method, opset_version=args.opset, dynamic_batch=args.dynamic_batch,
+                           rtol=args.rtol, warmup=args.warmup, repeat=args.repeat, threads=args.threads)
+    print('{:<12s} {:>8s} {:>10s} {:>9s} {:>10s} {:>10s} {:>8s}'.format(
+        'format', 'parity', 'max diff', 'agree', 'p50 ms', 'img/s', 'speedup'))
+    for r in results:
+        print(format_result(r))
+    # 导出失败或输出不一致时返回1
+    if any('error' in r or not r.get('parity', True) for r in results):
+        sys.exit(1)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# 按层统计模型的MACs(乘加次数)和FLOPs：用forward hook统计各个层，并临时替换F.interpolate、
+# F.avg_pool2d和F.max_pool2d以统计模型中函数式调用的上采样和池化
+# python -m semseg.flops_counter --structures ENet,erfnet,sqnet,drn_d_22 --resolution 360x480
+import argparse
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _pair(v):
+    return tuple(v) if isinstance(v, (tuple, list)) else (v, v)
+
+
+def _kernel_numel(kernel_size):
+    # Conv1d/2d/3d的kernel_size分别为1、2、3个元素的tuple
+    return int(np.prod(kernel_size))
+
+
+def _numel(t):
+    return int(np.prod(t.size()))
+
+
+def _first(x):
+    return x[0] if isinstance(x, (tuple, list)) else x
+
+
+def _conv(m, inputs, output):
+    # 空洞卷积的计算量和普通卷积相同，分组卷积每个输出只和in_channels/groups个输入通道相关
+    macs = _numel(output) * (m.in_channels // m.groups) * _kernel_numel(m.kernel_size)
+    flops = 2 * macs + (_numel(output) if m.bias is not None else 0)
+    return macs, flops
+
+
+def _conv_transpose(m, inputs, output):
+    # 每个输入元素和out_channels/groups个卷积核相乘
+    macs = _numel(inputs[0]) * (m.out_channels // m.groups) * _kernel_numel(m.kernel_size)
+    flops = 2 * macs + (_numel(output) if m.bias is not None else 0)
+    return macs, flops
+
+
+def _linear(m, inputs, output):
+    macs = _numel(output) * m.in_features
+    return macs, 2 * macs + (_numel(output) if m.bias is not None else 0)
+
+
+def _batch_norm(m, inputs, output):
+    # 推理时为每个元素一次乘加
+    n = _numel(output)
+    return n, 2 * n
+
+
+def _elementwise(m, inputs, output):
+    return 0, _numel(_first(output))
+
+
+def _pool(m, inputs, output):
+    kh, kw = _pair(m.kernel_size)
+    return 0, _numel(_first(output)) * kh * kw
+
+
+def _adaptive_pool(m, inputs, output):
+    return 0, _numel(inputs[0])
+
+
+def _unpool(m, inputs, output):
+    # 按indices把每个输入元素写回输出
+    return 0, _numel(inputs[0])
+
+
+def _upsample(m, inputs, output):
+    return _interpolate_cost(m.mode, output)
+
+
+def _zero(m, inputs, output):
+    return 0, 0
+
+
+def _interpolate_cost(mode, output):
+    n = _numel(output)
+    if mode in ('bilinear', 'linear'):
+        # 每个输出元素由4个输入加权得到
+        return 4 * n, 8 * n
+    if mode == 'bicubic':
+        return 16 * n, 32 * n
+    return 0, 0
+
+
+MODULE_COUNTERS = {
+    nn.Conv1d: _conv,
+    nn.Conv2d: _conv,
+    nn.Conv3d: _conv,
+    nn.ConvTranspose2d: _conv_transpose,
+    nn.Linear: _linear,
+    nn.BatchNorm1d: _batch_norm,
+    nn.BatchNorm2d: _batch_norm,
+    nn.InstanceNorm2d: _batch_norm,
+    nn.ReLU: _elementwise,
+    nn.ReLU6: _elementwise,
+    nn.PReLU: _elementwise,
+    nn.ELU: _elementwise,
+    nn.LeakyReLU: _elementwise,
+    nn.Sigmoid: _elementwise,
+    nn.Softmax: _elementwise,
+    nn.MaxPool2d: _pool,
+    nn.AvgPool2d: _pool,
+    nn.AdaptiveAvgPool2d: _adaptive_pool,
+    nn.AdaptiveMaxPool2d: _adaptive_pool,
+    nn.MaxUnpool2d: _unpool,
+    nn.Upsample: _upsample,
+    nn.UpsamplingBilinear2d: _upsample,
+    nn.UpsamplingNearest2d: _upsample,
+    nn.PixelShuffle: _zero,
+    nn.Dropout: _zero,
+    nn.Dropout2d: _zero,
+}
+
+
+class FlopsCounter(object):
+    """Analytic MACs/FLOPs of a model for one input size
+
+    counter = FlopsCounter(model)
+    macs, flops = counter.count((1, 3, 360, 480))
+    print(counter.table())
+
+    Multiply-accumulates count as 1 MAC and 2 FLOPs. Element-wise activations,
+    pooling comparisons and unpooling writes count as FLOPs only, pixel shuffle
+    and dropout are free at inference.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.layers = []
+
+    def _record(self, name, module_type, output, macs, flops, params=0):
+        self.layers.append({
+            'name': name,
+            'type': module_type,
+            'output_size': list(_first(output).size()),
+            'macs': int(macs),
+            'flops': int(flops),
+            'params': int(params),
+        })
+
+    def _patch_functional(self, stack):
+        """Wraps F.interpolate/avg_pool2d/max_pool2d, calls made inside counted modules are skipped"""
+        originals = {}
+
+        def _inside_counted():
+            return len(stack) > 0 and type(stack[-1][1]) in MODULE_COUNTERS
+
+        def _owner():
+            # 模型forward中直接调用的函数记在(root)下
+            return stack[-1][0] if stack and stack[-1][0] != '' else '(root)'
+
+        def interpolate(input, size=None, scale_factor=None, mode='nearest', *args, **kwargs):
+            out = originals['interpolate'](input, size, scale_factor, mode, *args, **kwargs)
+            if not _inside_counted():
+                macs, flops = _interpolate_cost(mode, out)
+                self._record(_owner() + '.interpolate', 'interpolate_' + mode, out, macs, flops)
+            return out
+
+        def _functional_pool(fname):
+            def pool(input, kernel_size, *args, **kwargs):
+                out = originals[fname](input, kernel_size, *args, **kwargs)
+                if not _inside_counted():
+                    kh, kw = _pair(kernel_size)
+                    self._record(_owner() + '.' + fname, fname, out, 0, _numel(_first(out)) * kh * kw)
+                return out
+            return pool
+
+        for fname, fn in [('interpolate', interpolate), ('avg_pool2d', _functional_pool('avg_pool2d')),
+                          ('max_pool2d', _functional_pool('max_pool2d'))]:
+            originals[fname] = getattr(F, fname)
+            setattr(F, fname, fn)
+        return originals
+
+    def count(self, input_size):
+        """Runs one forward with zeros of input_size, returns the total (macs, flops)"""
+        self.layers = []
+        stack = []
+        handles = []
+
+        def pre_hook(name):
+            def hook(module, inputs):
+                stack.append((name, module))
+            return hook
+
+        def post_hook(name):
+            def hook(module, inputs, output):
+                stack.pop()
+                counter = MODULE_COUNTERS.get(type(module))
+                if counter is not None:
+                    macs, flops = counter(module, inputs, output)
+                    params = sum(p.numel() for p in module.parameters(recurse=False))
+                    self._record(name, type(module).__name__, output, macs, flops, params)
+            return hook
+
+        for name, m in self.model.named_modules():
+            handles.append(m.register_forward_pre_hook(pre_hook(name)))
+            handles.append(m.register_forward_hook(post_hook(name)))
+
+        param = next(self.model.parameters(), None)
+        device = param.device if param is not None else torch.device('cpu')
+        training = self.model.training
+        self.model.eval()
+        originals = self._patch_functional(stack)
+        try:
+            with torch.no_grad():
+                self.model(torch.zeros(*input_size, device=device))
+        finally:
+            for fname, fn in originals.items():
+                setattr(F, fname, fn)
+            self.model.train(training)
+            for handle in handles:
+                handle.remove()
+        return self.total()
+
+    def total(self):
+        return sum(l['macs'] for l in self.layers), sum(l['flops'] for l in self.layers)
+
+    def blocks(self):
+        """MACs/FLOPs summed per top-level child module, in execution order"""
+        blocks = {}
+        for layer in self.layers:
+            block = layer['name'].split('.')[0]
+            if block not in blocks:
+                blocks[block] = {'macs': 0, 'flops': 0, 'params': 0}
+            for k in ('macs', 'flops', 'params'):
+                blocks[block][k] += layer[k]
+        return blocks
+
+    def table(self, per_layer=True):
+        total_macs, total_flops = self.total()
+        lines = []
+        if per_layer:
+            lines.append('{:<50s} {:<22s} {:<20s} {:>10s} {:>10s}'.format('layer', 'type', 'output', 'MMACs', 'MFLOPs'))
+            for l in self.layers:
+                lines.append('{:<50s} {:<22s} {:<20s} {:>10.2f} {:>10.2f}'.format(
+                    l['name'][-50:], l['type'][:22], 'x'.join(map(str, l['output_size']))[:20],
+                    l['macs'] / 1e6, l['flops'] / 1e6))
+        lines.append('{:<30s} {:>10s} {:>10s} {:>8s}'.format('block', 'GMACs', 'GFLOPs', 'share'))
+        for block, v in self.blocks().items():
+            lines.append('{:<30s} {:>10.3f} {:>10.3f} {:>7.1f}%'.format(
+                block[:30], v['macs'] / 1e9, v['flops'] / 1e9, 100.0 * v['macs'] / max(total_macs, 1)))
+        lines.append('total {:.3f} GMACs, {:.3f} GFLOPs'.format(total_macs / 1e9, total_flops / 1e9))
+        return '\n'.join(lines)
+
+
+def count_model(structure, n_classes, input_size):
+    """Counts a registered structure, returns the FlopsCounter"""
+    from semseg.modelloader import get_model
+    counter = FlopsCounter(get_model(structure, n_classes=n_classes))
+    counter.count(input_size)
+    return counter
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='count the MACs/FLOPs of the modelloader models')
+    parser.add_argument('--structures', type=str, default='all', help='comma separated structures [ all ]')
+    parser.add_argument('--n_classes', type=int, default=13, help='class num [ 13 ]')
+    parser.add_argument('--resolution', type=str, default='360x480', help='HxW input size [ 360x480 ]')
+    parser.add_argument('--batch_size', type=int, default=1, help='input batch size [ 1 ]')
+    parser.add_argument('--per_layer', type=bool, default=False, help='print the per-layer table [ False ]')
+    parser.add_argument('--output', type=str, default='', help='save the results as json')
+    args = parser.parse_args()
+
+    from semseg.modelloader import list_models
+    structures = list_models() if args.structures == 'all' else args.structures.split(',')
+    h, w = [int(v) for v in args.resolution.split('x')]
+    input_size = (args.batch_size, 3, h, w)
+
+    results = []
+    for structure in structures:
+        try:
+            counter = count_model(structure, args.n_classes, input_size)
+        except Exception as e:
+            print('{}: failed, {}'.format(structure, e))
+            continue
+        macs, flops = counter.total()
+        print('----', structure, input_size)
+        print(counter.table(per_layer=args.per_layer))
+        results.append({'structure': structure, 'input_size': list(input_size), 'macs': macs, 'flops': flops,
+                        'params': sum(p.numel() for p in counter.model.parameters()),
+                        'blocks': counter.blocks(), 'layers': counter.layers})
+
+    # 按计算量排序
+    print('{:<20s} {:>10s} {:>10s} {:>10s}'.format('structure', 'GMACs', 'GFLOPs', 'Mparams'))
+    for r in sorted(results, key=lambda r: r['macs']):
+        print('{:<20s} {:>10.3f} {:>10.3f} {:>10.2f}'.format(r['structure'], r['macs'] / 1e9, r['flops'] / 1e9,
+                                                          r['params'] / 1e6))
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
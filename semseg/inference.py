@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# 与模型无关的滑窗推理：把大图切成重叠的窗口，每次forward处理一批窗口（包括翻转），
+# 在float32的torch缓冲区中按权重累加logits，适用于全分辨率的Cityscapes评估；
+# 以及多尺度+翻转的测试时增强(TTA)，各尺度依次处理并累加到同一个缓冲区
+import torch
+import torch.nn.functional as F
+
+from semseg.dataloader.utils import SlidingWindowTiler
+
+
+def model_output(out):
+    """Main score map of a model output
+
+    Models with auxiliary outputs return the main score map first, MS_Deeplab
+    returns only its fused map in eval mode.
+    """
+    if isinstance(out, (tuple, list)):
+        out = out[0]
+    return out
+
+
+def blend_weight(crop_size, mode='mean', sigma_scale=0.125):
+    """Returns the (h, w) float32 weight of one window
+
+    :param mode: mean (uniform), gaussian (centered, sigma = crop * sigma_scale) or linear (tent)
+    """
+    h, w = crop_size
+    if mode == 'mean':
+        return torch.ones(h, w)
+    if mode == 'gaussian':
+        def _axis(n):
+            x = torch.arange(n, dtype=torch.float32) - (n - 1) / 2.0
+            return torch.exp(-0.5 * (x / max(n * sigma_scale, 1e-3)) ** 2)
+    elif mode == 'linear':
+        def _axis(n):
+            x = (torch.arange(n, dtype=torch.float32) + 0.5) / n
+            return 1.0 - torch.abs(2.0 * x - 1.0)
+    else:
+        raise ValueError('unknown blend mode {}'.format(mode))
+    weight = _axis(h)[:, None] * _axis(w)[None, :]
+    weight = weight / weight.max()
+    # 窗口边缘的权重不能为0，否则只被一个窗口覆盖的像素无法归一化
+    return weight.clamp_(min=1e-3)
+
+
+class SlidingWindowPredictor(object):
+    """Tiled inference for any modelloader network
+
+    predictor = SlidingWindowPredictor(model, n_classes=19, crop_size=(713, 713), flip=True)
+    logits = predictor(imgs)  # (N, n_classes, H, W) float32
+
+    :param model: network mapping (B, C, h, w) to (B, n_classes, h', w') scores
+    :param n_classes: number of output channels
+    :param crop_size: window size, int or (h, w)
+    :param stride_rate: window stride relative to crop_size
+    :param flip: also predict the horizontally flipped windows and average
+    :param blend: window weight, mean, gaussian or linear
+    :param tile_batch_size: maximum number of windows (flipped copies included) per forward
+    :param prob: accumulate softmax probabilities instead of logits
+    """
+
+    def __init__(self, model, n_classes, crop_size, stride_rate=2 / 3., flip=False, blend='mean',
+                 tile_batch_size=8, prob=False):
+        self.model = model
+        self.n_classes = n_classes
+        # 最后一行/列窗口移回图像内，只有小于窗口的图像才pad
+        self.tiler = SlidingWindowTiler(crop_size, stride_rate, clip_last=True)
+        self.crop_size = self.tiler.crop_size
+        self.flip = flip
+        self.weight = blend_weight(self.crop_size, blend)
+        self.tile_batch_size = max(1, int(tile_batch_size))
+        self.prob = prob
+
+    def forward_windows(self, windows):
+        """Runs the model on a (B, C, h, w) stack of windows, flipped copies in the same batch"""
+        n = windows.size(0)
+        if self.flip:
+            windows = torch.cat([windows, windows.flip(3)])
+        out = model_output(self.model(windows))
+        if tuple(out.size()[2:]) != self.crop_size:
+            out = F.interpolate(out, size=self.crop_size, mode='bilinear', align_corners=False)
+        out = out.float()
+        if self.prob:
+            out = F.softmax(out, dim=1)
+        if self.flip:
+            out = (out[:n] + out[n:].flip(3)) / 2.0
+        return out
+
+    def predict(self, imgs):
+        """Returns the (N, n_classes, H, W) float32 scores of a (N, C, H, W) batch
+
+        Windows of consecutive images share forwards, every image is merged as soon
+        as all its windows are predicted, so only about one image's window outputs are kept.
+        """
+        n, _, h, w = imgs.size()
+        # 按图像顺序排列的(N * num_windows, C, h, w)窗口
+        windows, _, _ = self.tiler.tile(imgs)
+        n_windows = windows.size(0) // n
+        per_forward = self.tile_batch_size // 2 if self.flip else self.tile_batch_size
+        per_forward = max(1, per_forward)
+
+        scores = []
+        pending = None
+        with torch.no_grad():
+            for k in range(0, windows.size(0), per_forward):
+                out = self.forward_windows(windows[k:k + per_forward])
+                pending = out if pending is None else torch.cat([pending, out])
+                while pending is not None and pending.size(0) >= n_windows:
+                    # 一张图像的窗口都已预测，用F.fold按权重累加
+                    scores.append(self.tiler.merge(pending[:n_windows], (h, w), self.weight))
+                    pending = pending[n_windows:] if pending.size(0) > n_windows else None
+        return torch.cat(scores)
+
+    __call__ = predict
+
+
+
+class MultiScalePredictor(object):
+    """Multi-scale and flip test-time augmentation for any model
+
+    The input is resized to every scale, predicted (and flipped), resized back and
+    accumulated into one running (N, n_classes, H, W) buffer, scales are processed
+    one at a time so the peak memory is that of the largest scale.
+
+    tta = MultiScalePredictor(model, n_classes=19, scales=(0.75, 1.0, 1.25), flip=True)
+    prob = tta(imgs)
+
+    :param model: network or predictor (e.g. SlidingWindowPredictor with prob=False) mapping
+        (N, C, h, w) to (N, n_classes, h', w') scores
+    :param scales: resize factors of the input
+    :param flip: also predict the horizontally flipped input
+    :param prob: fuse softmax probabilities instead of logits
+    :param fusion: mean or max over the augmented predictions
+    :param flip_in_batch: run the flipped copy in the same forward, faster but doubles the activations
+    """
+
+    def __init__(self, model, n_classes, scales=(1.0,), flip=False, prob=True, fusion='mean', flip_in_batch=False):
+        if fusion not in ('mean', 'max'):
+            raise ValueError('unknown fusion {}'.format(fusion))
+        self.model = model
+        self.n_classes = n_classes
+        self.scales = tuple(scales)
+        self.flip = flip
+        self.prob = prob
+        self.fusion = fusion
+        self.flip_in_batch = flip_in_batch
+
+    def forward_scale(self, x):
+        """Yields the predictions of x and, with flip, of its flipped copy (flipped back)"""
+        if self.flip and self.flip_in_batch:
+            n = x.size(0)
+            out = model_output(self.model(torch.cat([x, x.flip(3)])))
+            yield out[:n]
+            yield out[n:].flip(3)
+            return
+        yield model_output(self.model(x))
+        if self.flip:
+            yield model_output(self.model(x.flip(3))).flip(3)
+
+    def predict(self, imgs):
+        """Returns the fused (N, n_classes, H, W) float32 scores of a (N, C, H, W) batch"""
+        n, _, h, w = imgs.size()
+        scores = None
+        count = 0
+        with torch.no_grad():
+            for scale in self.scales:
+                if scale == 1.0:
+                    x = imgs
+                else:
+                    size = (max(1, int(round(h * scale))), max(1, int(round(w * scale))))
+                    x = F.interpolate(imgs, size=size, mode='bilinear', align_corners=False)
+                for out in self.forward_scale(x):
+                    if tuple(out.size()[2:]) != (h, w):
+                        out = F.interpolate(out, size=(h, w), mode='bilinear', align_corners=False)
+                    out = out.float()
+                    if self.prob:
+                        out = F.softmax(out, dim=1)
+                    # 累加到同一个缓冲区，不保留每个尺度的输出
+                    if scores is None:
+                        scores = out.clone()
+                    elif self.fusion == 'mean':
+                        scores += out
+                    else:
+                        torch.max(scores, out, out=scores)
+                    count += 1
+                    del out
+                del x
+        if self.fusion == 'mean':
+            scores /= count
+        return scores
+
+    __call__ = predict
+
+
+def is_oom_error(e):
+    """True for the CUDA and CPU allocator out of memory RuntimeErrors"""
+    msg = str(e)
+    return isinstance(e, RuntimeError) and ('out of memory' in msg or "can't allocate memory" in msg)
+
+
+class OOMFallbackPredictor(object):
+    """Runs a predictor on a batch, splitting it into smaller chunks when it runs out of memory
+
+    The chunk size is halved on every out of memory error and kept for the following
+    batches, a single sample which still does not fit raises the error.
+    """
+
+    def __init__(self, predictor):
+        self.predictor = predictor
+        self.max_batch = None
+
+    def predict(self, imgs):
+        while True:
+            chunk = imgs.size(0) if self.max_batch is None else min(self.max_batch, imgs.size(0))
+            try:
+                return torch.cat([self.predictor(imgs[k:k + chunk]) for k in range(0, imgs.size(0), chunk)])
+            except RuntimeError as e:
+                if not is_oom_error(e) or chunk == 1:
+                    raise
+                self.max_batch = chunk // 2
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                print('out of memory with batch size {}, retrying with {}'.format(chunk, self.max_batch))
+
+    __call__ = predict
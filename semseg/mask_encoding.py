@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# 标签图的紧凑编码，用于大量预测结果的存储和网络传输，编码和解码都是向量化的numpy操作：
+# png       uint8调色板PNG(zlib压缩)，普通看图软件可以直接查看
+# rle       行优先的游程编码，(值, 长度)两个数组
+# packbits  每个出现的类别一个二值mask，按位打包，可以不解码整张标签图直接取某一类的mask
+# 除png外的格式都带有魔数和(h, w)头，解码不需要额外的信息
+# python -m semseg.mask_encoding --mask pred/0001.png --format rle
+import argparse
+import io
+import struct
+
+import numpy as np
+from PIL import Image
+
+RLE_MAGIC = b'RLE1'
+PACKBITS_MAGIC = b'PKB1'
+# 魔数，高，宽，游程长度的字节数/类别数
+_HEADER = struct.Struct('<4sIIH')
+
+
+def _as_uint8(mask):
+    mask = np.asarray(mask)
+    if mask.ndim != 2:
+        raise ValueError('expected a (H, W) label map, got shape {}'.format(mask.shape))
+    if mask.dtype != np.uint8:
+        if mask.size > 0 and (mask.min() < 0 or mask.max() > 255):
+            raise ValueError('labels must be in [0, 255] to be encoded')
+        mask = mask.astype(np.uint8)
+    return mask
+
+
+def _parse_header(data, magic):
+    if len(data) < _HEADER.size or data[:4] != magic:
+        raise ValueError('not a {} mask'.format(magic.decode('ascii')))
+    _, h, w, n = _HEADER.unpack_from(data)
+    return h, w, n
+
+
+def png_encode(mask, palette=None, compress_level=6):
+    """uint8 PNG of mask, with palette the image is indexed (P) and shows the class colors"""
+    img = Image.fromarray(_as_uint8(mask))
+    if palette is not None:
+        # L模式的图像putpalette后为P模式，像素值仍为类别
+        img.putpalette(np.asarray(palette, dtype=np.uint8)[:256].flatten().tolist())
+    buf = io.BytesIO()
+    img.save(buf, format='PNG', compress_level=compress_level)
+    return buf.getvalue()
+
+
+def png_decode(data):
+    img = Image.open(io.BytesIO(data))
+    if img.mode not in ('L', 'P'):
+        raise ValueError('expected a L or P mode PNG mask, got {}'.format(img.mode))
+    return np.asarray(img, dtype=np.uint8)
+
+
+def rle_encode(mask):
+    """Row-major run-length encoding: header, uint8 values, uint16/uint32 run lengths"""
+    mask = _as_uint8(mask)
+    h, w = mask.shape
+    flat = mask.reshape(-1)
+    if flat.size == 0:
+        return _HEADER.pack(RLE_MAGIC, h, w, 2)
+    # 每个游程的起点为值变化的位置
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size))
+    # 游程都小于65536时长度用uint16保存
+    length_dtype = np.uint16 if lengths.max() < 1 << 16 else np.uint32
+    return (_HEADER.pack(RLE_MAGIC, h, w, np.dtype(length_dtype).itemsize) +
+            flat[starts].tobytes() + lengths.astype('<' + np.dtype(length_dtype).str[1:]).tobytes())
+
+
+def rle_decode(data):
+    h, w, length_bytes = _parse_header(data, RLE_MAGIC)
+    n = (len(data) - _HEADER.size) // (1 + length_bytes)
+    values = np.frombuffer(data, dtype=np.uint8, count=n, offset=_HEADER.size)
+    lengths = np.frombuffer(data, dtype='<u{}'.format(length_bytes), count=n, offset=_HEADER.size + n)
+    flat = np.repeat(values, lengths)
+    if flat.size != h * w:
+        raise ValueError('corrupt rle mask, {} pixels for {}x{}'.format(flat.size, h, w))
+    return flat.reshape(h, w)
+
+
+def packbits_encode(mask):
+    """Bit-packed binary mask of every label present: header, the labels, one packed plane per label"""
+    mask = _as_uint8(mask)
+    h, w = mask.shape
+    # 每个像素只属于一个类别，只保存出现的类别
+    labels = np.unique(mask)
+    planes = mask.reshape(1, -1) == labels.reshape(-1, 1)
+    return (_HEADER.pack(PACKBITS_MAGIC, h, w, len(labels)) + labels.tobytes() +
+            np.packbits(planes, axis=1).tobytes())
+
+
+def packbits_class_masks(data):
+    """(labels, (n_labels, H, W) bool masks) of packbits_encode data without building the label map"""
+    h, w, n = _parse_header(data, PACKBITS_MAGIC)
+    labels = np.frombuffer(data, dtype=np.uint8, count=n, offset=_HEADER.size)
+    row_bytes = (h * w + 7) // 8
+    packed = np.frombuffer(data, dtype=np.uint8, count=n * row_bytes, offset=_HEADER.size + n)
+    planes = np.unpackbits(packed.reshape(n, row_bytes), axis=1, count=h * w).view(bool)
+    return labels, planes.reshape(n, h, w)
+
+
+def packbits_decode(data):
+    labels, planes = packbits_class_masks(data)
+    h, w, _ = _parse_header(data, PACKBITS_MAGIC)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    # 每个像素恰好在一个平面中为1，按类别填充比在类别维上argmax快
+    for label, plane in zip(labels, planes):
+        np.copyto(mask, label, where=plane)
+    return mask
+
+
+ENCODERS = {
+    'png': (png_encode, png_decode, '.png'),
+    'rle': (rle_encode, rle_decode, '.rle'),
+    'packbits': (packbits_encode, packbits_decode, '.bits'),
+}
+MASK_FORMATS = sorted(ENCODERS.keys())
+
+
+def encode_mask(mask, fmt='png', palette=None):
+    """Encodes a (H, W) label map to bytes, palette is only used by png"""
+    if fmt not in ENCODERS:
+        raise ValueError('unknown mask format {}, available: {}'.format(fmt, ', '.join(MASK_FORMATS)))
+    if fmt == 'png':
+        return png_encode(mask, palette)
+    return ENCODERS[fmt][0](mask)
+
+
+def decode_mask(data, fmt=None):
+    """Decodes bytes of encode_mask, fmt None detects it from the header"""
+    if fmt is None:
+        fmt = {RLE_MAGIC: 'rle', PACKBITS_MAGIC: 'packbits'}.get(bytes(data[:4]), 'png')
+    if fmt not in ENCODERS:
+        raise ValueError('unknown mask format {}, available: {}'.format(fmt, ', '.join(MASK_FORMATS)))
+    return ENCODERS[fmt][1](data)
+
+
+def mask_extension(fmt):
+    return ENCODERS[fmt][2]
+
+
+def save_mask(path, mask, fmt='png', palette=None):
+    """Writes the encoded mask to path + the extension of fmt, returns the file path"""
+    path = path + mask_extension(fmt)
+    with open(path, 'wb') as f:
+        f.write(encode_mask(mask, fmt, palette))
+    return path
+
+
+def load_mask(path):
+    with open(path, 'rb') as f:
+        return decode_mask(f.read())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='encode a label map and compare the sizes')
+    parser.add_argument('--mask', type=str, default='', help='label map image (L or P mode png)')
+    parser.add_argument('--format', type=str, default='rle', help='output format [ ' + ' '.join(MASK_FORMATS) + ' ]')
+    parser.add_argument('--output', type=str, default='', help='save the encoded mask to this path (without extension)')
+    args = parser.parse_args()
+
+    mask = np.asarray(Image.open(args.mask), dtype=np.uint8)
+    data = encode_mask(mask, args.format)
+    assert np.array_equal(decode_mask(data), mask)
+    print('{}x{} mask: uint8 {} bytes, int64 {} bytes, {} {} bytes ({:.2f} bits/pixel)'.format(
+        mask.shape[0], mask.shape[1], mask.size, mask.size * 8, args.format, len(data), 8.0 * len(data) / mask.size))
+    if args.output != '':
+        save_mask(args.output, mask, args.format)
@@ -3,6 +3,7 @@
 # https://github.com/wkentaro/pytorch-fcn/blob/master/torchfcn/utils.py
 
 import numpy as np
+import torch
 
 # 类别为0-n_class-1，统计bincount
 def _fast_hist(label_true, label_pred, n_class):
@@ -24,6 +25,12 @@ def scores(label_trues, label_preds, n_class):
     # 循环添加每一个样本的混淆矩阵
     for lt, lp in zip(label_trues, label_preds):
         hist += _fast_hist(lt.flatten(), lp.flatten(), n_class)
+    return _hist_scores(hist, n_class)
+
+
+# 由混淆矩阵计算各项指标
+def _hist_scores(hist, n_class):
+    hist = hist.astype(np.float64)
     acc = np.diag(hist).sum() / hist.sum()
     acc_cls = np.diag(hist) / hist.sum(axis=1)
     acc_cls = np.nanmean(acc_cls)
@@ -37,3 +44,43 @@ def scores(label_trues, label_preds, n_class):
             'Mean Acc : \t': acc_cls,
             'FreqW Acc : \t': fwavacc,
             'Mean IoU : \t': mean_iu,}, cls_iu
+
+
+class StreamingSegMetrics(object):
+    """Confusion matrix evaluator updated batch by batch
+
+    Only the int64 (n_class, n_class) confusion matrix is kept, so the memory does
+    not grow with the split. get_scores returns the same result as scores().
+
+    metrics = StreamingSegMetrics(n_class=19, ignore_index=250)
+    for imgs, labels in valloader:
+        metrics.update(labels, model(imgs).max(1)[1])
+    score, class_iou = metrics.get_scores()
+    """
+
+    def __init__(self, n_class, ignore_index=None):
+        self.n_class = n_class
+        self.ignore_index = ignore_index
+        self.hist = torch.zeros(n_class, n_class, dtype=torch.int64)
+
+    def reset(self):
+        self.hist.zero_()
+
+    def update(self, label_trues, label_preds):
+        """Adds a batch of label maps, torch tensors (on any device) or np.ndarrays of the same shape"""
+        lt = torch.as_tensor(label_trues).reshape(-1).long()
+        lp = torch.as_tensor(label_preds).reshape(-1).to(lt.device).long()
+        # 和_fast_hist相同，只统计标签在0-n_class-1之间的像素
+        mask = (lt >= 0) & (lt < self.n_class)
+        if self.ignore_index is not None:
+            mask &= lt != self.ignore_index
+        hist = torch.bincount(self.n_class * lt[mask] + lp[mask], minlength=self.n_class ** 2)
+        self.hist += hist.reshape(self.n_class, self.n_class).cpu()
+
+    def merge(self, other):
+        """Adds the confusion matrix of another evaluator, e.g. one per worker"""
+        self.hist += other.hist if isinstance(other, StreamingSegMetrics) else torch.as_tensor(other)
+        return self
+
+    def get_scores(self):
+        return _hist_scores(self.hist.numpy(), self.n_class)
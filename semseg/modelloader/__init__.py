@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# 模型注册表：结构名 -> 构造函数，对应的模块只在选择该结构时才导入，
+# train.py和validate.py共用，新增模型只需在这里注册
+import importlib
+
+
+class LazyModel(object):
+    """Factory importing module.attr on first use
+
+    :param module: module path, e.g. semseg.modelloader.fcn
+    :param attr: model class or function in the module
+    :param pretrained: the constructor accepts pretrained, otherwise it is ignored
+    :param kwargs: fixed constructor arguments, e.g. module_type='32s'
+    """
+
+    def __init__(self, module, attr, pretrained=True, **kwargs):
+        self.module = module
+        self.attr = attr
+        self.pretrained = pretrained
+        self.kwargs = kwargs
+
+    def __call__(self, n_classes, pretrained=False, **kwargs):
+        constructor = getattr(importlib.import_module(self.module), self.attr)
+        model_kwargs = dict(self.kwargs)
+        model_kwargs.update(kwargs)
+        if self.pretrained:
+            model_kwargs['pretrained'] = pretrained
+        return constructor(n_classes=n_classes, **model_kwargs)
+
+
+_MODELS = {}
+
+
+def register_model(name, factory=None):
+    """Registers factory(n_classes, pretrained=False, **kwargs) under name, usable as a decorator"""
+    if factory is None:
+        def _register(f):
+            register_model(name, f)
+            return f
+        return _register
+    _MODELS[name] = factory
+    return factory
+
+
+def list_models():
+    return sorted(_MODELS.keys())
+
+
+def get_model(name, n_classes, pretrained=False, **kwargs):
+    """Builds the model registered as name
+
+    :param pretrained: init from the ImageNet weights, ignored by the models without them
+    """
+    if name not in _MODELS:
+        raise ValueError('unknown structure {}, available: {}'.format(name, ', '.join(list_models())))
+    return _MODELS[name](n_classes, pretrained=pretrained, **kwargs)
+
+
+for _module_type in ['32s', '16s', '8s']:
+    register_model('fcn' + _module_type, LazyModel('semseg.modelloader.fcn', 'fcn', module_type=_module_type))
+    for _resnet in ['fcn_resnet18', 'fcn_resnet34']:
+        register_model(_resnet + '_' + _module_type,
+                       LazyModel('semseg.modelloader.fcn_resnet', _resnet, module_type=_module_type))
+register_model('ResNetDUC', LazyModel('semseg.modelloader.duc_hdc', 'ResNetDUC'))
+register_model('ResNetDUCHDC', LazyModel('semseg.modelloader.duc_hdc', 'ResNetDUCHDC'))
+for _segnet in ['segnet', 'segnet_vgg19', 'segnet_alignres', 'segnet_squeeze']:
+    register_model(_segnet, LazyModel('semseg.modelloader.segnet', _segnet))
+register_model('segnet_unet', LazyModel('semseg.modelloader.segnet_unet', 'segnet_unet'))
+register_model('sqnet', LazyModel('semseg.modelloader.sqnet', 'sqnet'))
+register_model('ENet', LazyModel('semseg.modelloader.enet', 'ENet', pretrained=False))
+register_model('ENetV2', LazyModel('semseg.modelloader.enetv2', 'ENetV2', pretrained=False))
+for _drn in ['drn_d_22', 'drn_a_50', 'drn_a_18', 'drn_e_22']:
+    register_model(_drn, LazyModel('semseg.modelloader.drn', 'DRNSeg', model_name=_drn))
+register_model('pspnet', LazyModel('semseg.modelloader.pspnet', 'pspnet', pretrained=False))
+register_model('erfnet', LazyModel('semseg.modelloader.erfnet', 'erfnet', pretrained=False))
+register_model('fcdensenet103', LazyModel('semseg.modelloader.fc_densenet', 'fcdensenet103', pretrained=False))
+register_model('fcdensenet56', LazyModel('semseg.modelloader.fc_densenet', 'fcdensenet56', pretrained=False))
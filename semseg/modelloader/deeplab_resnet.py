@@ -3,6 +3,7 @@
 
 import time
 import torch.nn as nn
+import torch.nn.functional as F
 import math
 import torch.utils.model_zoo as model_zoo
 import torch
@@ -189,32 +190,37 @@ class ResNet(nn.Module):
         return x
 
 class MS_Deeplab(nn.Module):
-    def __init__(self,block,n_classes):
+    def __init__(self,block,n_classes,scales=(1.0, 0.75, 0.5)):
         super(MS_Deeplab,self).__init__()
         self.Scale = ResNet(block,[3, 4, 23, 3],n_classes)   #changed to fix #4
+        self.scales = scales
 
     def forward(self,x):
-        input_size = x.size()[2]
-        self.interp1 = nn.UpsamplingBilinear2d(size = (  int(input_size*0.75)+1,  int(input_size*0.75)+1  ))
-        self.interp2 = nn.UpsamplingBilinear2d(size = (  int(input_size*0.5)+1,   int(input_size*0.5)+1   ))
-        self.interp3 = nn.UpsamplingBilinear2d(size = (  outS(input_size),   outS(input_size)   ))
+        input_size = x.size()[2:]
         out = []
-        x2 = self.interp1(x)
-        x3 = self.interp2(x)
-        out.append(self.Scale(x))	# for original scale
-        out.append(self.interp3(self.Scale(x2)))	# for 0.75x scale
-        out.append(self.Scale(x3))	# for 0.5x scale
-
-        x2Out_interp = out[1]
-        x3Out_interp = self.interp3(out[2])
-        # print('out[0].data.size():', out[0].data.size())
-        # print('x2Out_interp.data.size():', x2Out_interp.data.size())
-        temp1 = torch.max(out[0],x2Out_interp)
-        out.append(torch.max(temp1,x3Out_interp))
+        for scale in self.scales:
+            if scale == 1.0:
+                x_scale = x
+            else:
+                x_scale = F.interpolate(x, size=(int(input_size[0]*scale)+1, int(input_size[1]*scale)+1),
+                                        mode='bilinear', align_corners=True)
+            out.append(self.Scale(x_scale))
+
+        # 各尺度的输出插值到最大的输出大小(原尺度时为outS(input_size))，再取最大值融合
+        out_size = max(o.size()[2:] for o in out)
+        out = [o if o.size()[2:] == out_size else F.interpolate(o, size=out_size, mode='bilinear', align_corners=True)
+               for o in out]
+        fused = out[0]
+        for o in out[1:]:
+            fused = torch.max(fused, o)
+        # 训练时返回各尺度的输出和融合结果用于多尺度loss，推理时只返回融合结果
+        if not self.training:
+            return fused
+        out.append(fused)
         return out
 
-def Res_Deeplab(n_classes=21):
-    model = MS_Deeplab(Bottleneck,n_classes)
+def Res_Deeplab(n_classes=21, scales=(1.0, 0.75, 0.5)):
+    model = MS_Deeplab(Bottleneck,n_classes,scales)
     return model
 
 if __name__ == '__main__':
@@ -10,7 +10,6 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import models
 
 from semseg.loss import cross_entropy2d
 
@@ -289,6 +289,7 @@ class DownsamplingBottleneck(nn.Module):
 
         # Store parameters that are needed later
         self.return_indices = return_indices
+        self.pad_channels = out_channels - in_channels
 
         # Check in the internal_scale parameter is within the expected range
         # [1, channels]
@@ -362,17 +363,8 @@ class DownsamplingBottleneck(nn.Module):
         ext = self.ext_regul(ext)
 
         # Main branch channel padding
-        n, ch_ext, h, w = ext.size()
-        ch_main = main.size()[1]
-        padding = Variable(torch.zeros(n, ch_ext - ch_main, h, w))
-
-        # Before concatenating, check if main is on the CPU or GPU and
-        # convert padding accordingly
-        if main.is_cuda:
-            padding = padding.cuda()
-
-        # Concatenate
-        main = torch.cat((main, padding), 1)
+        # 用F.pad在通道维补零，和main在同一设备上，不依赖运行时的大小，可以被FX追踪(量化)
+        main = F.pad(main, (0, 0, 0, 0, 0, self.pad_channels))
 
         # Add main and extension branches
         out = main + ext
@@ -6,7 +6,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import models
 
 # class fast_segnet(nn.Module):
 #     def __init__(self):
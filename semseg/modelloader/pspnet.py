@@ -7,13 +7,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import models
 
+from semseg.inference import SlidingWindowPredictor
 from semseg.loss import cross_entropy2d
 from semseg.modelloader.utils import conv2DBatchNormRelu
 from semseg.modelloader.utils import residualBlockPSP
 from semseg.modelloader.utils import pyramidPooling
-from semseg import caffe_pb2
 
 
 class pspnet(nn.Module):
@@ -53,7 +52,7 @@ class pspnet(nn.Module):
         # H/4, W/4 -> H/8, W/8
         x = self.res_block5(self.res_block4(self.res_block3(self.res_block2(x))))
         x = self.pyramid_pooling(x)
-        x = F.dropout2d(self.cbr_final(x), p=0.1, inplace=True)
+        x = F.dropout2d(self.cbr_final(x), p=0.1, training=self.training, inplace=True)
         x = self.classification(x)
         x = F.upsample(x, size=inp_shape, mode='bilinear')
         return x
@@ -95,6 +94,8 @@ class pspnet(nn.Module):
                 raise Exception("Unkown layer type {}".format(ltype))
 
 
+        # caffe的protobuf定义很大，只在加载caffe模型时导入
+        from semseg import caffe_pb2
         net = caffe_pb2.NetParameter()
         with open(model_path, 'rb') as model_file:
             net.MergeFromString(model_file.read())
@@ -204,79 +205,22 @@ class pspnet(nn.Module):
             _transfer_residual(k, v)
 
 
-    def tile_predict(self, img, input_size=[713, 713]):
+    def tile_predict(self, img, input_size=[713, 713], tile_batch_size=4):
         """
         Predict by takin overlapping tiles from the image.
     
         :param img: np.ndarray with shape [C, H, W] in BGR format
+        :param tile_batch_size: number of windows (flipped copies included) per forward
             
         Source: https://github.com/mitmul/chainer-pspnet/blob/master/pspnet.py#L408-L448
         Adapted for PyTorch
-        # TODO: Remove artifacts in last window.
         """
         
         setattr(self, 'input_size', input_size)
 
-        def _pad_img(img):
-            if img.shape[1] < self.input_size[0]:
-                pad_h = self.input_size[0] - img.shape[1]
-                img = np.pad(img, ((0, 0), (0, pad_h), (0, 0)), 'constant')
-            else:
-                pad_h = 0
-            if img.shape[2] < self.input_size[1]:
-                pad_w = self.input_size[1] - img.shape[2]
-                img = np.pad(img, ((0, 0), (0, 0), (0, pad_w)), 'constant')
-            else:
-                pad_w = 0
-            return img, pad_h, pad_w
-
-
-        ori_rows, ori_cols = img.shape[1:]
-        long_size = max(ori_rows, ori_cols)
-            
-        if long_size > max(self.input_size):
-            count = np.zeros((ori_rows, ori_cols))
-            pred = np.zeros((1, self.n_classes, ori_rows, ori_cols))
-            stride_rate = 2 / 3.
-            stride = (int(ceil(self.input_size[0] * stride_rate)),
-                      int(ceil(self.input_size[1] * stride_rate)))
-            hh = int(ceil((ori_rows - self.input_size[0]) / stride[0])) + 1
-            ww = int(ceil((ori_cols - self.input_size[1]) / stride[1])) + 1
-            for yy in range(hh):
-                for xx in range(ww):
-                    sy, sx = yy * stride[0], xx * stride[1]
-                    ey, ex = sy + self.input_size[0], sx + self.input_size[1]
-                    img_sub = img[:, sy:ey, sx:ex]
-                    img_sub, pad_h, pad_w = _pad_img(img_sub)
-                    img_sub_flp = np.copy(img_sub[:, :, ::-1])
-
-                    # inp = Variable(torch.unsqueeze(torch.from_numpy(img_sub).float(), 0).cuda(), volatile=True)
-                    # flp = Variable(torch.unsqueeze(torch.from_numpy(img_sub_flp).float(), 0).cuda(), volatile=True)
-                    inp = Variable(torch.unsqueeze(torch.from_numpy(img_sub).float(), 0), volatile=True)
-                    flp = Variable(torch.unsqueeze(torch.from_numpy(img_sub_flp).float(), 0), volatile=True)
-                    psub1 = F.softmax(self.forward(inp), dim=1).data.cpu().numpy()
-                    psub2 = F.softmax(self.forward(flp), dim=1).data.cpu().numpy()
-
-                    psub = (psub1 + psub2[:, :, :, ::-1]) / 2.0
-
-                    if sy + self.input_size[0] > ori_rows:
-                        psub = psub[:, :, :-pad_h, :]
-                    if sx + self.input_size[1] > ori_cols:
-                        psub = psub[:, :, :, :-pad_w]
-                    pred[:, :, sy:ey, sx:ex] = psub
-                    count[sy:ey, sx:ex] += 1
-            score = (pred / count[None, None, ...]).astype(np.float32)
-        else:
-            img, pad_h, pad_w = _pad_img(img)
-            # inp = Variable(torch.unsqueeze(torch.from_numpy(img), 0).cuda(), volatile=True)
-            inp = Variable(torch.unsqueeze(torch.from_numpy(img), 0), volatile=True)
-            pred1 = F.softmax(self.forward(inp), dim=1).data.cpu().numpy()
-            pred2 = F.softmax(self.forward(inp[:, :, :, ::-1]), dim=1).data.cpu().numpy()
-            pred = (pred1 + pred2[:, :, :, ::-1]) / 2.0
-            score = pred[:, :, :self.input_size[0] - pad_h, :self.input_size[1] - pad_w]
-        
-        tscore = F.upsample(torch.from_numpy(score), size=(ori_rows, ori_cols), mode='bilinear')
-        score = tscore[0].data.numpy()
+        predictor = SlidingWindowPredictor(self, self.n_classes, self.input_size, stride_rate=2 / 3., flip=True,
+                                           tile_batch_size=tile_batch_size, prob=True)
+        score = predictor(torch.from_numpy(img).float().unsqueeze(0))[0].numpy()
         return score / score.sum(axis=0)
 
 if __name__ == '__main__':
@@ -8,7 +8,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import models
 
 from semseg.loss import cross_entropy2d
 from semseg.modelloader.utils import unetDown, unetUp
@@ -7,7 +7,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import models
 
 class conv2DBatchNorm(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size,  stride, padding, bias=True):
@@ -395,7 +394,7 @@ class pyramidPooling(nn.Module):
         # 输出已经默认包括x
         output_slices = [x]
         # 输出宽度需要和x相同
-        h, w = x.view()[2:]
+        h, w = x.size()[2:]
 
         for module, pool_size in zip(self.path_module_list, self.pool_sizes):
             # 金字塔池化操作，分别对每一个module和sizes进行操作
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# 按模块统计前向和反向耗时：forward hook为每个模块(包括组合模块)打上record_function的范围，
+# torch.profiler记录的反向算子通过sequence_nr对应到前向算子所在的模块，
+# 汇总多次迭代后按耗时排序输出，并可导出chrome trace(chrome://tracing或perfetto中查看)
+# python -m semseg.profiler --structure pspnet --resolution 360x480 --iterations 5 --backward True --trace pspnet.json
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.autograd.profiler import record_function
+
+SCOPE_PREFIX = 'module::'
+BACKWARD_PREFIX = 'autograd::engine::evaluate_function: '
+
+
+def _output_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(_output_bytes(o) for o in output)
+    if isinstance(output, dict):
+        return sum(_output_bytes(o) for o in output.values())
+    return 0
+
+
+class ModuleProfiler(object):
+    """Per-module forward/backward time of a model over several iterations
+
+    profiler = ModuleProfiler(model)
+    profiler.start()
+    for imgs, labels in loader:
+        ...forward, backward...
+        profiler.step()
+    profiler.stop()
+    print(profiler.table())
+    profiler.export_chrome_trace('trace.json')
+
+    Times are inclusive (total) and exclusive of the child modules (self). On gpu
+    pass sync=True so that the module ranges wait for their kernels.
+    """
+
+    def __init__(self, model, sync=False):
+        self.model = model
+        self.sync = sync
+        self.iterations = 0
+        self.stats = {}
+        self._handles = []
+        self._scopes = []
+        self._prof = None
+
+    def _new_stats(self, name, module):
+        return {'name': name if name != '' else '(model)', 'type': type(module).__name__, 'calls': 0,
+                'forward_ms': 0.0, 'forward_self_ms': 0.0, 'backward_ms': 0.0, 'backward_self_ms': 0.0,
+                'activation_bytes': 0}
+
+    def _sync(self):
+        if self.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            self._sync()
+            scope = record_function(SCOPE_PREFIX + name)
+            scope.__enter__()
+            self._scopes.append(scope)
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            self._sync()
+            self._scopes.pop().__exit__(None, None, None)
+            stats = self.stats[name]
+            stats['calls'] += 1
+            stats['activation_bytes'] += _output_bytes(output)
+        return hook
+
+    def start(self):
+        self.iterations = 0
+        self.stats = {}
+        for name, module in self.model.named_modules():
+            self.stats[name] = self._new_stats(name, module)
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._post_hook(name)))
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._prof = torch.profiler.profile(activities=activities)
+        self._prof.__enter__()
+        return self
+
+    def step(self):
+        """Marks the end of one iteration, the times are reported per iteration"""
+        self.iterations += 1
+
+    def stop(self):
+        self._prof.__exit__(None, None, None)
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._aggregate(self._prof.events())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @staticmethod
+    def _scope(event):
+        """The innermost module scope enclosing event (or event itself), None outside the model"""
+        while event is not None and not event.name.startswith(SCOPE_PREFIX):
+            event = event.cpu_parent
+        return event
+
+    def _aggregate(self, events):
+        forward_ops = {}
+        for event in events:
+            name = event.name
+            if name.startswith(SCOPE_PREFIX):
+                stats = self.stats.get(name[len(SCOPE_PREFIX):])
+                if stats is None:
+                    continue
+                ms = event.cpu_time_total / 1000.0
+                stats['forward_ms'] += ms
+                stats['forward_self_ms'] += ms
+                parent = self._scope(event.cpu_parent)
+                if parent is not None and parent.name[len(SCOPE_PREFIX):] in self.stats:
+                    self.stats[parent.name[len(SCOPE_PREFIX):]]['forward_self_ms'] -= ms
+            elif event.sequence_nr >= 0 and not name.startswith(BACKWARD_PREFIX):
+                # 记录创建反向节点的前向算子，外层算子(如aten::conv2d)先出现
+                forward_ops.setdefault((event.thread, event.sequence_nr), event)
+
+        for event in events:
+            if not event.name.startswith(BACKWARD_PREFIX) or event.sequence_nr < 0:
+                continue
+            forward_op = forward_ops.get((event.fwd_thread, event.sequence_nr))
+            scope = self._scope(forward_op)
+            if scope is None:
+                continue
+            ms = event.cpu_time_total / 1000.0
+            self.stats[scope.name[len(SCOPE_PREFIX):]]['backward_self_ms'] += ms
+            # 反向耗时同时计入所有外层模块
+            while scope is not None:
+                name = scope.name[len(SCOPE_PREFIX):]
+                if name in self.stats:
+                    self.stats[name]['backward_ms'] += ms
+                scope = self._scope(scope.cpu_parent)
+
+    def report(self, sort_by='self'):
+        """Per-iteration stats of the called modules, sorted by self or total time"""
+        n = float(max(self.iterations, 1))
+        total_ms = sum(s['forward_self_ms'] + s['backward_self_ms'] for s in self.stats.values())
+        rows = []
+        for s in self.stats.values():
+            if s['calls'] == 0:
+                continue
+            row = dict(s)
+            for k in ('forward_ms', 'forward_self_ms', 'backward_ms', 'backward_self_ms'):
+                row[k] = s[k] / n
+            row['calls'] = s['calls'] / n
+            row['self_ms'] = row['forward_self_ms'] + row['backward_self_ms']
+            row['total_ms'] = row['forward_ms'] + row['backward_ms']
+            row['share'] = row['self_ms'] * n / total_ms if total_ms > 0 else 0.0
+            row['activation_mb'] = s['activation_bytes'] / n / 1024.0 ** 2
+            rows.append(row)
+        key = 'total_ms' if sort_by == 'total' else 'self_ms'
+        return sorted(rows, key=lambda r: -r[key])
+
+    def table(self, top=30, sort_by='self'):
+        lines = ['{:<45s} {:<20s} {:>6s} {:>10s} {:>10s} {:>10s} {:>10s} {:>7s} {:>10s}'.format(
+            'module', 'type', 'calls', 'fwd ms', 'bwd ms', 'self ms', 'total ms', 'share', 'act MB')]
+        for r in self.report(sort_by)[:top]:
+            lines.append('{:<45s} {:<20s} {:>6.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>6.1f}% {:>10.2f}'.format(
+                r['name'][-45:], r['type'][:20], r['calls'], r['forward_ms'], r['backward_ms'], r['self_ms'],
+                r['total_ms'], 100 * r['share'], r['activation_mb']))
+        lines.append('{} iterations, times per iteration'.format(self.iterations))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        self._prof.export_chrome_trace(path)
+
+
+def profile_model(model, input_size, iterations=5, warmup=1, backward=False, sync=False):
+    """Profiles iterations forward (and backward) passes of model on random input_size"""
+    device = next(model.parameters()).device
+    input_ = torch.randn(*input_size, device=device)
+    model.train(backward)
+
+    def run():
+        if backward:
+            out = model(input_)
+            out = out[0] if isinstance(out, (tuple, list)) else out
+            out.float().mean().backward()
+            model.zero_grad()
+        else:
+            with torch.no_grad():
+                model(input_)
+
+    for _ in range(warmup):
+        run()
+    profiler = ModuleProfiler(model, sync=sync)
+    with profiler:
+        for _ in range(iterations):
+            run()
+            profiler.step()
+    return profiler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='per-module forward/backward time of a modelloader model')
+    parser.add_argument('--structure', type=str, default='ENet', help='use the net structure to segment [ ENet ]')
+    parser.add_argument('--n_classes', type=int, default=13, help='class num [ 13 ]')
+    parser.add_argument('--resolution', type=str, default='360x480', help='HxW input size [ 360x480 ]')
+    parser.add_argument('--batch_size', type=int, default=1, help='input batch size [ 1 ]')
+    parser.add_argument('--iterations', type=int, default=5, help='profiled iterations [ 5 ]')
+    parser.add_argument('--backward', type=bool, default=False, help='also profile the backward pass [ False ]')
+    parser.add_argument('--top', type=int, default=30, help='rows of the hot-spot table [ 30 ]')
+    parser.add_argument('--sort_by', type=str, default='self', help='sort the table by [ self total ]')
+    parser.add_argument('--trace', type=str, default='', help='export a chrome trace to this path')
+    parser.add_argument('--cuda', type=bool, default=False, help='use cuda [ False ]')
+    args = parser.parse_args()
+
+    from semseg.modelloader import get_model
+    model = get_model(args.structure, n_classes=args.n_classes)
+    if args.cuda:
+        model.cuda()
+    h, w = [int(v) for v in args.resolution.split('x')]
+    profiler = profile_model(model, (args.batch_size, 3, h, w), iterations=args.iterations,
+                             backward=args.backward, sync=args.cuda)
+    print(profiler.table(top=args.top, sort_by=args.sort_by))
+    if args.trace != '':
+        profiler.export_chrome_trace(args.trace)
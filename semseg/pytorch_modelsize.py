@@ -1,11 +1,27 @@
 # -*- coding: utf-8 -*-
 
 # code from https://github.com/jacobkimmel/pytorch_modelsize/blob/master/pytorch_modelsize.py
+# 改为用forward hook记录每一层真实的输出大小，适用于非顺序结构的模型（残差、concat、unpool等）
+# python -m semseg.pytorch_modelsize --structures segnet,ENet --batch_sizes 1,4 --resolutions 360x480 --rss True
+
+import argparse
+import json
+import os
+import subprocess
+import sys
 
-import torch
-import torch.nn as nn
-from torch.autograd import Variable
 import numpy as np
+import torch
+
+
+def _tensors(x):
+    if torch.is_tensor(x):
+        return [x]
+    if isinstance(x, (tuple, list)):
+        return [t for v in x for t in _tensors(v)]
+    if isinstance(x, dict):
+        return [t for v in x.values() for t in _tensors(v)]
+    return []
 
 
 class SizeEstimator(object):
@@ -14,64 +30,89 @@ class SizeEstimator(object):
         '''
         Estimates the size of PyTorch models in memory
         for a given input size
+
+        Floating point parameters, buffers and activations are counted with
+        `bits` bits, pass bits=None to use their real dtype. Integer tensors
+        (e.g. max pooling indices) always use their own dtype.
         '''
         self.model = model
         self.input_size = input_size
-        self.bits = 32
+        self.bits = bits
         return
 
-    def get_parameter_sizes(self):
-        '''Get sizes of all parameters in `model`'''
-        mods = list(self.model.modules())
-        sizes = []
-
-        for i in range(1, len(mods)):
-            m = mods[i]
-            p = list(m.parameters())
-            for j in range(len(p)):
-                sizes.append(np.array(p[j].size()))
+    def _tensor_bits(self, t):
+        if self.bits is not None and t.is_floating_point():
+            return t.numel() * self.bits
+        return t.numel() * t.element_size() * 8
 
-        self.param_sizes = sizes
+    def get_parameter_sizes(self):
+        '''Get sizes of all parameters and buffers in `model`, shared tensors are counted once'''
+        self.param_sizes = [np.array(p.size()) for p in self.model.parameters()]
+        self.buffer_sizes = [np.array(b.size()) for b in self.model.buffers()]
         return
 
     def get_output_sizes(self):
-        '''Run sample input through each layer to get output sizes'''
-        input_ = Variable(torch.FloatTensor(*self.input_size), volatile=True)
-        mods = list(self.model.modules())
-        out_sizes = []
-        for i in range(1, len(mods)):
-            m = mods[i]
-            out = m(input_)
-            out_sizes.append(np.array(out.size()))
-            input_ = out
-
-        self.out_sizes = out_sizes
+        '''Run sample input through the model and record the output of every leaf module with forward hooks'''
+        layers = []
+        handles = []
+
+        def _hook(name, m):
+            def hook(module, inputs, outputs):
+                in_ptrs = set(t.data_ptr() for t in _tensors(inputs))
+                outs = _tensors(outputs)
+                # inplace操作(如ReLU(inplace=True))的输出和输入共用内存，不重复计算
+                new_outs = [t for t in outs if t.data_ptr() not in in_ptrs]
+                layers.append({
+                    'name': name,
+                    'type': type(module).__name__,
+                    'output_sizes': [list(t.size()) for t in outs],
+                    'dtypes': [str(t.dtype).replace('torch.', '') for t in outs],
+                    'inplace': len(new_outs) < len(outs),
+                    'activation_bits': int(sum(self._tensor_bits(t) for t in new_outs)),
+                    'param_bits': int(sum(self._tensor_bits(p) for p in module.parameters(recurse=False))),
+                    'buffer_bits': int(sum(self._tensor_bits(b) for b in module.buffers(recurse=False))),
+                })
+            return hook
+
+        for name, m in self.model.named_modules():
+            # 只统计叶子模块，避免容器模块重复计算
+            if len(list(m.children())) == 0:
+                handles.append(m.register_forward_hook(_hook(name, m)))
+
+        param = next(self.model.parameters(), None)
+        device = param.device if param is not None else torch.device('cpu')
+        input_ = torch.zeros(*self.input_size, device=device)
+        training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                self.model(input_)
+        finally:
+            self.model.train(training)
+            for handle in handles:
+                handle.remove()
+
+        self.layers = layers
+        self.out_sizes = [np.array(s) for layer in layers for s in layer['output_sizes']]
         return
 
     def calc_param_bits(self):
-        '''Calculate total number of bits to store `model` parameters'''
-        total_bits = 0
-        for i in range(len(self.param_sizes)):
-            s = self.param_sizes[i]
-            bits = np.prod(np.array(s)) * self.bits
-            total_bits += bits
-        self.param_bits = total_bits
+        '''Calculate total number of bits to store `model` parameters and buffers'''
+        self.param_bits = sum(self._tensor_bits(p) for p in self.model.parameters())
+        self.buffer_bits = sum(self._tensor_bits(b) for b in self.model.buffers())
         return
 
     def calc_forward_backward_bits(self):
         '''Calculate bits to store forward and backward pass'''
-        total_bits = 0
-        for i in range(len(self.out_sizes)):
-            s = self.out_sizes[i]
-            bits = np.prod(np.array(s)) * self.bits
-            total_bits += bits
+        total_bits = sum(layer['activation_bits'] for layer in self.layers)
         # multiply by 2 for both forward AND backward
         self.forward_backward_bits = (total_bits * 2)
         return
 
     def calc_input_bits(self):
         '''Calculate bits to store input'''
-        self.input_bits = np.prod(np.array(self.input_size)) * self.bits
+        bits = self.bits if self.bits is not None else 32
+        self.input_bits = int(np.prod(np.array(self.input_size))) * bits
         return
 
     def estimate_size(self):
@@ -81,7 +122,175 @@ class SizeEstimator(object):
         self.calc_param_bits()
         self.calc_forward_backward_bits()
         self.calc_input_bits()
-        total = self.param_bits + self.forward_backward_bits + self.input_bits
+        total = self.param_bits + self.buffer_bits + self.forward_backward_bits + self.input_bits
 
         total_megabytes = (total / 8) / (1024 ** 2)
         return total_megabytes, total
+
+    def summary(self):
+        '''Per-layer breakdown as a printable table, call estimate_size first'''
+        mb = lambda bits: bits / 8.0 / 1024 ** 2
+        lines = ['{:<50s} {:<20s} {:<24s} {:>10s} {:>10s}'.format('layer', 'type', 'output', 'act MB', 'param MB')]
+        for layer in self.layers:
+            out = ','.join('x'.join(map(str, s)) for s in layer['output_sizes'])
+            lines.append('{:<50s} {:<20s} {:<24s} {:>10.3f} {:>10.3f}'.format(
+                layer['name'][-50:], layer['type'][:20], out[:24], mb(layer['activation_bits']),
+                mb(layer['param_bits'] + layer['buffer_bits'])))
+        lines.append('params {:.2f} MB, buffers {:.2f} MB, forward/backward {:.2f} MB, input {:.2f} MB'.format(
+            mb(self.param_bits), mb(self.buffer_bits), mb(self.forward_backward_bits), mb(self.input_bits)))
+        return '\n'.join(lines)
+
+
+def _proc_status_mb(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024.0
+    return None
+
+
+def reset_peak_rss():
+    '''Resets the peak RSS (VmHWM) of this process, Linux only, returns False when not supported'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def current_rss_mb():
+    '''Resident set size of this process in MB, the peak RSS where /proc is not available'''
+    try:
+        return _proc_status_mb('VmRSS')
+    except (IOError, OSError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    '''Peak resident set size of this process in MB (since the last reset_peak_rss on Linux)'''
+    try:
+        return _proc_status_mb('VmHWM')
+    except (IOError, OSError):
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS返回字节，其他系统返回KB
+        return rss / 1024.0 ** 2 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def measure_rss(structure, n_classes, input_size, backward=False):
+    '''Builds structure and runs one pass in this process
+
+    Returns the RSS in MB before building the model, after building it and the peak during the pass.
+    '''
+    from semseg.modelloader import get_model
+    rss_base = current_rss_mb()
+    model = get_model(structure, n_classes=n_classes)
+    input_ = torch.randn(*input_size)
+    rss_model = current_rss_mb()
+    # import torch和构建模型(如复制vgg16的权重)时的峰值不计入
+    reset_peak_rss()
+    if backward:
+        model.train()
+        out = model(input_)
+        out = out[0] if isinstance(out, (tuple, list)) else out
+        out.sum().backward()
+    else:
+        model.eval()
+        with torch.no_grad():
+            model(input_)
+    return {'rss_base_mb': rss_base, 'rss_model_mb': rss_model, 'rss_peak_mb': peak_rss_mb()}
+
+
+def measure_rss_subprocess(structure, n_classes, input_size, backward=False):
+    '''Runs measure_rss in a fresh interpreter so the peak RSS of earlier models does not leak in'''
+    cmd = [sys.executable, '-m', 'semseg.pytorch_modelsize', '--measure_rss_child', structure,
+           '--n_classes', str(n_classes), '--input_size', 'x'.join(map(str, input_size)),
+           '--backward', '1' if backward else '']
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(cmd, cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'measure_rss failed')
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def sweep(structures, n_classes, batch_sizes, resolutions, bits=32, rss=False, backward=False, breakdown=False):
+    '''Estimates every structure at every batch size and resolution, returns a list of result dicts'''
+    from semseg.modelloader import get_model
+    results = []
+    for structure in structures:
+        try:
+            model = get_model(structure, n_classes=n_classes)
+        except Exception as e:
+            print('{}: build failed, {}'.format(structure, e))
+            continue
+        for h, w in resolutions:
+            for batch_size in batch_sizes:
+                input_size = (batch_size, 3, h, w)
+                result = {'structure': structure, 'input_size': list(input_size)}
+                try:
+                    se = SizeEstimator(model, input_size=input_size, bits=bits)
+                    total_mb, _ = se.estimate_size()
+                    result.update({'estimate_mb': total_mb,
+                                   'param_mb': se.param_bits / 8.0 / 1024 ** 2,
+                                   'buffer_mb': se.buffer_bits / 8.0 / 1024 ** 2,
+                                   'forward_backward_mb': se.forward_backward_bits / 8.0 / 1024 ** 2})
+                    if breakdown:
+                        print(structure, input_size)
+                        print(se.summary())
+                        result['layers'] = se.layers
+                    if rss:
+                        result.update(measure_rss_subprocess(structure, n_classes, input_size, backward))
+                except Exception as e:
+                    result['error'] = str(e)
+                results.append(result)
+    return results
+
+
+def _parse_size(s):
+    return tuple(int(v) for v in s.split('x'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='estimate the memory of the modelloader models')
+    parser.add_argument('--structures', type=str, default='all', help='comma separated structures [ all ]')
+    parser.add_argument('--n_classes', type=int, default=13, help='class num [ 13 ]')
+    parser.add_argument('--batch_sizes', type=str, default='1', help='comma separated batch sizes [ 1 ]')
+    parser.add_argument('--resolutions', type=str, default='360x480', help='comma separated HxW input sizes [ 360x480 ]')
+    parser.add_argument('--bits', type=int, default=32, help='bits per float value, 0 uses the real dtype [ 32 ]')
+    parser.add_argument('--rss', type=bool, default=False, help='also measure the peak RSS in a subprocess [ False ]')
+    parser.add_argument('--backward', type=bool, default=False, help='include a backward pass in the RSS measurement [ False ]')
+    parser.add_argument('--breakdown', type=bool, default=False, help='print the per-layer breakdown [ False ]')
+    parser.add_argument('--output', type=str, default='', help='save the results as json')
+    parser.add_argument('--measure_rss_child', type=str, default='', help=argparse.SUPPRESS)
+    parser.add_argument('--input_size', type=str, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_rss_child != '':
+        # measure_rss_subprocess启动的子进程
+        print(json.dumps(measure_rss(args.measure_rss_child, args.n_classes, _parse_size(args.input_size),
+                                     args.backward)))
+        sys.exit(0)
+
+    from semseg.modelloader import list_models
+    structures = list_models() if args.structures == 'all' else args.structures.split(',')
+    results = sweep(structures, args.n_classes,
+                    [int(b) for b in args.batch_sizes.split(',')],
+                    [_parse_size(r) for r in args.resolutions.split(',')],
+                    bits=args.bits if args.bits > 0 else None, rss=args.rss, backward=args.backward,
+                    breakdown=args.breakdown)
+
+    print('{:<20s} {:<18s} {:>12s} {:>10s} {:>10s} {:>12s}'.format(
+        'structure', 'input', 'estimate MB', 'param MB', 'RSS MB', 'RSS peak MB'))
+    # RSS为模型构建后相对构建前的增量，RSS peak为前向(反向)过程中的峰值增量
+    for r in results:
+        if 'error' in r:
+            print('{:<20s} {:<18s} error: {}'.format(r['structure'], 'x'.join(map(str, r['input_size'])), r['error']))
+            continue
+        print('{:<20s} {:<18s} {:>12.1f} {:>10.1f} {:>10s} {:>12s}'.format(
+            r['structure'], 'x'.join(map(str, r['input_size'])), r['estimate_mb'], r['param_mb'],
+            '{:.1f}'.format(r['rss_model_mb'] - r['rss_base_mb']) if 'rss_model_mb' in r else '-',
+            '{:.1f}'.format(r['rss_peak_mb'] - r['rss_base_mb']) if 'rss_peak_mb' in r else '-'))
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
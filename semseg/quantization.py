@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# int8训练后静态量化：用FX在模型中插入observer，在camvid/cityscapes的N个样本上校准后转换为int8模型，
+# MaxUnpool2d和返回indices的MaxPool2d没有量化实现，量化的PReLU误差过大，这些层都保持float；
+# forward中依赖张量大小的模块(如ENetV2的通道padding)无法符号追踪，自动找出后整体保持float，
+# 其余的卷积(包括1x3/3x1非对称卷积和空洞卷积)量化为int8
+# python -m semseg.quantization --structure ENet --model_state_dict ENet_camvid_class_13_100.pt --dataset_path ~/Data/CamVid
+import argparse
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.fx
+
+from semseg.metrics import scores
+
+REALTIME_STRUCTURES = ['ENet', 'ENetV2', 'erfnet', 'sqnet', 'segnet_squeeze']
+# 没有量化实现的层保持float，FX在前后插入dequantize/quantize
+FLOAT_MODULES = (nn.MaxUnpool2d,)
+
+
+class FloatPReLU(nn.Module):
+    """PReLU kept in float
+
+    The FX lowering turns nn.PReLU into a quantized PReLU whose error is far
+    too large (0.75 relative error on ENetV2's initial block), and a None
+    qconfig on a traced nn.PReLU breaks the lowering. The wrapper is traced
+    as a leaf so no PReLU node reaches the lowering.
+    """
+
+    def __init__(self, prelu):
+        super(FloatPReLU, self).__init__()
+        self.prelu = prelu
+
+    def forward(self, x):
+        return self.prelu(x)
+
+
+class TraceWrapper(nn.Module):
+    """Calls model with its default keyword arguments only
+
+    forward(input, only_encode=False) style flags would otherwise become
+    symbolic inputs and break the FX trace.
+    """
+
+    def __init__(self, model):
+        super(TraceWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)
+
+
+class _LeafTracer(torch.fx.Tracer):
+    def __init__(self, leaf_classes):
+        super(_LeafTracer, self).__init__()
+        self.leaf_classes = tuple(leaf_classes)
+
+    def is_leaf_module(self, m, module_qualified_name):
+        return isinstance(m, self.leaf_classes) or super(_LeafTracer, self).is_leaf_module(m, module_qualified_name)
+
+
+def find_non_traceable(model, max_tries=32):
+    """Module classes of model that FX cannot trace, innermost first
+
+    Traces repeatedly, every failure marks the class of the innermost module
+    in the traceback as a leaf. Modules keeping a traced value as state (ENet
+    saves the pooling indices for the decoder) are marked as well, the traced
+    graph would not update that state.
+    """
+    leaves = []
+    for _ in range(max_tries):
+        try:
+            _LeafTracer(leaves).trace(model)
+        except Exception as e:
+            tb = e.__traceback__
+            culprit = None
+            while tb is not None:
+                obj = tb.tb_frame.f_locals.get('self')
+                # 只标记本仓库的模块，torch自带的层可以追踪
+                if isinstance(obj, nn.Module) and type(obj).__module__.startswith('semseg') \
+                        and not isinstance(obj, TraceWrapper) and type(obj) not in leaves:
+                    culprit = type(obj)
+                tb = tb.tb_next
+            if culprit is None:
+                raise
+            leaves.append(culprit)
+            continue
+        stateful = []
+        for m in model.modules():
+            proxies = [k for k, v in vars(m).items() if isinstance(v, torch.fx.Proxy)]
+            for k in proxies:
+                delattr(m, k)
+            if proxies and type(m) not in leaves + stateful:
+                stateful.append(type(m))
+        if not stateful:
+            return leaves
+        leaves.extend(stateful)
+    raise RuntimeError('model is not traceable after marking {}'.format([c.__name__ for c in leaves]))
+
+
+def select_backend(backend=''):
+    engines = torch.backends.quantized.supported_engines
+    if backend == '':
+        # x86/fbgemm用于服务器cpu，qnnpack用于arm
+        backend = next((e for e in ('x86', 'fbgemm', 'qnnpack') if e in engines), engines[0])
+    if backend not in engines:
+        raise ValueError('quantized engine {} not in {}'.format(backend, engines))
+    torch.backends.quantized.engine = backend
+    return backend
+
+
+def quantize_static(model, calib_inputs, backend=''):
+    """Post-training static int8 quantization of model with FX graph mode
+
+    :param model: float model, it is copied
+    :param calib_inputs: iterable of input batches used to calibrate the observers
+    :param backend: quantized engine, '' picks x86/fbgemm/qnnpack
+    :return: (quantized model, non-traceable classes kept in float)
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    backend = select_backend(backend)
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    for module_type in FLOAT_MODULES:
+        qconfig_mapping = qconfig_mapping.set_object_type(module_type, None)
+
+    wrapper = TraceWrapper(copy.deepcopy(model)).eval()
+    # 同一个PReLU可能在多处使用(ENetV2)，每处都要替换
+    for name, m in list(wrapper.named_modules(remove_duplicate=False)):
+        if isinstance(m, nn.PReLU):
+            parent_name, _, attr = name.rpartition('.')
+            setattr(wrapper.get_submodule(parent_name), attr, FloatPReLU(m))
+    # 包装后图中没有nn.PReLU节点，两者都设为None不影响lowering
+    qconfig_mapping = qconfig_mapping.set_object_type(FloatPReLU, None).set_object_type(nn.PReLU, None)
+    for name, m in wrapper.named_modules():
+        # 返回(输出, indices)的池化，indices给MaxUnpool2d使用
+        if isinstance(m, nn.MaxPool2d) and m.return_indices:
+            qconfig_mapping = qconfig_mapping.set_module_name(name, None)
+    leaves = find_non_traceable(wrapper)
+    prepare_config = PrepareCustomConfig().set_non_traceable_module_classes(leaves + [FloatPReLU])
+
+    calib_inputs = iter(calib_inputs)
+    first = next(calib_inputs)
+    # prepare_fx会把eval模式下的conv+bn(+relu)融合
+    prepared = prepare_fx(wrapper, qconfig_mapping, (first,), prepare_custom_config=prepare_config)
+    with torch.no_grad():
+        prepared(first)
+        for x in calib_inputs:
+            prepared(x)
+    return convert_fx(prepared), leaves
+
+
+def _predict(model, img):
+    with torch.no_grad():
+        out = model(img.unsqueeze(0))
+    out = out[0] if isinstance(out, (tuple, list)) else out
+    return out.max(1)[1].numpy()[0]
+
+
+def compare(model, qmodel, dst, indices, n_classes):
+    """mIoU of the float and the int8 model on dst[indices] through metrics.scores"""
+    gts, preds, qpreds = [], [], []
+    for i in indices:
+        img, label = dst[i]
+        gts.append(label.numpy() if torch.is_tensor(label) else np.asarray(label))
+        preds.append(_predict(model, img))
+        qpreds.append(_predict(qmodel, img))
+    score, _ = scores(gts, preds, n_classes)
+    qscore, _ = scores(gts, qpreds, n_classes)
+    agreement = np.mean([np.mean(p == q) for p, q in zip(preds, qpreds)])
+    return score, qscore, agreement
+
+
+def load_dataset(dataset, path, split):
+    import os
+    path = os.path.expanduser(path)
+    if dataset == 'CityScapes':
+        from semseg.dataloader.cityscapes_loader import cityscapesLoader
+        return cityscapesLoader(path, split=split, is_transform=True)
+    from semseg.dataloader.camvid_loader import camvidLoader
+    return camvidLoader(path, split=split, is_transform=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='int8 post-training static quantization of the real-time models')
+    parser.add_argument('--structure', type=str, default='ENet', help='use the net structure to segment [ ' + ' '.join(REALTIME_STRUCTURES) + ' ]')
+    parser.add_argument('--model_state_dict', type=str, default='', help='trained float state dict [ ENet_camvid_class_13_100.pt ]')
+    parser.add_argument('--dataset', type=str, default='CamVid', help='calibration and validation dataset [ CamVid CityScapes ]')
+    parser.add_argument('--dataset_path', type=str, default='~/Data/CamVid', help='dataset path [ ~/Data/CamVid ~/Data/cityscapes ]')
+    parser.add_argument('--calib_split', type=str, default='train', help='split of the calibration samples [ train ]')
+    parser.add_argument('--calib_samples', type=int, default=32, help='calibration samples [ 32 ]')
+    parser.add_argument('--eval_samples', type=int, default=0, help='val samples for the mIoU, 0 for all [ 0 ]')
+    parser.add_argument('--backend', type=str, default='', help='quantized engine, empty picks one [ x86 fbgemm qnnpack ]')
+    parser.add_argument('--threads', type=int, default=0, help='cpu threads, 0 for the torch default [ 0 ]')
+    parser.add_argument('--repeat', type=int, default=10, help='timed passes of the latency comparison [ 10 ]')
+    parser.add_argument('--save', type=str, default='', help='save the int8 model as torchscript (or its state dict) to this path')
+    args = parser.parse_args()
+
+    from semseg.benchmark import time_forward
+    from semseg.modelloader import get_model
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    calib_dst = load_dataset(args.dataset, args.dataset_path, args.calib_split)
+    val_dst = load_dataset(args.dataset, args.dataset_path, 'val')
+    n_classes = val_dst.n_classes
+    model = get_model(args.structure, n_classes=n_classes)
+    if args.model_state_dict != '':
+        model.load_state_dict(torch.load(args.model_state_dict, map_location='cpu'))
+    model.eval()
+
+    # 均匀抽取校准样本
+    calib_indices = np.linspace(0, len(calib_dst) - 1, min(args.calib_samples, len(calib_dst))).astype(int)
+    qmodel, leaves = quantize_static(model, (calib_dst[i][0].unsqueeze(0) for i in calib_indices), args.backend)
+    print('backend:', torch.backends.quantized.engine, 'calibration samples:', len(calib_indices))
+    if leaves:
+        print('kept in float (not traceable):', ', '.join(c.__name__ for c in leaves))
+
+    n_eval = len(val_dst) if args.eval_samples <= 0 else min(args.eval_samples, len(val_dst))
+    score, qscore, agreement = compare(model, qmodel, val_dst, range(n_eval), n_classes)
+    for k in score:
+        print('{} fp32 {:.4f} int8 {:.4f} drop {:+.4f}'.format(k.strip(' :\t'), score[k], qscore[k], qscore[k] - score[k]))
+    print('pixel agreement fp32/int8: {:.4f}'.format(agreement))
+
+    img = val_dst[0][0].unsqueeze(0)
+    fp_ms = np.median(time_forward(model, img, 2, args.repeat))
+    q_ms = np.median(time_forward(qmodel, img, 2, args.repeat))
+    print('latency {}: fp32 {:.2f} ms int8 {:.2f} ms speedup {:.2f}x'.format(
+        'x'.join(map(str, img.size())), fp_ms, q_ms, fp_ms / q_ms))
+
+    if args.save != '':
+        try:
+            torch.jit.save(torch.jit.trace(qmodel, img), args.save)
+        except Exception as e:
+            # MaxUnpool2d在部分pytorch版本中无法jit.trace，保存int8的state dict，
+            # 加载时先用quantize_static得到同结构的模型再load_state_dict
+            print('torchscript export failed ({}), saving the int8 state dict instead'.format(type(e).__name__))
+            torch.save(qmodel.state_dict(), args.save)
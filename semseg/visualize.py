@@ -1,26 +1,131 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
+import argparse
+import time
 
 from graphviz import Digraph
 import torch
 from torch.autograd import Variable
 import numpy as np
 
-from semseg.modelloader.fcn import fcn32s
+from semseg.modelloader import get_model
+
+
+def _tensor_bytes(t):
+    return t.numel() * t.element_size()
+
+
+def _format_bytes(n):
+    if n >= 1024 ** 2:
+        return '%.1fMB' % (n / 1024.0 ** 2)
+    return '%.1fKB' % (n / 1024.0)
+
+
+def saved_tensors(var_grad):
+    """Tensors saved for backward by an autograd node, parameters excluded"""
+    tensors = []
+    # 新版pytorch的节点通过_saved_xxx属性暴露保存的张量，旧版为saved_tensors
+    names = [a for a in dir(var_grad) if a.startswith('_saved_')]
+    values = [getattr(var_grad, a, None) for a in names]
+    if hasattr(var_grad, 'saved_tensors'):
+        values.extend(var_grad.saved_tensors)
+    for v in values:
+        for t in (v if isinstance(v, (tuple, list)) else [v]):
+            # 参数本身不算在反向传播额外保存的内存中
+            if torch.is_tensor(t) and not (t.is_leaf and t.requires_grad):
+                tensors.append(t)
+    return tensors
+
+
+def trace_graph(model, input_):
+    """Runs model on input_ and records, for the autograd graph of the output,
+
+    the module that created each node and the forward time (inclusive) and
+    output bytes of every module. Returns (output, stats) for make_dot.
+    """
+    modules = {}
+    nodes = {}
+    starts = {}
+    input_nodes = {}
+    handles = []
+
+    def grad_fns(x):
+        if torch.is_tensor(x):
+            return [x.grad_fn] if x.grad_fn is not None else []
+        if isinstance(x, (tuple, list)):
+            return [fn for t in x for fn in grad_fns(t)]
+        return []
+
+    def out_bytes(x):
+        if torch.is_tensor(x):
+            return _tensor_bytes(x)
+        if isinstance(x, (tuple, list)):
+            return sum(out_bytes(t) for t in x)
+        return 0
+
+    def pre_hook(name):
+        def hook(module, inputs):
+            input_nodes[name] = set(id(fn) for fn in grad_fns(inputs))
+            starts[name] = time.perf_counter()
+        return hook
+
+    def post_hook(name):
+        def hook(module, inputs, output):
+            stats = modules.setdefault(name, {'type': type(module).__name__, 'forward_ms': 0.0,
+                                              'activation_bytes': 0, 'calls': 0})
+            stats['forward_ms'] += (time.perf_counter() - starts[name]) * 1000
+            stats['activation_bytes'] += out_bytes(output)
+            stats['calls'] += 1
+            # 从输出往回遍历到输入为止，其间新建的节点属于该模块，子模块先完成所以先标记
+            stack = grad_fns(output)
+            while stack:
+                fn = stack.pop()
+                if id(fn) in input_nodes[name] or id(fn) in nodes:
+                    continue
+                nodes[id(fn)] = name
+                stack.extend(u[0] for u in fn.next_functions if u[0] is not None)
+        return hook
+
+    for name, m in model.named_modules():
+        handles.append(m.register_forward_pre_hook(pre_hook(name)))
+        handles.append(m.register_forward_hook(post_hook(name)))
+    try:
+        output = model(input_)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return output, {'modules': modules, 'nodes': nodes}
+
+
+def _cost_color(cost, max_cost):
+    # 代价越大颜色越红
+    s = min(cost / max_cost, 1.0) if max_cost > 0 else 0.0
+    return '0.000 %.3f 1.000' % s
+
 
 # 网络模型绘图，生成pytorch autograd图表示，蓝色节点表示要求grad梯度的变量，黄色表示在反向传播的张量
-def make_dot(var, params=None):
+def make_dot(var, params=None, stats=None, color_by='memory', collapse_depth=0):
     """ Produces Graphviz representation of PyTorch autograd graph
     Blue nodes are the Variables that require grad, orange are Tensors
     saved for backward in torch.autograd.Function
     Args:
         var: output Variable
         params: dict of (name, Variable) to add names to node that
-            require grad (TODO: make optional)
+            require grad
+        stats: the stats of trace_graph, adds the module, forward time and
+            activation bytes to the nodes
+        color_by: fill the nodes by 'memory' (saved for backward bytes) or
+            'time' (forward time of their module)
+        collapse_depth: draws every module deeper than collapse_depth as a
+            single node, 0 draws all the nodes
     """
+    param_map = {}
     if params is not None:
-        assert isinstance(params.values()[0], Variable)
+        params = dict(params)
+        assert all(isinstance(v, Variable) for v in params.values())
         param_map = {id(v): k for k, v in params.items()}
+    modules = stats['modules'] if stats is not None else {}
+    node_modules = stats['nodes'] if stats is not None else {}
 
     node_attr = dict(style='filled',
                      shape='box',
@@ -29,38 +134,118 @@ def make_dot(var, params=None):
                      ranksep='0.1',
                      height='0.2')
     dot = Digraph(node_attr=node_attr, graph_attr=dict(size="12,12"))
-    seen = set()
 
     def size_to_str(size):
         return '(' + ', '.join(['%d' % v for v in size]) + ')'
 
-    def add_nodes(var_grad):
-        if var_grad not in seen:
-            if torch.is_tensor(var_grad):
-                dot.node(str(id(var_grad)), size_to_str(var_grad.size()), fillcolor='orange')
-            elif hasattr(var_grad, 'variable'):
-                u = var_grad.variable
-                name = param_map[id(u)] if params is not None else ''
-                node_name = '%s\n %s' % (name, size_to_str(u.size()))
-                dot.node(str(id(var_grad)), node_name, fillcolor='lightblue')
-            else:
-                dot.node(str(id(var_grad)), str(type(var_grad).__name__))
-            seen.add(var_grad)
-            if hasattr(var_grad, 'next_functions'):
-                for u in var_grad.next_functions:
-                    if u[0] is not None:
-                        dot.edge(str(id(u[0])), str(id(var_grad)))
-                        add_nodes(u[0])
-            if hasattr(var_grad, 'saved_tensors'):
-                for t in var_grad.saved_tensors:
-                    dot.edge(str(id(t)), str(id(var_grad)))
-                    add_nodes(t)
-    add_nodes(var.grad_fn)
+    def group_of(var_grad):
+        # 折叠后的节点名，为模块名的前collapse_depth级
+        name = node_modules.get(id(var_grad))
+        if not collapse_depth or name is None or name == '':
+            return None
+        parts = name.split('.')
+        if len(parts) < collapse_depth:
+            return None
+        return '.'.join(parts[:collapse_depth])
+
+    # 先遍历整个图，收集节点、边和每个节点保存的张量
+    nodes = []
+    edges = set()
+    saved = {}
+    seen = set()
+    stack = [var.grad_fn]
+    while stack:
+        var_grad = stack.pop()
+        if var_grad in seen:
+            continue
+        seen.add(var_grad)
+        nodes.append(var_grad)
+        saved[var_grad] = saved_tensors(var_grad)
+        for u in getattr(var_grad, 'next_functions', ()):
+            if u[0] is not None:
+                edges.add((u[0], var_grad))
+                stack.append(u[0])
+
+    def node_id(var_grad):
+        group = group_of(var_grad)
+        return 'group_' + group if group is not None else str(id(var_grad))
+
+    # 同一个张量可能被多个节点保存，按存储去重
+    def unique_bytes(tensors):
+        storages = {}
+        for t in tensors:
+            storages[(t.data_ptr(), tuple(t.size()), t.dtype)] = _tensor_bytes(t)
+        return sum(storages.values())
+
+    groups = {}
+    node_costs = {}
+    for var_grad in nodes:
+        key = node_id(var_grad)
+        groups.setdefault(key, []).append(var_grad)
+    for key, members in groups.items():
+        module = node_modules.get(id(members[0]), '')
+        if key.startswith('group_'):
+            module = key[len('group_'):]
+        # 直接在模型forward中创建的节点不标注整个模型的耗时
+        module_stats = modules.get(module) if module != '' else None
+        if module_stats is None and key.startswith('group_'):
+            # ModuleList等容器本身不会被调用，汇总直接子模块
+            children = [v for k, v in modules.items()
+                        if k.startswith(module + '.') and '.' not in k[len(module) + 1:]]
+            if children:
+                module_stats = {'type': children[0]['type'],
+                                'forward_ms': sum(c['forward_ms'] for c in children),
+                                'activation_bytes': sum(c['activation_bytes'] for c in children)}
+        saved_bytes = unique_bytes([t for m in members for t in saved[m]])
+        forward_ms = module_stats['forward_ms'] if module_stats is not None else 0.0
+        node_costs[key] = (saved_bytes, forward_ms, module, module_stats)
+
+    max_cost = max([c[0] if color_by == 'memory' else c[1] for c in node_costs.values()] + [0])
+    for key, members in groups.items():
+        saved_bytes, forward_ms, module, module_stats = node_costs[key]
+        var_grad = members[0]
+        if key.startswith('group_'):
+            label = '%s\n%s x%d nodes' % (module, module_stats['type'] if module_stats else '', len(members))
+        elif hasattr(var_grad, 'variable'):
+            u = var_grad.variable
+            name = param_map.get(id(u), '')
+            dot.node(key, '%s\n %s' % (name, size_to_str(u.size())), fillcolor='lightblue')
+            continue
+        else:
+            label = str(type(var_grad).__name__)
+            if module != '':
+                label += '\n' + module
+        if module_stats is not None:
+            label += '\nfwd %.2fms act %s' % (forward_ms, _format_bytes(module_stats['activation_bytes']))
+        if saved_bytes > 0:
+            label += '\nsaved %s' % _format_bytes(saved_bytes)
+        cost = saved_bytes if color_by == 'memory' else forward_ms
+        dot.node(key, label, fillcolor=_cost_color(cost, max_cost) if stats is not None or saved_bytes > 0 else 'white')
+
+    drawn = set()
+    for u, v in edges:
+        edge = (node_id(u), node_id(v))
+        if edge[0] != edge[1] and edge not in drawn:
+            drawn.add(edge)
+            dot.edge(*edge)
+
+    total_saved = unique_bytes([t for ts in saved.values() for t in ts])
+    dot.attr(label='saved for backward %s' % _format_bytes(total_saved))
     return dot
 
+
+def export_graph(model, input_size, color_by='memory', collapse_depth=0):
+    """Traces model on random input_size and returns the annotated graph"""
+    x = Variable(torch.randn(*input_size))
+    pred, stats = trace_graph(model, x)
+    pred = pred[0] if isinstance(pred, (tuple, list)) else pred
+    return make_dot(pred, params=dict(model.named_parameters()), stats=stats, color_by=color_by,
+                    collapse_depth=collapse_depth)
+
+
 def main():
     n_classes = 21
-    model = fcn32s(n_classes=n_classes)
+    model = get_model('fcn32s', n_classes=n_classes)
     x = Variable(torch.randn(1, 3, 360, 480))
     pred = model(x)
     g = make_dot(pred)
@@ -68,5 +253,22 @@ def main():
     g.render('model_vis.gv', view=True)
 
 
+# python -m semseg.visualize --structure fcdensenet103 --resolution 224x224 --collapse_depth 2
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='annotated autograd graph of a modelloader model')
+    parser.add_argument('--structure', type=str, default='fcn32s', help='use the net structure to segment [ fcn32s ]')
+    parser.add_argument('--n_classes', type=int, default=21, help='class num [ 21 ]')
+    parser.add_argument('--resolution', type=str, default='360x480', help='HxW input size [ 360x480 ]')
+    parser.add_argument('--color_by', type=str, default='memory', help='node color by [ memory time ]')
+    parser.add_argument('--collapse_depth', type=int, default=0, help='draw the modules deeper than N as one node, 0 keeps all [ 0 ]')
+    parser.add_argument('--output', type=str, default='model_vis.gv', help='graphviz output path [ model_vis.gv ]')
+    parser.add_argument('--view', type=bool, default=False, help='render and open the graph [ False ]')
+    args = parser.parse_args()
+
+    model = get_model(args.structure, n_classes=args.n_classes)
+    h, w = [int(v) for v in args.resolution.split('x')]
+    g = export_graph(model, (1, 3, h, w), color_by=args.color_by, collapse_depth=args.collapse_depth)
+    if args.view:
+        g.render(args.output, view=True)
+    else:
+        g.save(args.output)
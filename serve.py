@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# 本地HTTP推理服务：模型只加载一次，asyncio接收请求，并发的请求合并为micro-batch
+# (最多max_batch_size张，第一张到达后最多等待max_wait_ms)，在专用的单个线程中前向，
+# 返回调色板PNG、rle、packbits(见semseg.mask_encoding)或原始uint8标签图；
+# GET /metrics返回排队数、batch大小分布和延迟分位数
+# python serve.py --structure ENet --model_state_dict ENet_camvid_class_13_100.pt --port 8080
+# curl --data-binary @image.png http://127.0.0.1:8080/predict -o mask.png
+# curl http://127.0.0.1:8080/metrics
+import argparse
+import asyncio
+import collections
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+from predict import Preprocessor, dataset_constants, load_model
+from semseg.dataloader.utils import normalize_batch
+from semseg.inference import OOMFallbackPredictor, model_output
+from semseg.mask_encoding import encode_mask, MASK_FORMATS as ENCODED_FORMATS
+
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+MASK_FORMATS = ENCODED_FORMATS + ['raw']
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=''):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+def _percentiles(values):
+    if len(values) == 0:
+        return {}
+    values = np.asarray(values, dtype=np.float64)
+    return {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99)), 'max': float(values.max())}
+
+
+class ServerMetrics(object):
+    """Counters, batch size histogram and latency percentiles over the last window requests"""
+
+    def __init__(self, window=1000):
+        self.start_time = time.time()
+        self.requests = 0
+        self.errors = collections.Counter()
+        self.batches = 0
+        self.batch_sizes = collections.Counter()
+        self.latency_ms = collections.deque(maxlen=window)
+        self.queue_ms = collections.deque(maxlen=window)
+        self.forward_ms = collections.deque(maxlen=window)
+
+    def record_batch(self, size, forward_ms, queue_ms):
+        self.batches += 1
+        self.batch_sizes[size] += 1
+        self.forward_ms.append(forward_ms)
+        self.queue_ms.extend(queue_ms)
+
+    def record_request(self, latency_ms):
+        self.requests += 1
+        self.latency_ms.append(latency_ms)
+
+    def record_error(self, status):
+        self.errors[status] += 1
+
+    def snapshot(self, queue_depth):
+        images = sum(size * n for size, n in self.batch_sizes.items())
+        return {
+            'uptime_s': time.time() - self.start_time,
+            'requests': self.requests,
+            'errors': dict((str(k), v) for k, v in self.errors.items()),
+            'queue_depth': queue_depth,
+            'batches': self.batches,
+            'mean_batch_size': images / float(self.batches) if self.batches else 0.0,
+            'batch_size_histogram': dict((str(k), v) for k, v in sorted(self.batch_sizes.items())),
+            # 请求总延迟、排队等待(进入队列到开始前向)和每个batch的前向耗时，单位ms
+            'latency_ms': _percentiles(self.latency_ms),
+            'queue_wait_ms': _percentiles(self.queue_ms),
+            'batch_forward_ms': _percentiles(self.forward_ms),
+        }
+
+
+class MicroBatcher(object):
+    """Gathers concurrent requests into batches for run_batch
+
+    A batch is closed when max_batch_size items are waiting or max_wait_ms after
+    its first item arrived. run_batch(items) runs in one dedicated thread, so
+    the model is only ever called from that thread. Beyond max_queue waiting
+    items submit raises HTTPError 503.
+    """
+
+    def __init__(self, run_batch, metrics, max_batch_size=8, max_wait_ms=10.0, max_queue=64):
+        self.run_batch = run_batch
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise HTTPError(503, 'queue is full')
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [b[0] for b in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            self.metrics.record_batch(len(batch), (time.perf_counter() - start) * 1000,
+                                      [(start - b[2]) * 1000 for b in batch])
+            for (_, future, _), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+class SegmentationService(object):
+    """Decodes the request images, predicts micro-batches and encodes the masks"""
+
+    def __init__(self, model, mean, img_norm, palette, device, img_size=None):
+        self.model = model
+        self.mean = mean
+        self.img_norm = img_norm
+        self.palette = palette
+        self.device = device
+        self.preprocess = Preprocessor(img_size)
+        # 显存/内存不足时自动减半batch
+        self.predictor = OOMFallbackPredictor(lambda imgs: model_output(self.model(imgs)))
+
+    def decode(self, body):
+        try:
+            chw, size, _ = self.preprocess(io.BytesIO(body))
+        except Exception as e:
+            raise HTTPError(400, 'cannot decode the image: {}'.format(e))
+        return chw, size
+
+    def run_batch(self, items):
+        """Masks of the (chw, size) items, images of the same size are forwarded together"""
+        groups = collections.OrderedDict()
+        for i, (chw, _) in enumerate(items):
+            groups.setdefault(tuple(chw.size()), []).append(i)
+        masks = [None] * len(items)
+        with torch.no_grad():
+            for indices in groups.values():
+                imgs = torch.stack([items[i][0] for i in indices]).to(self.device)
+                imgs = normalize_batch(imgs, self.mean, self.img_norm)
+                preds = self.predictor(imgs).max(1)[1].to(torch.uint8).cpu().numpy()
+                for i, pred in zip(indices, preds):
+                    masks[i] = pred
+        return masks
+
+    def encode(self, mask, size, fmt='png'):
+        """(content type, body) of the mask at the image size"""
+        img = Image.fromarray(mask)
+        if tuple(mask.shape) != tuple(size):
+            img = img.resize((size[1], size[0]), Image.NEAREST)
+        if fmt == 'raw':
+            # 行优先的uint8标签，大小见X-Mask-Shape
+            return 'application/octet-stream', np.asarray(img).tobytes()
+        data = encode_mask(np.asarray(img), fmt, self.palette)
+        return 'image/png' if fmt == 'png' else 'application/octet-stream', data
+
+    def warmup(self, img_size):
+        chw = torch.zeros((3,) + tuple(img_size), dtype=torch.uint8)
+        self.run_batch([(chw, img_size)])
+
+
+class InferenceServer(object):
+    """Minimal HTTP/1.1 server on asyncio streams
+
+    POST /predict   image bytes in the body, ?format=png|rle|packbits|raw, returns the mask
+    GET  /metrics   json metrics
+    GET  /health    ok
+    """
+
+    def __init__(self, service, max_batch_size=8, max_wait_ms=10.0, max_queue=64, max_body_mb=32):
+        self.service = service
+        self.metrics = ServerMetrics()
+        self.batcher_args = (max_batch_size, max_wait_ms, max_queue)
+        # python 3.10之前asyncio.Queue在创建时绑定事件循环，batcher在serve中运行的循环上创建
+        self.batcher = None
+        self.max_body = int(max_body_mb * 1024 * 1024)
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise HTTPError(400, 'bad request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', '0'))
+        if length > self.max_body:
+            raise HTTPError(413, 'body larger than {} bytes'.format(self.max_body))
+        body = await reader.readexactly(length) if length > 0 else b''
+        return parts[0].upper(), parts[1], parts[2], headers, body
+
+    async def _write_response(self, writer, status, content_type, body, keep_alive, extra_headers=None):
+        lines = ['HTTP/1.1 {} {}'.format(status, HTTP_STATUS.get(status, '')),
+                 'Content-Type: ' + content_type,
+                 'Content-Length: {}'.format(len(body)),
+                 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        for key, value in (extra_headers or {}).items():
+            lines.append('{}: {}'.format(key, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def predict(self, query, body):
+        loop = asyncio.get_running_loop()
+        fmt = query.get('format', ['png'])[0]
+        if fmt not in MASK_FORMATS:
+            raise HTTPError(400, 'unknown format {}, use {}'.format(fmt, ' or '.join(MASK_FORMATS)))
+        # 解码和编码在默认线程池中进行，不阻塞事件循环，前向只在batcher的线程中
+        chw, size = await loop.run_in_executor(None, self.service.decode, body)
+        mask = await self.batcher.submit((chw, size))
+        content_type, data = await loop.run_in_executor(None, self.service.encode, mask, size, fmt)
+        return content_type, data, {'X-Mask-Shape': '{}x{}'.format(size[0], size[1])}
+
+    async def handle(self, method, target, body):
+        url = urlparse(target)
+        if url.path == '/predict':
+            if method != 'POST':
+                raise HTTPError(405, 'use POST with the image bytes as body')
+            start = time.perf_counter()
+            response = await self.predict(parse_qs(url.query), body)
+            self.metrics.record_request((time.perf_counter() - start) * 1000)
+            return response
+        if url.path == '/metrics' and method == 'GET':
+            data = json.dumps(self.metrics.snapshot(self.batcher.queue.qsize()), indent=2).encode('utf-8')
+            return 'application/json', data, None
+        if url.path == '/health' and method == 'GET':
+            return 'text/plain', b'ok', None
+        raise HTTPError(404, 'unknown path {}'.format(url.path))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, target, version, headers, body = request
+                    # HTTP/1.1默认保持连接
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+                    content_type, data, extra = await self.handle(method, target, body)
+                    await self._write_response(writer, 200, content_type, data, keep_alive, extra)
+                except HTTPError as e:
+                    self.metrics.record_error(e.status)
+                    await self._write_response(writer, e.status, 'text/plain', str(e).encode('utf-8'), keep_alive)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    self.metrics.record_error(500)
+                    await self._write_response(writer, 500, 'text/plain', str(e).encode('utf-8'), False)
+                    break
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.batcher = MicroBatcher(self.service.run_batch, self.metrics, *self.batcher_args)
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print('serving on http://{}:{}'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+            self.batcher.executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local HTTP segmentation server with micro-batching')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='listen address [ 127.0.0.1 ]')
+    parser.add_argument('--port', type=int, default=8080, help='listen port [ 8080 ]')
+    parser.add_argument('--structure', type=str, default='ENet', help='use the net structure to segment [ ENet fcn32s segnet erfnet ]')
+    parser.add_argument('--model_state_dict', type=str, default='', help='model state dict path [ ENet_camvid_class_13_100.pt ]')
+    parser.add_argument('--torchscript', type=str, default='', help='TorchScript model exported by semseg.export, replaces structure')
+    parser.add_argument('--dataset', type=str, default='CamVid', help='mean and palette of the training dataset [ CamVid CityScapes ]')
+    parser.add_argument('--n_classes', type=int, default=0, help='class num, 0 for the dataset class num [ 0 ]')
+    parser.add_argument('--img_size', type=str, default='', help='HxW the images are resized to, the masks keep the image size, empty keeps it')
+    parser.add_argument('--max_batch_size', type=int, default=8, help='max images per forward [ 8 ]')
+    parser.add_argument('--max_wait_ms', type=float, default=10.0, help='max wait for more requests after the first of a batch [ 10 ]')
+    parser.add_argument('--max_queue', type=int, default=64, help='waiting requests beyond it are rejected with 503 [ 64 ]')
+    parser.add_argument('--max_body_mb', type=float, default=32, help='max request body size [ 32 ]')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 for the torch default [ 0 ]')
+    parser.add_argument('--fuse_bn', type=bool, default=False, help='fold BatchNorm into the convolutions [ False ]')
+    parser.add_argument('--cuda', type=bool, default=False, help='use cuda [ False ]')
+    args = parser.parse_args()
+    print(args)
+
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    mean, img_norm, palette, n_classes = dataset_constants(args.dataset)
+    n_classes = args.n_classes if args.n_classes > 0 else n_classes
+    img_size = tuple(int(v) for v in args.img_size.split('x')) if args.img_size != '' else None
+    service = SegmentationService(load_model(args, n_classes, device), mean, img_norm, palette, device, img_size)
+    if img_size is not None:
+        # 第一个请求不承担初始化的耗时
+        service.warmup(img_size)
+    server = InferenceServer(service, args.max_batch_size, args.max_wait_ms, args.max_queue, args.max_body_mb)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -3,47 +3,55 @@ import torch
 import os
 import argparse
 
-import cv2
 import time
 import numpy as np
-import visdom
 from torch.autograd import Variable
+from torch.utils.data.dataloader import default_collate
 
+from semseg.dataloader.batch_augment import AugmentCollate, BatchJointAugment
 from semseg.dataloader.camvid_loader import camvidLoader
 from semseg.dataloader.cityscapes_loader import cityscapesLoader
+from semseg.dataloader.packed_loader import ShardedSegDataset
+from semseg.dataloader.utils import normalize_batch
 from semseg.loss import cross_entropy2d
-from semseg.modelloader.drn import drn_d_22, DRNSeg
-from semseg.modelloader.duc_hdc import ResNetDUC, ResNetDUCHDC
-from semseg.modelloader.enet import ENet
-from semseg.modelloader.enetv2 import ENetV2
-from semseg.modelloader.erfnet import erfnet
-from semseg.modelloader.fc_densenet import fcdensenet103, fcdensenet56
-from semseg.modelloader.fcn import fcn
-from semseg.modelloader.fcn_resnet import fcn_resnet18, fcn_resnet34
-from semseg.modelloader.pspnet import pspnet
-from semseg.modelloader.segnet import segnet, segnet_squeeze, segnet_alignres, segnet_vgg19
-from semseg.modelloader.segnet_unet import segnet_unet
-from semseg.modelloader.sqnet import sqnet
+from semseg.modelloader import get_model
+from semseg.profiler import ModuleProfiler
 
 
 def train(args):
     init_time = str(int(time.time()))
     if args.vis:
+        import visdom
         vis = visdom.Visdom()
     # if args.dataset_path == '':
     #     HOME_PATH = os.path.expanduser('~')
     #     local_path = os.path.join(HOME_PATH, 'Data/CamVid')
     # else:
     local_path = os.path.expanduser(args.dataset_path)
-    if args.dataset == 'CamVid':
-        dst = camvidLoader(local_path, is_transform=True, is_augment=args.data_augment)
+    if args.dataset_format == 'packed':
+        # dataset_path为packed_loader打包后的目录
+        dst = ShardedSegDataset(local_path, is_transform=True, img_uint8=args.img_uint8)
+    elif args.dataset == 'CamVid':
+        dst = camvidLoader(local_path, is_transform=True, img_uint8=args.img_uint8)
     elif args.dataset == 'CityScapes':
-        dst = cityscapesLoader(local_path, is_transform=True)
+        label_cache = os.path.expanduser(args.label_cache) if args.label_cache != '' else None
+        dst = cityscapesLoader(local_path, is_transform=True, label_cache=label_cache, img_uint8=args.img_uint8)
     else:
         pass
 
     # dst.n_classes = args.n_classes # 保证输入的class
-    trainloader = torch.utils.data.DataLoader(dst, batch_size=args.batch_size, shuffle=True)
+    collate_fn = default_collate
+    if args.data_augment:
+        # 数据增强在collate阶段对整个batch进行：随机水平翻转和[-90, 90]度旋转，对所有数据集生效
+        # 旋转后图像外的区域和原来PIL旋转一样补黑色：uint8图像在collate之后才减均值，黑色为0；
+        # float图像已经减过均值(和/255)，黑色为-mean(/255)
+        if args.img_uint8:
+            fill = 0
+        else:
+            fill = -np.asarray(dst.mean, dtype=np.float64) / (255.0 if getattr(dst, 'img_norm', True) else 1.0)
+            fill = fill.tolist()
+        collate_fn = AugmentCollate(BatchJointAugment(flip=True, degree=90, fill=fill))
+    trainloader = torch.utils.data.DataLoader(dst, batch_size=args.batch_size, shuffle=True, collate_fn=collate_fn)
 
     start_epoch = 0
     if args.resume_model != '':
@@ -52,60 +60,8 @@ def train(args):
         start_epoch_id2 = args.resume_model.rfind('.')
         start_epoch = int(args.resume_model[start_epoch_id1+1:start_epoch_id2])
     else:
-        if args.structure == 'fcn32s':
-            model = fcn(module_type='32s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn16s':
-            model = fcn(module_type='16s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn8s':
-            model = fcn(module_type='8s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn_resnet18_32s':
-            model = fcn_resnet18(module_type='32s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn_resnet18_16s':
-            model = fcn_resnet18(module_type='16s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn_resnet18_8s':
-            model = fcn_resnet18(module_type='8s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn_resnet34_32s':
-            model = fcn_resnet34(module_type='32s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn_resnet34_16s':
-            model = fcn_resnet34(module_type='16s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'fcn_resnet34_8s':
-            model = fcn_resnet34(module_type='8s', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'ResNetDUC':
-            model = ResNetDUC(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'ResNetDUCHDC':
-            model = ResNetDUCHDC(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'segnet':
-            model = segnet(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'segnet_vgg19':
-            model = segnet_vgg19(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'segnet_unet':
-            model = segnet_unet(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'segnet_alignres':
-            model = segnet_alignres(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'sqnet':
-            model = sqnet(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'segnet_squeeze':
-            model = segnet_squeeze(n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'ENet':
-            model = ENet(n_classes=dst.n_classes)
-        elif args.structure == 'ENetV2':
-            model = ENetV2(n_classes=dst.n_classes)
-        elif args.structure == 'drn_d_22':
-            model = DRNSeg(model_name='drn_d_22', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'drn_a_50':
-            model = DRNSeg(model_name='drn_a_50', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'drn_a_18':
-            model = DRNSeg(model_name='drn_a_18', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'drn_e_22':
-            model = DRNSeg(model_name='drn_e_22', n_classes=dst.n_classes, pretrained=args.init_vgg16)
-        elif args.structure == 'pspnet':
-            model = pspnet(n_classes=dst.n_classes)
-        elif args.structure == 'erfnet':
-            model = erfnet(n_classes=dst.n_classes)
-        elif args.structure == 'fcdensenet103':
-            model = fcdensenet103(n_classes=dst.n_classes)
-        elif args.structure == 'fcdensenet56':
-            model = fcdensenet56(n_classes=dst.n_classes)
+        # 只导入所选结构的模块
+        model = get_model(args.structure, n_classes=dst.n_classes, pretrained=args.init_vgg16)
         if args.resume_model_state_dict != '':
             try:
                 # fcn32s、fcn16s和fcn8s模型略有增加参数，互相赋值重新训练过程中会有KeyError，暂时捕捉异常处理
@@ -129,6 +85,10 @@ def train(args):
     print('start_epoch:', start_epoch)
     optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad, model.parameters()), lr=args.lr, momentum=0.99, weight_decay=5e-4)
     # optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-4)
+    profiler = None
+    if args.profile > 0:
+        # 统计前args.profile次迭代中各模块的前向和反向耗时，输出后结束训练
+        profiler = ModuleProfiler(model, sync=args.cuda).start()
     for epoch in range(start_epoch+1, 20000, 1):
         loss_epoch = 0
         loss_avg_epoch = 0
@@ -147,6 +107,9 @@ def train(args):
             if args.cuda:
                 imgs = imgs.cuda()
                 labels = labels.cuda()
+            if args.img_uint8:
+                # uint8图像在拷贝到设备之后再按batch减均值和归一化，loader已减过均值时(ADE20K)用raw_mean
+                imgs = normalize_batch(imgs, getattr(dst, 'raw_mean', dst.mean), getattr(dst, 'img_norm', True))
             outputs = model(imgs)
 
             if args.vis and i%50==0:
@@ -184,6 +147,15 @@ def train(args):
 
             optimizer.step()
 
+            if profiler is not None:
+                profiler.step()
+                if profiler.iterations >= args.profile:
+                    profiler.stop()
+                    print(profiler.table())
+                    if args.profile_trace != '':
+                        profiler.export_chrome_trace(args.profile_trace)
+                    return
+
             # 显示一个周期的loss曲线
             if args.vis:
                 win = 'loss'
@@ -224,12 +196,17 @@ if __name__=='__main__':
     parser.add_argument('--init_vgg16', type=bool, default=False, help='init model using vgg16 weights [ False ]')
     parser.add_argument('--dataset', type=str, default='CamVid', help='train dataset [ CamVid CityScapes ]')
     parser.add_argument('--dataset_path', type=str, default='~/Data/CamVid', help='train dataset path [ ~/Data/CamVid ~/Data/cityscapes ]')
-    parser.add_argument('--data_augment', type=bool, default=False, help='enlarge the training data [ False ]')
+    parser.add_argument('--dataset_format', type=str, default='raw', help='dataset format, packed reads the shards written by python -m semseg.dataloader.packed_loader [ raw packed ]')
+    parser.add_argument('--label_cache', type=str, default='', help='preprocessed label cache directory, build it with python -m semseg.dataloader.label_cache [ ~/Data/cityscapes/label_cache ]')
+    parser.add_argument('--data_augment', type=bool, default=False, help='enlarge the training data with random flip and rotation of every batch, for every dataset (previously CamVid only) [ False ]')
+    parser.add_argument('--img_uint8', type=bool, default=False, help='load uint8 images and normalize them per batch [ False ]')
     parser.add_argument('--batch_size', type=int, default=1, help='train dataset batch size [ 1 ]')
     # parser.add_argument('--n_classes', type=int, default=13, help='train class num [ 13 ]')
     parser.add_argument('--lr', type=float, default=1e-5, help='train learning rate [ 0.00001 ]')
     parser.add_argument('--vis', type=bool, default=False, help='visualize the training results [ False ]')
     parser.add_argument('--cuda', type=bool, default=False, help='use cuda [ False ]')
+    parser.add_argument('--profile', type=int, default=0, help='profile the modules over N iterations and stop, 0 disables [ 0 ]')
+    parser.add_argument('--profile_trace', type=str, default='', help='export the profile as a chrome trace to this path')
     args = parser.parse_args()
     # print(args.resume_model)
     # print(args.save_model)
@@ -1,129 +1,228 @@
 # -*- coding: utf-8 -*-
 import argparse
+import multiprocessing
 
 import torch
 import os
 
 from torch.autograd import Variable
-import visdom
-from scipy import misc
-from requests import ConnectionError
 import numpy as np
 import time
+from PIL import Image
 
 from semseg.dataloader.camvid_loader import camvidLoader
-from semseg.metrics import scores
-from semseg.modelloader.drn import DRNSeg
-from semseg.modelloader.duc_hdc import ResNetDUC
-from semseg.modelloader.enet import ENet
-from semseg.modelloader.fcn import fcn
-from semseg.modelloader.segnet import segnet
-from semseg.modelloader.erfnet import erfnet
-from semseg.modelloader.pspnet import pspnet
+from semseg.dataloader.cityscapes_loader import cityscapesLoader
+from semseg.dataloader.packed_loader import ShardedSegDataset
+from semseg.dataloader.utils import blend_segmap, normalize_batch, PadCollate
+from semseg.inference import SlidingWindowPredictor, MultiScalePredictor, OOMFallbackPredictor
+from semseg.mask_encoding import MASK_FORMATS, save_mask
+from semseg.metrics import StreamingSegMetrics
+from semseg.modelloader import get_model
+from semseg.modelloader.fusion import optimize_for_inference
+from semseg.profiler import ModuleProfiler
 
 
-def validate(args):
-    init_time = str(int(time.time()))
-    if args.vis:
-        vis = visdom.Visdom()
+def load_dataset(args):
     if args.dataset_path == '':
         HOME_PATH = os.path.expanduser('~')
-        local_path = os.path.join(HOME_PATH, 'Data/CamVid')
+        local_path = os.path.join(HOME_PATH, 'Data/CamVid' if args.dataset == 'CamVid' else 'Data/cityscapes')
     else:
         local_path = args.dataset_path
-    dst = camvidLoader(local_path, is_transform=True, split='val')
-    dst.n_classes = args.n_classes  # 保证输入的class
-    valloader = torch.utils.data.DataLoader(dst, batch_size=1)
+    if args.dataset_format == 'packed':
+        # dataset_path为packed_loader打包后的val目录
+        dst = ShardedSegDataset(os.path.expanduser(local_path), is_transform=True, img_uint8=args.img_uint8)
+    elif args.dataset == 'CityScapes':
+        # 滑窗推理时使用全分辨率的图像和标签
+        img_size = (1024, 2048) if args.sliding_window else (512, 1024)
+        dst = cityscapesLoader(local_path, is_transform=True, split='val', img_size=img_size, img_uint8=args.img_uint8)
+    else:
+        dst = camvidLoader(local_path, is_transform=True, split='val', img_uint8=args.img_uint8)
+    # 类别数默认取数据集的类别数，和数据集不一致时StreamingSegMetrics会忽略多出的标签，指标没有意义
+    if args.n_classes > 0 and args.n_classes != dst.n_classes:
+        raise ValueError('--n_classes {} does not match the {} classes of {}'.format(
+            args.n_classes, dst.n_classes, local_path if args.dataset_format == 'packed' else args.dataset))
+    return dst
+
 
+def load_model(args, n_classes):
     # if os.path.isfile(args.validate_model):
     if args.validate_model != '':
         model = torch.load(args.validate_model)
     else:
-        if args.structure == 'fcn32s':
-            model = fcn(module_type='32s', n_classes=dst.n_classes)
-        elif args.structure == 'fcn16s':
-            model = fcn(module_type='16s', n_classes=dst.n_classes)
-        elif args.structure == 'fcn8s':
-            model = fcn(module_type='8s', n_classes=dst.n_classes)
-        elif args.structure == 'ResNetDUC':
-            model = ResNetDUC(n_classes=dst.n_classes)
-        elif args.structure == 'segnet':
-            model = segnet(n_classes=dst.n_classes)
-        elif args.structure == 'ENet':
-            model = ENet(n_classes=dst.n_classes)
-        elif args.structure == 'drn_d_22':
-            model = DRNSeg(model_name='drn_d_22', n_classes=dst.n_classes)
-        elif args.structure == 'pspnet':
-            model = pspnet(n_classes=dst.n_classes, use_aux=False)
-        elif args.structure == 'erfnet':
-            model = erfnet(n_classes=dst.n_classes)
+        model = get_model(args.structure, n_classes=n_classes)
         if args.validate_model_state_dict != '':
             try:
                 model.load_state_dict(torch.load(args.validate_model_state_dict))
             except KeyError:
                 print('missing key')
     model.eval()
+    if args.fuse_bn:
+        # BatchNorm折叠到卷积中，输出和原模型一致
+        model = optimize_for_inference(model)
+    return model
+
+
+def load_predictor(args, n_classes, model=None):
+    if model is None:
+        model = load_model(args, n_classes)
+    predictor = model
+    if args.sliding_window:
+        predictor = SlidingWindowPredictor(model, n_classes, args.crop_size, stride_rate=args.stride_rate,
+                                           flip=args.tile_flip, blend=args.tile_blend,
+                                           tile_batch_size=args.tile_batch_size)
+    scales = [float(scale) for scale in args.scales.split(',')]
+    if scales != [1.0] or args.flip:
+        # 多尺度和翻转测试，尺度依次处理
+        predictor = MultiScalePredictor(predictor, n_classes, scales=scales, flip=args.flip,
+                                        fusion=args.tta_fusion)
+    # 显存/内存不足时自动减半batch
+    return OOMFallbackPredictor(predictor)
+
+
+def sample_name(dst, index):
+    """Output file name of sample index of dst: the image file name, or the index for loaders without it"""
+    if hasattr(dst, 'sample_paths'):
+        path = dst.sample_paths(index)[0]
+    elif isinstance(getattr(dst, 'files', None), dict) and getattr(dst, 'split', None) in dst.files:
+        path = dst.files[dst.split][index]
+    else:
+        return '{:06d}'.format(index)
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def evaluate(args, dst, predictor, indices=None, vis=None, init_time=None, profiler=None):
+    """Evaluates predictor on dst (or the subset indices), returns a StreamingSegMetrics
+
+    With a started profiler only the first args.profile batches are evaluated.
+    With args.mask_format the predicted masks (and with args.blend the blends) are
+    saved to args.output_dir, named after their samples.
+    """
+    if indices is not None:
+        dst_eval = torch.utils.data.Subset(dst, indices)
+    else:
+        dst_eval = dst
+    # 不同大小的图像pad到同一大小，标签的pad区域为250，pad的像素不计入指标；
+    # 但补0改变了下/右边缘附近的感受野，发生pad时边缘的预测(和指标)可能和batch_size=1时不同
+    valloader = torch.utils.data.DataLoader(dst_eval, batch_size=args.batch_size,
+                                            collate_fn=PadCollate(ignore_index=250, size_divisor=args.size_divisor,
+                                                                  return_sizes=True))
 
-    gts, preds = [], []
-    for i, (imgs, labels) in enumerate(valloader):
+    # 只保存混淆矩阵，内存不随数据集大小增长
+    metrics = StreamingSegMetrics(n_class=dst.n_classes, ignore_index=250)
+    for i, (imgs, labels, sizes) in enumerate(valloader):
         print(i)
         #  print(labels.shape)
         #  print(imgs.shape)
         # 将np变量转换为pytorch中的变量
+        if args.img_uint8:
+            # uint8图像按batch减均值和归一化，loader已减过均值时(ADE20K)用raw_mean
+            imgs = normalize_batch(imgs, getattr(dst, 'raw_mean', dst.mean), getattr(dst, 'img_norm', True))
         imgs = Variable(imgs)
         labels = Variable(labels)
 
-        outputs = model(imgs)
+        outputs = predictor(imgs)
         # 取axis=1中的最大值，outputs的shape为batch_size*n_classes*height*width，
         # 获取max后，返回两个数组，分别是最大值和相应的索引值，这里取索引值为label
-        pred = outputs.data.max(1)[1].numpy()
+        # uint8标签每个像素1字节，int64为8字节
+        pred = outputs.data.max(1)[1]
+        pred = (pred.to(torch.uint8) if dst.n_classes <= 256 else pred).numpy()
         gt = labels.data.numpy()
         # print(pred.dtype)
         # print(gt.dtype)
         # print('pred.shape:', pred.shape)
         # print('gt.shape:', gt.shape)
 
-        if args.vis and i % 1 == 0:
-            img = imgs.data.numpy()[0]
-            # print(img.shape)
-            label_color = dst.decode_segmap(gt[0]).transpose(2, 0, 1)
-            # print(label_color.shape)
-            pred_label_color = dst.decode_segmap(pred[0]).transpose(2, 0, 1)
-            # print(pred_label_color.shape)
-            # try:
-            #     win = 'label_color'
-            #     vis.image(label_color, win=win)
-            #     win = 'pred_label_color'
-            #     vis.image(pred_label_color, win=win)
-            # except ConnectionError:
-            #     print('ConnectionError')
-
-
-            if args.blend:
-                img_hwc = img.transpose(1, 2, 0)
-                img_hwc = img_hwc*255.0
-                img_hwc += np.array([104.00699, 116.66877, 122.67892])
-                img_hwc = np.array(img_hwc, dtype=np.uint8)
-                # label_color_hwc = label_color.transpose(1, 2, 0)
-                pred_label_color_hwc = pred_label_color.transpose(1, 2, 0)
-                pred_label_color_hwc = np.array(pred_label_color_hwc, dtype=np.uint8)
-                # print(img_hwc.dtype)
-                # print(pred_label_color_hwc.dtype)
-                label_blend = img_hwc * 0.5 + pred_label_color_hwc * 0.5
-                label_blend = np.array(label_blend, dtype=np.uint8)
-
-                if not os.path.exists('/tmp/' + init_time):
-                    os.mkdir('/tmp/' + init_time)
-                time_str = str(int(time.time()))
-
-                misc.imsave('/tmp/'+init_time+'/'+time_str+'_label_blend.png', label_blend)
-
-        for gt_, pred_ in zip(gt, pred):
-            gts.append(gt_)
-            preds.append(pred_)
-
-
-    score, class_iou = scores(gts, preds, n_class=dst.n_classes)
+        # 文件名由样本决定，多次运行和多进程校验的结果相同
+        names = [sample_name(dst, k if indices is None else indices[k])
+                 for k in range(i * args.batch_size, i * args.batch_size + len(pred))]
+        if args.mask_format != '':
+            # 去掉PadCollate的pad，保存每个样本原来大小的mask
+            for name, mask, (h, w) in zip(names, pred, sizes):
+                save_mask(os.path.join(args.output_dir, name), mask[:h, :w], args.mask_format, dst.palette)
+
+        # if vis is not None:
+        #     try:
+        #         win = 'label_color'
+        #         vis.image(dst.decode_segmap(gt[0]).transpose(2, 0, 1), win=win)
+        #         win = 'pred_label_color'
+        #         vis.image(dst.decode_segmap(pred[0]).transpose(2, 0, 1), win=win)
+        #     except ConnectionError:
+        #         print('ConnectionError')
+
+        if args.blend:
+            # 整个batch的预测一次解码并和原图blend
+            img_hwc = imgs.data.numpy().transpose(0, 2, 3, 1)
+            img_hwc = img_hwc*255.0
+            img_hwc += dst.mean
+            img_hwc = np.array(img_hwc, dtype=np.uint8)
+            label_blends = blend_segmap(img_hwc, pred, dst.palette)
+
+            for name, label_blend, (h, w) in zip(names, label_blends, sizes):
+                Image.fromarray(label_blend[:h, :w]).save(os.path.join(args.output_dir, name + '_label_blend.png'))
+
+        metrics.update(gt, pred)
+        if profiler is not None:
+            profiler.step()
+            if profiler.iterations >= args.profile:
+                break
+    return metrics
+
+
+def validate_shard(args, indices):
+    """Process pool worker: evaluates one shard of the val split with its own model copy"""
+    torch.set_num_threads(args.threads)
+    dst = load_dataset(args)
+    predictor = load_predictor(args, dst.n_classes)
+    return evaluate(args, dst, predictor, indices=indices).hist
+
+
+def validate(args):
+    init_time = str(int(time.time()))
+    dst = load_dataset(args)
+    if args.mask_format != '' and args.mask_format not in MASK_FORMATS:
+        raise ValueError('unknown mask format {}, available: {}'.format(args.mask_format, ', '.join(MASK_FORMATS)))
+    if args.mask_format != '' or args.blend:
+        if args.output_dir == '':
+            args.output_dir = '/tmp/' + init_time
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+
+    if args.workers > 1 and args.profile <= 0:
+        # 每个进程加载自己的模型，处理连续的一段数据，各自的混淆矩阵最后相加，结果和单进程完全相同
+        if args.threads <= 0:
+            args.threads = max(1, multiprocessing.cpu_count() // args.workers)
+        shards = [shard.tolist() for shard in np.array_split(np.arange(len(dst)), args.workers) if len(shard) > 0]
+        # spawn避免fork后torch线程池和已加载的模型状态带来的问题
+        pool = multiprocessing.get_context('spawn').Pool(len(shards))
+        try:
+            hists = pool.starmap(validate_shard, [(args, shard) for shard in shards])
+        finally:
+            pool.close()
+            pool.join()
+        metrics = StreamingSegMetrics(n_class=dst.n_classes, ignore_index=250)
+        for hist in hists:
+            metrics.merge(hist)
+    else:
+        if args.threads > 0:
+            torch.set_num_threads(args.threads)
+        vis = None
+        if args.vis:
+            import visdom
+            vis = visdom.Visdom()
+        model = load_model(args, dst.n_classes)
+        predictor = load_predictor(args, dst.n_classes, model=model)
+        profiler = None
+        if args.profile > 0:
+            # 在单进程中统计前args.profile个batch中各模块的耗时
+            profiler = ModuleProfiler(model).start()
+        metrics = evaluate(args, dst, predictor, vis=vis, init_time=init_time, profiler=profiler)
+        if profiler is not None:
+            profiler.stop()
+            print(profiler.table())
+            if args.profile_trace != '':
+                profiler.export_chrome_trace(args.profile_trace)
+
+    score, class_iou = metrics.get_scores()
     for k, v in score.items():
         print(k, v)
 
@@ -139,9 +238,30 @@ if __name__=='__main__':
     parser.add_argument('--validate_model', type=str, default='', help='validate model path [ fcn32s_camvid_9.pkl ]')
     parser.add_argument('--validate_model_state_dict', type=str, default='', help='validate model state dict path [ fcn32s_camvid_9.pt ]')
     parser.add_argument('--dataset_path', type=str, default='', help='train dataset path [ /home/cgf/Data/CamVid ]')
-    parser.add_argument('--n_classes', type=int, default=13, help='train class num [ 13 ]')
+    parser.add_argument('--dataset_format', type=str, default='raw', help='dataset format, packed reads the shards written by python -m semseg.dataloader.packed_loader [ raw packed ]')
+    parser.add_argument('--img_uint8', type=bool, default=False, help='load uint8 images and normalize them per batch [ False ]')
+    parser.add_argument('--dataset', type=str, default='CamVid', help='validate dataset [ CamVid CityScapes ]')
+    parser.add_argument('--sliding_window', type=bool, default=False, help='predict overlapping crop_size windows, CityScapes is validated at full resolution [ False ]')
+    parser.add_argument('--crop_size', type=int, default=713, help='sliding window size [ 713 ]')
+    parser.add_argument('--stride_rate', type=float, default=2 / 3., help='sliding window stride relative to crop_size [ 0.667 ]')
+    parser.add_argument('--tile_batch_size', type=int, default=4, help='windows per forward, caps the memory of sliding window inference [ 4 ]')
+    parser.add_argument('--tile_blend', type=str, default='mean', help='weight of the overlapping windows [ mean gaussian linear ]')
+    parser.add_argument('--tile_flip', type=bool, default=False, help='average with the horizontally flipped windows [ False ]')
+    parser.add_argument('--scales', type=str, default='1.0', help='comma separated test scales, e.g. 0.5,0.75,1.0,1.25,1.5 [ 1.0 ]')
+    parser.add_argument('--flip', type=bool, default=False, help='average with the horizontally flipped prediction [ False ]')
+    parser.add_argument('--tta_fusion', type=str, default='mean', help='fusion of the multi-scale/flip predictions [ mean max ]')
+    parser.add_argument('--fuse_bn', type=bool, default=False, help='fold BatchNorm into the convolutions before validating [ False ]')
+    parser.add_argument('--batch_size', type=int, default=1, help='validate batch size, halved automatically when out of memory [ 1 ]')
+    parser.add_argument('--size_divisor', type=int, default=1, help='pad the batch height and width to a multiple of it, e.g. 32 for segnet [ 1 ]')
+    parser.add_argument('--workers', type=int, default=1, help='validate shards of the split in N processes, the confusion matrices are merged [ 1 ]')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads per process, 0 splits the cores between the workers [ 0 ]')
+    parser.add_argument('--profile', type=int, default=0, help='profile the modules over the first N batches in one process, 0 disables [ 0 ]')
+    parser.add_argument('--profile_trace', type=str, default='', help='export the profile as a chrome trace to this path')
+    parser.add_argument('--n_classes', type=int, default=0, help='train class num, 0 for the dataset class num [ 0 ]')
     parser.add_argument('--vis', type=bool, default=False, help='visualize the training results [ False ]')
     parser.add_argument('--blend', type=bool, default=False, help='blend the result and the origin [ False ]')
+    parser.add_argument('--mask_format', type=str, default='', help='save the predicted masks, empty saves none [ ' + ' '.join(MASK_FORMATS) + ' ]')
+    parser.add_argument('--output_dir', type=str, default='', help='directory of the masks and blends, empty for /tmp/<time>')
     args = parser.parse_args()
     # print(args.resume_model)
     # print(args.save_model)